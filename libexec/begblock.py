@@ -8,7 +8,10 @@
 
 import sys
 import os
+import copy
+import time
 import collections
+import concurrent.futures as futures
 
 import despymisc.miscutils as miscutils
 import intgutils.intgdefs as intgdefs
@@ -19,6 +22,8 @@ from processingfw.runqueries import runqueries
 import processingfw.pfwblock as pfwblock
 import processingfw.pfwdb as pfwdb
 
+DEF_JOBFILE_NTHREADS = 4
+
 
 def begblock(argv):
     """ Program entry point """
@@ -136,15 +141,27 @@ def begblock(argv):
             missingfiles = dbh.check_files(config, finallist)
             if missingfiles:
                 raise Exception("The following input files cannot be found in the archive:" + ",".join(missingfiles))
+        # input list files used by several jobs go into shared tarballs
+        shared_inputs = set()
+        if miscutils.convertBool(config.getfull('use_shared_input_tar', default='true')):
+            shared_inputs = pfwblock.find_shared_inputs(joblist)
+        # one tarball per group of files used by the same jobs, so no file
+        # is in more than one tarball
+        filehashes = {}
+        for (jobkeys, groupfiles) in pfwblock.group_shared_inputs(joblist, shared_inputs):
+            sharedtar = pfwblock.tar_shared_inputfiles(groupfiles, filehashes)
+            for jobkey in jobkeys:
+                joblist[jobkey].setdefault('inputsharedtars', []).append(sharedtar)
+
         miscutils.fwdebug_print("Creating job files - BEG")
-        for jobkey, jobdict in sorted(joblist.items()):
+        starttime = time.time()
+        joborder = sorted(joblist.items())
+        for jobkey, jobdict in joborder:
             jobdict['jobnum'] = pfwutils.pad_jobnum(config.inc_jobnum())
             jobdict['jobkeys'] = jobkey
             jobdict['numexpwrap'] = len(jobdict['tasks'])
             if miscutils.fwdebug_check(6, 'PFWBLOCK_DEBUG'):
                 miscutils.fwdebug_print(f"jobnum = {jobdict['jobnum']}, jobkey = {jobkey}:")
-            jobdict['tasksfile'] = write_workflow_taskfile(config, jobdict['jobnum'],
-                                                           jobdict['tasks'])
             if (jobdict['inlist'] and
                     config.getfull(pfwdefs.USE_HOME_ARCHIVE_OUTPUT) != 'never' and
                     'submit_files_mvmt' in config and
@@ -165,16 +182,22 @@ def begblock(argv):
                 pfwblock.copy_input_lists_home_archive(config, filemgmt,
                                                        archive_info, jobdict['inlist'])
                 filemgmt.commit()
-            jobdict['inputwcltar'] = pfwblock.tar_inputfiles(config, jobdict['jobnum'],
-                                                             jobdict['inwcl'] + jobdict['inlist'])
-            if miscutils.convertBool(config.getfull(pfwdefs.PF_USE_DB_OUT)):
-                dbh.insert_job(config, jobdict)
-            pfwblock.write_jobwcl(config, jobkey, jobdict)
             if ('glidein_use_wall' in config and
                     miscutils.convertBool(config.getfull('glidein_use_wall')) and
                     'jobwalltime' in config):
                 jobdict['wall'] = config['jobwalltime']
 
+        # all job rows in one transaction (job wcl needs the job task ids)
+        if miscutils.convertBool(config.getfull(pfwdefs.PF_USE_DB_OUT)):
+            dbh.insert_jobs(config, [jobdict for (_, jobdict) in joborder])
+
+        nthreads = int(config.getfull('begblock_nthreads', default=DEF_JOBFILE_NTHREADS))
+        with futures.ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+            jobfutures = [executor.submit(write_job_files, config, jobkey, jobdict, shared_inputs)
+                          for (jobkey, jobdict) in joborder]
+            for fut in futures.as_completed(jobfutures):
+                fut.result()   # re-raise any error from the job file writing
+        print(f"DESDMTIME: begblock_job_files {len(joborder)} {time.time()-starttime:0.3f}")
 
         miscutils.fwdebug_print("Creating job files - END")
 
@@ -209,6 +232,23 @@ def begblock(argv):
     return retval
 
 
+def write_job_files(config, jobkey, jobdict, shared_inputs):
+    """ Write the task list, input tarball and job wcl for a single job
+
+        Jobs are written concurrently after all jobnums were assigned, so
+        the job's files are written using a shallow copy of config whose
+        current jobnum is this job's (any value referencing ${jobnum}
+        without explicit currvals resolves to this job, not the last one).
+    """
+    config = copy.copy(config)
+    config[pfwdefs.PF_JOBNUM] = str(int(jobdict['jobnum']))
+    jobdict['tasksfile'] = write_workflow_taskfile(config, jobdict['jobnum'],
+                                                   jobdict['tasks'])
+    jobdict['inputwcltar'] = pfwblock.tar_inputfiles(config, jobdict['jobnum'],
+                                                     jobdict['inwcl'] + [f for f in jobdict['inlist'] if f not in shared_inputs])
+    pfwblock.write_jobwcl(config, jobkey, jobdict)
+
+
 def write_workflow_taskfile(config, jobnum, tasks):
     """ Write the list of wrapper executions for a single job to a file """
     taskfile = config.get_filename('jobtasklist', {pfwdefs.PF_CURRVALS:{'jobnum':jobnum},
@@ -14,6 +14,7 @@ import filemgmt.fmutils as fmutils
 import processingfw.pfwdefs as pfwdefs
 import processingfw.pfwutils as pfwutils
 import processingfw.pfwconfig as pfwconfig
+import processingfw.pfwlog as pfwlog
 from processingfw.pfwemail import send_email
 import qcframework.Messaging as Messaging
 
@@ -97,6 +98,9 @@ def begrun(argv):
                 pfw_dbh = config.dbh
             pfw_dbh.begin_task(config['task_id']['attempt'], True)
 
+        # optional local process batching deslog event writes from hooks
+        pfwlog.start_collector(config)
+
         # the three wcl files to copy to the home archive
         origwcl = config['origwcl']
         expwcl = config['expwcl']
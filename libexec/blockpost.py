@@ -19,10 +19,11 @@ import processingfw.pfwdefs as pfwdefs
 import processingfw.pfwutils as pfwutils
 import processingfw.pfwconfig as pfwconfig
 import processingfw.pfwdb as pfwdb
+import processingfw.pfwhookpool as pfwhookpool
+import processingfw.pfwverify as pfwverify
 from processingfw.pfwlog import log_pfw_event
 from processingfw.pfwemail import send_email, get_subblock_output
 import qcframework.Messaging as Messaging
-import filemgmt.compare_utils as cu
 import despydmdb.dbsemaphore as dbsem
 
 def get_qcf_messages(qdbh, wraptids):
@@ -137,8 +138,10 @@ def blockpost(argv=None):
         try:
             miscutils.fwdebug_print("Connecting to DB")
             if config.dbh is None:
+                dbstart = time.time()
                 dbh = pfwdb.PFWDB(config.getfull('submit_des_services'),
                                   config.getfull('submit_des_db_section'))
+                pfwhookpool.record_db_latency(time.time() - dbstart)
             else:
                 dbh = config.dbh
             if verify_files:
@@ -152,7 +155,18 @@ def blockpost(argv=None):
                     print(f"Cannot read archive root directory:{config.getfull('home_archive')} This program must be run on an NCSA machine with access to the archive storage system.")
                 sem = dbsem.DBSemaphore('verify_files_10', None, config.getfull('submit_des_services'), config.getfull('submit_des_db_section'), connection=dbh)
                 print("\n\nVerifying archive file sizes on disk (0 is success)")
-                verify_status = cu.compare(dbh=dbh, archive=config.getfull('home_archive'), pfwid=attid, md5sum=False, debug=False, script=False, verbose=False, silent=True)
+                archfiles = dbh.get_attempt_archive_files(attid, config.getfull('home_archive'))
+                archfiles = pfwverify.select_sample(archfiles,
+                                                    config.getfull('verify_files_sample', default='all'),
+                                                    float(config.getfull('verify_files_percent', default=pfwverify.DEF_PERCENT)),
+                                                    seed=attid)
+                problems = pfwverify.verify_files(archfiles, root,
+                                                  miscutils.convertBool(config.getfull('verify_files_md5sum', default='false')),
+                                                  int(config.getfull('verify_files_nthreads', default=pfwverify.DEF_NTHREADS)),
+                                                  f"{blkdir}/verify_files.checkpoint")
+                for fname, prob in sorted(problems.items())[:20]:
+                    print(f"    {fname}: {prob}")
+                verify_status = 1 if problems else 0
                 if sem is not None:
                     del sem
                     sem = None
@@ -175,11 +189,12 @@ def blockpost(argv=None):
             if ('block' in config['task_id'] and
                     str(blknum) in config['task_id']['block']):
                 blktid = int(config['task_id']['block'][str(blknum)])
-                miscutils.fwdebug_print("Getting block task info from DB")
+                miscutils.fwdebug_print("Getting block state from DB")
                 start_time = time.time()
-                bltasks = dbh.get_block_task_info(blktid)
+                (bltasks, blkjobinfo, blkwrapinfo, blkjobwrap, stats) = dbh.get_block_state(blktid, attid)
                 end_time = time.time()
-                miscutils.fwdebug_print(f"Done getting block task info from DB ({end_time - start_time} secs)")
+                miscutils.fwdebug_print(f"Done getting block state from DB ({end_time - start_time} secs)")
+                print(f"DESDMTIME: blockpost_state_queries {stats['queries']} {stats['rows']} {stats['bytes']} {end_time - start_time:0.3f}")
                 for bltdict in bltasks.values():
                     print("Block status = ", bltdict['status'])
                     if bltdict['status'] == pfwdefs.PF_EXIT_DRYRUN:
@@ -229,20 +244,12 @@ def blockpost(argv=None):
                 if retval != pfwdefs.PF_EXIT_DRYRUN:
                     print(f"\n\nChecking job status from pfw_job table in DB ({pfwdefs.PF_EXIT_SUCCESS} is success)")
 
-                    miscutils.fwdebug_print("Getting job info from DB")
-                    start_time = time.time()
-                    jobinfo = dbh.get_job_info({'pfw_block_task_id': blktid})
-                    end_time = time.time()
-                    miscutils.fwdebug_print(f"Done getting job info from DB ({end_time - start_time} secs)")
-                    miscutils.fwdebug_print("Getting wrapper info from DB")
-                    start_time = time.time()
-                    wrapinfo = dbh.get_wrapper_info(pfw_attempt_id=attid, pfw_block_task_id=blktid)
+                    jobinfo = blkjobinfo
+                    wrapinfo = blkwrapinfo
                     if retval != pfwdefs.PF_EXIT_SUCCESS:
-                        jobwrap = dbh.get_jobwrapper_info(id=attid)
+                        jobwrap = blkjobwrap
                     else:
                         jobwrap = {}
-                    end_time = time.time()
-                    miscutils.fwdebug_print(f"Done getting wrapper info from DB ({end_time - start_time} secs)")
             else:
                 msg = f"Could not find task id for block {blockname} in config.des"
                 print("Error:", msg)
@@ -474,6 +481,7 @@ def blockpost(argv=None):
         dbh.commit()
         #dbh.close()
     if dbh is not None:
+        dbh.print_stmt_stats()
         dbh.close()
     miscutils.fwdebug_print(f"Returning retval = {retval} ({type(retval)})")
     miscutils.fwdebug_print("END")
@@ -8,6 +8,10 @@
 
 import sys
 import os
+import copy
+import threading
+import time
+import concurrent.futures as futures
 
 import despymisc.miscutils as miscutils
 import processingfw.pfwdefs as pfwdefs
@@ -15,8 +19,122 @@ import processingfw.pfwconfig as pfwconfig
 import processingfw.pfwdb as pfwdb
 import filemgmt.archive_transfer_utils as archive_transfer_utils
 
-
-
+DEF_TRANSFER_CHUNKSIZE = 1000
+DEF_TRANSFER_NTHREADS = 4
+PROGRESS_FILE = 'endblock_transfer.progress'
+
+# per transfer thread copies of config/archive info with their own DB connection
+thread_state = threading.local()
+
+
+######################################################################
+def read_progress(progfile):
+    """ Read names of files already transferred by an earlier try """
+    done = set()
+    if os.path.exists(progfile):
+        with open(progfile, 'r') as progfh:
+            for line in progfh:
+                line = line.strip()
+                if line:
+                    done.add(line)
+    return done
+
+
+######################################################################
+def init_transfer_thread(target_info, home_info, config, dbhs, dbhs_lock):
+    """ Give a transfer thread its own config, archive info and DB connection
+
+        archive_copy isn't known to be thread safe and the shared
+        connection is also busy fetching the file list.
+    """
+    thread_state.target_info = copy.deepcopy(target_info)
+    thread_state.home_info = copy.deepcopy(home_info)
+    thread_state.config = copy.copy(config)
+    thread_state.config.dbh = None
+    if config.dbh is not None:
+        thread_state.config.dbh = pfwdb.PFWDB(config.getfull('submit_des_services', default=None),
+                                              config.getfull('submit_des_db_section', default=None))
+        with dbhs_lock:
+            dbhs.append(thread_state.config.dbh)
+
+
+######################################################################
+def transfer_chunk(transinfo, chunk):
+    """ Copy (and register) a single chunk of files from target to home archive """
+    starttime = time.time()
+    archive_transfer_utils.archive_copy(thread_state.target_info, thread_state.home_info,
+                                        transinfo, chunk, thread_state.config)
+    return len(chunk), time.time() - starttime
+
+
+######################################################################
+def transfer_outputs(target_info, home_info, transinfo, batches, config, nthreads):
+    """ Transfer files in chunks using a bounded number of concurrent transfers
+
+        batches is an iterable of lists of (filename, compression, path).
+        At most 2*nthreads chunks are in flight so memory stays flat for
+        huge runs.  Each finished chunk is appended to a progress file in
+        the block dir so a rerun of endblock only transfers what is left.
+        Each transfer thread works on its own copy of config with its own
+        DB connection.  Returns the number of chunks that failed.
+    """
+    done = read_progress(PROGRESS_FILE)
+    if done:
+        print(f"endblock transfer: {len(done)} files already transferred")
+    dbhs = []
+
+    starttime = time.time()
+    numfiles = 0
+    numchunks = 0
+    numfail = 0
+    with open(PROGRESS_FILE, 'a') as progfh, \
+         futures.ThreadPoolExecutor(max_workers=nthreads, initializer=init_transfer_thread,
+                                    initargs=(target_info, home_info, config,
+                                              dbhs, threading.Lock())) as executor:
+        inflight = {}
+
+        def finish(fut):
+            nonlocal numfiles, numfail
+            chunk = inflight.pop(fut)
+            try:
+                cnt, chunktime = fut.result()
+            except Exception as exc:
+                numfail += 1
+                print(f"Error: transfer of chunk starting with {chunk[0]} failed: {exc}")
+                return
+            progfh.write('\n'.join(chunk) + '\n')
+            progfh.flush()
+            numfiles += cnt
+            if miscutils.fwdebug_check(3, 'PFWENDBLOCK_DEBUG'):
+                miscutils.fwdebug_print(f"chunk of {cnt} files took {chunktime:0.2f} secs")
+
+        for batch in batches:
+            # done also keeps every file already handed out, so a file in
+            # several batches is only transferred once
+            chunk = list(dict.fromkeys(fname for (fname, _, _) in batch if fname not in done))
+            if not chunk:
+                continue
+            done.update(chunk)
+            while len(inflight) >= 2 * nthreads:
+                finished, _ = futures.wait(inflight, return_when=futures.FIRST_COMPLETED)
+                for fut in finished:
+                    finish(fut)
+            inflight[executor.submit(transfer_chunk, transinfo, chunk)] = chunk
+            numchunks += 1
+
+        for fut in futures.as_completed(list(inflight)):
+            finish(fut)
+
+    for dbh in dbhs:
+        dbh.close()
+
+    walltime = time.time() - starttime
+    rate = numfiles / walltime if walltime > 0 else 0.0
+    print(f"DESDMTIME: endblock_transfer {walltime:0.3f} ({numfiles} files in {numchunks} chunks, {rate:0.1f} files/sec, {nthreads} threads, {numfail} failed chunks)")
+    return numfail
+
+
+######################################################################
 def endblock(configfile):
     """ Program entry point """
     miscutils.fwdebug_print("BEG")
@@ -55,11 +173,13 @@ def endblock(configfile):
                 dbh = pfwdb.PFWDB()
             else:
                 dbh = config.dbh
-            filelist = dbh.get_run_filelist(config.getfull(pfwdefs.REQNUM),
+            chunksize = int(config.getfull('endblock_transfer_chunksize', default=DEF_TRANSFER_CHUNKSIZE))
+            batches = dbh.iter_run_filelist(config.getfull(pfwdefs.REQNUM),
                                             config.getfull(pfwdefs.UNITNAME),
                                             config.getfull(pfwdefs.ATTNUM),
                                             config.getfull(pfwdefs.PF_BLKNUM),
-                                            config.getfull(pfwdefs.TARGET_ARCHIVE))
+                                            config.getfull(pfwdefs.TARGET_ARCHIVE),
+                                            chunksize)
         else:
             print("Error:  Asked to transfer outputs at end of block, but not using database.")
             print("        Currently not supported.")
@@ -67,8 +187,12 @@ def endblock(configfile):
 
 
         # call transfer
-        archive_transfer_utils.archive_copy(target_info, home_info,
-                                            config.getfull('archive_transfer'), filelist, config)
+        nthreads = int(config.getfull('endblock_transfer_nthreads', default=DEF_TRANSFER_NTHREADS))
+        numfail = transfer_outputs(target_info, home_info, config.getfull('archive_transfer'),
+                                   batches, config, max(1, nthreads))
+        if numfail > 0:
+            print(f"Error: {numfail} chunks failed to transfer, rerun endblock to finish transfer")
+            return pfwdefs.PF_EXIT_FAILURE
 
     miscutils.fwdebug_print(f"END - exiting with code {pfwdefs.PF_EXIT_SUCCESS}")
     return pfwdefs.PF_EXIT_SUCCESS
@@ -13,6 +13,7 @@ import despymisc.miscutils as miscutils
 import processingfw.pfwdefs as pfwdefs
 import processingfw.pfwdb as pfwdb
 import processingfw.pfwconfig as pfwconfig
+import processingfw.pfwlog as pfwlog
 import filemgmt.archive_transfer_utils as archive_transfer_utils
 
 
@@ -65,6 +66,8 @@ def endrun(configfile):
                                                 archpath, config)
 
 
+    pfwlog.stop_collector(config)
+
     if miscutils.convertBool(config[pfwdefs.PF_USE_DB_OUT]):
         miscutils.fwdebug_print(f"Calling update_attempt_end: retval = {retval}")
         dbh = pfwdb.PFWDB(config.getfull('submit_des_services'),
@@ -6,10 +6,116 @@
 
 
 import argparse
+import json
+import re
 import sys
 import despydb.desdbi as desdbi
 import intgutils.queryutils as queryutils
 
+DEF_ARRAYSIZE = 5000
+PREFIX_PAT = re.compile(r'^[0-9a-zA-Z_-]+')
+COLUMN_PAT = re.compile(r'^[A-Za-z_][A-Za-z0-9_$#]*$')
+
+
+def get_prefix(filename):
+    """ Same prefix as regexp_substr(filename, '^[0-9a-zA-Z_-]+') """
+    pmatch = PREFIX_PAT.match(filename)
+    if pmatch is None:
+        return None
+    return pmatch.group(0)
+
+
+def fetch_batches(cursor, arraysize):
+    """ Yield rows from an executed cursor arraysize rows at a time """
+    while True:
+        rows = cursor.fetchmany(arraysize)
+        if not rows:
+            break
+        yield from rows
+
+
+def query_pairs_db(dbh, args, filetype1, filetype2, arraysize):
+    """ Yield (filename1, filename2, col0, col1) paired by the DB self-join """
+    bindstr = {k: dbh.get_named_bind_string(k) for k in ['execname', 'unitname', 'attnum', 'reqnum', 'filetype1', 'filetype2']}
+    wgbwhere = f"image.filename=wgb.filename and wgb.exec_name={bindstr['execname']} and wgb.unitname={bindstr['unitname']} and wgb.attnum={bindstr['attnum']} and wgb.reqnum={bindstr['reqnum']}"
+    query = f"select t1.filename,t2.filename,t1.{args.column[0]},t1.{args.column[1]} from (select image.filename,image.{args.column[0]},image.{args.column[1]},(regexp_substr(image.filename,'^[0-9a-zA-Z_-]+')) as n1 from wgb,image where {wgbwhere} and image.filetype={bindstr['filetype1']}) t1, (select image.filename,(regexp_substr(image.filename,'^[0-9a-zA-Z_-]+')) as n2 from wgb,image where {wgbwhere} and image.filetype={bindstr['filetype2']}) t2 where t1.n1=t2.n2"
+    params = {'execname': args.execname, 'unitname': args.unitname,
+              'attnum': args.attnum, 'reqnum': args.reqnum,
+              'filetype1': filetype1, 'filetype2': filetype2}
+
+    print("Executing the following query\n", query)
+    print("params =", params)
+
+    cursor = dbh.cursor()
+    cursor.arraysize = arraysize
+    cursor.execute(query, params)
+    try:
+        yield from fetch_batches(cursor, arraysize)
+    finally:
+        cursor.close()
+
+
+def query_pairs_client(dbh, args, filetype1, filetype2, arraysize):
+    """ Yield (filename1, filename2, col0, col1) paired with a hash join on the prefix
+
+        The filetype2 filenames are read into a dict keyed by prefix, then
+        the filetype1 rows are streamed and matched against it.
+    """
+    bindstr = {k: dbh.get_named_bind_string(k) for k in ['execname', 'unitname', 'attnum', 'reqnum', 'filetype']}
+    wgbwhere = f"image.filename=wgb.filename and wgb.exec_name={bindstr['execname']} and wgb.unitname={bindstr['unitname']} and wgb.attnum={bindstr['attnum']} and wgb.reqnum={bindstr['reqnum']} and image.filetype={bindstr['filetype']}"
+    params = {'execname': args.execname, 'unitname': args.unitname,
+              'attnum': args.attnum, 'reqnum': args.reqnum}
+
+    query2 = f"select image.filename from wgb,image where {wgbwhere}"
+    print("Executing the following query\n", query2)
+    cursor = dbh.cursor()
+    cursor.arraysize = arraysize
+    cursor.execute(query2, dict(params, filetype=filetype2))
+    byprefix = {}
+    for (fname2,) in fetch_batches(cursor, arraysize):
+        byprefix.setdefault(get_prefix(fname2), []).append(fname2)
+    cursor.close()
+    byprefix.pop(None, None)
+    print(f"{sum([len(v) for v in byprefix.values()])} {filetype2} files with {len(byprefix)} prefixes")
+
+    query1 = f"select image.filename,image.{args.column[0]},image.{args.column[1]} from wgb,image where {wgbwhere}"
+    print("Executing the following query\n", query1)
+    cursor = dbh.cursor()
+    cursor.arraysize = arraysize
+    cursor.execute(query1, dict(params, filetype=filetype1))
+    try:
+        for (fname1, val0, val1) in fetch_batches(cursor, arraysize):
+            for fname2 in byprefix.get(get_prefix(fname1), []):
+                yield (fname1, fname2, val0, val1)
+    finally:
+        cursor.close()
+
+
+def make_line(args, column1, column2, pair):
+    """ Create the list line for a single pair """
+    (fname1, fname2, val0, val1) = pair
+    return {'file': {column1: {args.column[0]: val0,
+                               args.column[1]: val1,
+                               'filename': fname1},
+                     column2: {args.column[0]: val0,
+                               args.column[1]: val1,
+                               'filename': fname2}}}
+
+
+def stream_json(qoutfile, lines):
+    """ Write (linename, line) pairs as a json list dataset as they come in """
+    cnt = 0
+    with open(qoutfile, 'w') as outfh:
+        outfh.write('{"list": {"line": {')
+        for linename, line in lines:
+            if cnt > 0:
+                outfh.write(',')
+            outfh.write(f"\n{json.dumps(linename)}: {json.dumps(line, default=str)}")
+            cnt += 1
+        outfh.write('\n}}}\n')
+    return cnt
+
+
 def main(argv):
     parser = argparse.ArgumentParser(description='filepairs_query.py')
     parser.add_argument('--qoutfile', action='store')
@@ -20,6 +126,11 @@ def main(argv):
     parser.add_argument('--execname', action='store')
     parser.add_argument('--unitname', action='store')
     parser.add_argument('--column', action='append')
+    parser.add_argument('--arraysize', action='store', type=int, default=DEF_ARRAYSIZE)
+    parser.add_argument('--pairing', action='store', choices=['db', 'client'], default='db',
+                        help='pair files in the DB (self-join) or client-side (hash join)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print the full list of pairs')
 
     args = parser.parse_args(argv)
 
@@ -30,45 +141,33 @@ def main(argv):
     filetype2 = items[0]
     column2 = items[1]
 
-    dbh = desdbi.DesDbi()
+    # column names cannot be bind variables
+    for col in args.column[:2]:
+        if not COLUMN_PAT.match(col):
+            print(f"Error: invalid column name '{col}'")
+            return 1
 
-    query = f"select t1.filename,t2.filename,t1.{args.column[0]},t1.{args.column[1]} from (select image.filename,image.{args.column[0]},image.{args.column[1]},(regexp_substr(image.filename,'^[0-9a-zA-Z_-]+')) as n1 from wgb,image where image.filename=wgb.filename and wgb.exec_name='{args.execname}' and wgb.unitname='{args.unitname}' and wgb.attnum={args.attnum} and wgb.reqnum={args.reqnum} and image.filetype='{filetype1}') t1, (select image.filename,(regexp_substr(image.filename,'^[0-9a-zA-Z_-]+')) as n2 from wgb,image where image.filename=wgb.filename and wgb.exec_name='{args.execname}' and wgb.unitname='{args.unitname}' and wgb.attnum={args.attnum} and wgb.reqnum={args.reqnum} and image.filetype='{filetype2}') t2 where t1.n1=t2.n2"
-
-    print("Executing the following query\n", query)
+    dbh = desdbi.DesDbi()
 
-    cursor = dbh.cursor()
-    cursor.execute(query)
-    result = cursor.fetchall()
-    cursor.close()
+    if args.pairing == 'client':
+        pairs = query_pairs_client(dbh, args, filetype1, filetype2, args.arraysize)
+    else:
+        pairs = query_pairs_db(dbh, args, filetype1, filetype2, args.arraysize)
 
-    listdict = {'list':{'line':{}}}
-    linedict = {}
-
-    length = len(result)
-    for i in range(length):
-        lineNum = i+1
-        line = f"line{lineNum:05d}"
-        filedict = {'file':{}}
-        columndict = {}
-        element1dict = {}
-        element2dict = {}
-        element1dict[args.column[0]] = result[i][2]
-        element1dict[args.column[1]] = result[i][3]
-        element1dict['filename'] = result[i][0]
-        columndict[column1] = element1dict
-        element2dict[args.column[0]] = result[i][2]
-        element2dict[args.column[1]] = result[i][3]
-        element2dict['filename'] = result[i][1]
-        columndict[column2] = element2dict
-        filedict['file'] = columndict
-        linedict[line] = filedict
-
-    listdict['list']['line'] = linedict
-
-    print("Results returned from query\n", listdict)
+    lines = ((f"line{lineNum:05d}", make_line(args, column1, column2, pair))
+             for lineNum, pair in enumerate(pairs, start=1))
 
     ## output list
-    queryutils.output_lines(args.qoutfile, listdict, args.qouttype)
+    if args.qouttype == 'json' and not args.verbose:
+        # json can be written as rows are fetched instead of held in memory
+        numlines = stream_json(args.qoutfile, lines)
+        print(f"Query returned {numlines} pairs")
+    else:
+        listdict = {'list':{'line':dict(lines)}}
+        print(f"Query returned {len(listdict['list']['line'])} pairs")
+        if args.verbose:
+            print("Results returned from query\n", listdict)
+        queryutils.output_lines(args.qoutfile, listdict, args.qouttype)
 
     return 0
 
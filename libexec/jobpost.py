@@ -9,9 +9,12 @@
 import sys
 import re
 import os
+import json
 import tempfile
 import traceback
 import random
+import time
+import collections
 from datetime import datetime
 
 import despymisc.miscutils as miscutils
@@ -19,92 +22,215 @@ import processingfw.pfwdefs as pfwdefs
 import processingfw.pfwconfig as pfwconfig
 import processingfw.pfwcondor as pfwcondor
 import processingfw.pfwutils as pfwutils
-import processingfw.pfwdb as pfwdb
+from processingfw.pfwhook import HookRuntime
 from processingfw.pfwlog import log_pfw_event
-import qcframework.Messaging as Messaging
 
-def parse_job_output(config, jobnum, dbh=None, retval=None):
+class JobPostResult:
+    """ Collects the pfw_job and task values jobpost finds for a job
+        (job output, condor log, final task status) so they can be
+        written in one transaction """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.jobvals = collections.OrderedDict()   # job task id -> pfw_job values
+        self.taskvals = {}
+
+    def add_job_values(self, vals, task_id=None):
+        """ Add pfw_job values, later values override earlier ones """
+        if vals:
+            self.jobvals.setdefault(task_id or self.task_id, {}).update(vals)
+
+    def add_task_values(self, vals):
+        """ Add values for the job's row in the task table """
+        self.taskvals.update(vals)
+
+    def apply(self, dbh):
+        """ Write everything collected and commit once """
+        starttime = time.time()
+        numstmts = dbh.update_job_results(self.task_id, self.jobvals, self.taskvals)
+        print(f"DESDMTIME: jobpost_db_update {numstmts} {time.time()-starttime:0.3f}")
+
+
+# byte strings marking job output lines jobpost cares about
+JOBOUT_MARKERS = (b'PFW:', b'No such file or directory:', b'Error: eups setup',
+                  b'Exiting with status', b'Could not connect to database')
+JOBOUT_CHUNKSIZE = 16 * 1024 * 1024
+JOBOUT_SCAN_STATE = 'jobpost_scan.json'
+DEF_MAX_MSGS_PER_PATTERN = 50
+
+
+def find_marker_lines(buf, end):
+    """ Return sorted start offsets of lines in buf[:end] containing any marker """
+    starts = set()
+    for marker in JOBOUT_MARKERS:
+        pos = buf.find(marker, 0, end)
+        while pos != -1:
+            starts.add(buf.rfind(b'\n', 0, pos) + 1)
+            stop = buf.find(b'\n', pos, end)
+            if stop == -1:
+                break
+            pos = buf.find(marker, stop, end)
+    return sorted(starts)
+
+
+def scan_chunk(buf, end, lineno, handle_line):
+    """ Call handle_line(lineno, line) for each line in buf[:end] containing a marker
+
+        Returns the line number following buf[:end].
+    """
+    pos = 0
+    cnt = lineno
+    for start in find_marker_lines(buf, end):
+        cnt += buf.count(b'\n', pos, start)
+        pos = start
+        stop = buf.find(b'\n', start, end)
+        if stop == -1:
+            stop = end
+        handle_line(cnt, buf[start:stop].decode('utf-8', errors='replace'))
+
+    lineno += buf.count(b'\n', 0, end)
+    if end > 0 and buf[end-1:end] != b'\n':
+        lineno += 1
+    return lineno
+
+
+def scan_job_output(jobfile, handle_line, offset=0, lineno=0, chunksize=JOBOUT_CHUNKSIZE):
+    """ Call handle_line(lineno, line) for each line of jobfile containing a marker
+
+        The file is read in large chunks cut at line ends and searched for
+        the markers as bytes, so only matching lines are decoded.
+        Scanning starts at byte offset, which must be the start of line
+        lineno.  Returns (offset, lineno) at the end of the file.
+    """
+    with open(jobfile, 'rb') as jobfh:
+        jobfh.seek(offset)
+        tail = b''
+        while True:
+            chunk = jobfh.read(chunksize)
+            if not chunk:
+                break
+            chunk = tail + chunk
+            end = chunk.rfind(b'\n') + 1
+            tail = chunk[end:]
+            if end > 0:
+                lineno = scan_chunk(chunk, end, lineno, handle_line)
+                offset += end
+        if tail:   # last line missing its newline
+            lineno = scan_chunk(tail, len(tail), lineno, handle_line)
+            offset += len(tail)
+    return offset, lineno
+
+
+def read_scan_state(statefile):
+    """ Return saved jobpost scan state, empty if none """
+    try:
+        with open(statefile, 'r') as statefh:
+            return json.load(statefh)
+    except (OSError, ValueError):
+        return {}
+
+
+def parse_job_output(config, jobnum, hook=None, retval=None):
     """ Search stdout/stderr for timing stats as well as eups setup
-        or DB connection error messages and insert them into db """
+        or DB connection error messages and queue them for the db
+
+        Only the first jobpost_max_msgs_per_pattern messages for each kind
+        of error are saved, followed by a count of the rest.  If
+        jobpost_scan_resume is true, where the scan ended and what it found
+        are saved so a rerun of jobpost only reads new output.
+    """
     jobbase = config.get_filename('job',
                                   {pfwdefs.PF_CURRVALS: {pfwdefs.PF_JOBNUM:jobnum,
                                                          'flabel': 'runjob',
                                                          'fsuffix':''}})
-    tjobinfo = {}
-    tjobinfo_task = {}
+    task_id = config['task_id']['job'][jobnum]
+    desservices = config.getfull('target_des_services')
+    maxmsgs = int(config.getfull('jobpost_max_msgs_per_pattern', default=DEF_MAX_MSGS_PER_PATTERN))
+    resume = miscutils.convertBool(config.getfull('jobpost_scan_resume', default='false'))
+
+    state = read_scan_state(JOBOUT_SCAN_STATE) if resume else {}
+    tjobinfo = state.get('tjobinfo', {})
+    tjobinfo_task = state.get('tjobinfo_task', {})
+    positions = state.get('positions', {})
+    msgcnts = {}    # kind of message -> [count, msglvl, jobfile]
+
+    def add_message(kind, msg, msglvl, jobfile, no):
+        """ Queue message unless already saved too many of this kind """
+        cnt = msgcnts.setdefault(kind, [0, msglvl, jobfile])
+        cnt[0] += 1
+        cnt[2] = jobfile
+        if hook and cnt[0] <= maxmsgs:
+            hook.message(task_id, msg, msglvl, jobfile, no)
+
+    def handle_line(no, line, jobfile):
+        """ Pull information out of a single matching line """
+        line = line.strip()
+        if line.startswith('PFW:'):
+            parts = line.split()
+            if len(parts) < 3:
+                return
+            if parts[1] == 'batchid':
+                if parts[2] == '=':   # older pfwrunjob.py
+                    tjobinfo['target_job_id'] = parts[3]
+                else:
+                    tjobinfo['target_job_id'] = parts[2]
+            elif parts[1] == 'condorid':
+                tjobinfo['condor_job_id'] = parts[2]
+            elif parts[1] == 'job_shell_script' and len(parts) > 3:
+                if parts[2] == 'exechost:':
+                    tjobinfo_task['exec_host'] = parts[3]
+                elif parts[2] == 'starttime:':
+                    tjobinfo_task['start_time'] = float(parts[3])
+                elif parts[2] == 'endtime:':
+                    tjobinfo_task['end_time'] = float(parts[3])
+                elif parts[2] == 'exit_status:':
+                    tjobinfo_task['status'] = parts[3]
+        # skip ORA messages as they are caught by the QCF earlier, and not all are fatal
+        elif "No such file or directory:" in line and desservices and desservices in line:
+            add_message('No such file or directory', line, pfwdefs.PFWDB_MSG_ERROR, jobfile, no)
+        elif "Error: eups setup" in line:
+            print("Setting retval to failure")
+            tjobinfo_task['status'] = pfwdefs.PF_EXIT_EUPS_FAILURE
+            add_message('Error: eups setup', line, pfwdefs.PFWDB_MSG_ERROR, jobfile, no)
+        elif "Exiting with status" in line:
+            lmatch = re.search(r'Exiting with status (\d+)', line)
+            if lmatch:
+                if int(lmatch.group(1)) != 0 and retval == 0:
+                    msg = f"Info:  Job exit status was {lmatch.group(1)}, but retval was {retval}."
+                    msg += "Setting retval to failure."
+                    tjobinfo['status'] = pfwdefs.PF_EXIT_FAILURE
+                    add_message('Exiting with status', msg, pfwdefs.PFWDB_MSG_ERROR, jobfile, no)
+        elif "Could not connect to database" in line:
+            add_message('Could not connect to database', line, pfwdefs.PFWDB_MSG_INFO, jobfile, no)
+
+    starttime = time.time()
+    numbytes = 0
     for jobfile in [f"{jobbase}out", f"{jobbase}err"]:
         if os.path.exists(jobfile):
-            with open(jobfile, 'r') as jobfh:
-                for no, line in enumerate(jobfh):
-                    line = line.strip()
-                    if line.startswith('PFW:'):
-                        parts = line.split()
-                        if parts[1] == 'batchid':
-                            if parts[2] == '=':   # older pfwrunjob.py
-                                tjobinfo['target_job_id'] = parts[3]
-                            else:
-                                tjobinfo['target_job_id'] = parts[2]
-                        elif parts[1] == 'condorid':
-                            tjobinfo['condor_job_id'] = parts[2]
-                        elif parts[1] == 'job_shell_script':
-                            #print("parts[2]", parts[2])
-                            #print("parts[3]", parts[3])
-                            if parts[2] == 'exechost:':
-                                #tjobinfo['target_exec_host'] = parts[3]
-                                tjobinfo_task['exec_host'] = parts[3]
-                            elif parts[2] == 'starttime:':
-                                tjobinfo_task['start_time'] = datetime.fromtimestamp(float(parts[3]))
-                            elif parts[2] == 'endtime:':
-                                #tjobinfo['target_end_time'] = datetime.fromtimestamp(float(parts[3]))
-                                tjobinfo_task['end_time'] = datetime.fromtimestamp(float(parts[3]))
-                            elif parts[2] == 'exit_status:':
-                                tjobinfo_task['status'] = parts[3]
-                    # skip ORA messages as they are caught by the QCF earlier, and not all are fatal
-                    #elif 'ORA-' in line:
-                        #print "Found:", line
-                        #if not 'DBD' in line:
-                        #    print "Setting retval to failure"
-                        #    tjobinfo_task['status'] = pfwdefs.PF_EXIT_FAILURE
-                        #else:
-                        #    print " Ignoring QCF perl error message."
-                    #    if dbh:
-                    #        Messaging.pfw_message(dbh, config['pfw_attempt_id'],
-                    #                              config['task_id']['job'][jobnum],
-                    #                              line, pfwdefs.PFWDB_MSG_ERROR, jobfile, no)
-                    elif "No such file or directory:" in line and \
-                          config.getfull('target_des_services') in line:
-                        #print "Found:", line
-                        if dbh:
-                            Messaging.pfw_message(dbh, config['pfw_attempt_id'],
-                                                  config['task_id']['job'][jobnum],
-                                                  line, pfwdefs.PFWDB_MSG_ERROR, jobfile, no)
-                    elif "Error: eups setup" in line:
-                        #print "Found:", line
-                        print("Setting retval to failure")
-                        tjobinfo_task['status'] = pfwdefs.PF_EXIT_EUPS_FAILURE
-                        if dbh:
-                            Messaging.pfw_message(dbh, config['pfw_attempt_id'],
-                                                  config['task_id']['job'][jobnum],
-                                                  line, pfwdefs.PFWDB_MSG_ERROR, jobfile, no)
-                    elif "Exiting with status" in line:
-                        lmatch = re.search(r'Exiting with status (\d+)', line)
-                        if lmatch:
-                            if int(lmatch.group(1)) != 0 and retval == 0:
-                                #print "Found:", line
-                                msg = f"Info:  Job exit status was {lmatch.group(1)}, but retval was {retval}."
-                                msg += "Setting retval to failure."
-                                #print msg
-                                tjobinfo['status'] = pfwdefs.PF_EXIT_FAILURE
-                                if dbh:
-                                    Messaging.pfw_message(dbh, config['pfw_attempt_id'],
-                                                          config['task_id']['job'][jobnum],
-                                                          msg, pfwdefs.PFWDB_MSG_ERROR, jobfile, no)
-                    elif "Could not connect to database" in line:
-                        #print "Found:", line
-                        if dbh:
-                            Messaging.pfw_message(dbh, config['pfw_attempt_id'],
-                                                  config['task_id']['job'][jobnum],
-                                                  line, pfwdefs.PFWDB_MSG_INFO, jobfile, no)
+            (offset, lineno) = positions.get(jobfile, (0, 0))
+            if offset > os.path.getsize(jobfile):   # file was replaced, start over
+                (offset, lineno) = (0, 0)
+            (newoffset, lineno) = scan_job_output(jobfile,
+                                                  lambda no, line, jfile=jobfile: handle_line(no, line, jfile),
+                                                  offset, lineno)
+            numbytes += newoffset - offset
+            positions[jobfile] = (newoffset, lineno)
+    print(f"DESDMTIME: jobpost_parse_job_output {numbytes} {time.time()-starttime:0.3f}")
+
+    for kind, (cnt, msglvl, jobfile) in msgcnts.items():
+        if cnt > maxmsgs and hook:
+            hook.message(task_id, f"{cnt - maxmsgs} more '{kind}' messages not saved (see {jobfile})",
+                         msglvl, jobfile, 0)
+
+    if resume:
+        with open(JOBOUT_SCAN_STATE, 'w') as statefh:
+            json.dump({'positions': positions, 'tjobinfo': tjobinfo,
+                       'tjobinfo_task': tjobinfo_task}, statefh)
+
+    # times are kept as epoch secs until here so the scan state can be saved as json
+    for key in ['start_time', 'end_time']:
+        if key in tjobinfo_task:
+            tjobinfo_task[key] = datetime.fromtimestamp(float(tjobinfo_task[key]))
 
     return tjobinfo, tjobinfo_task
 
@@ -122,195 +248,150 @@ def jobpost(argv=None):
 
     #debugfh = tempfile.NamedTemporaryFile(prefix='jobpost_', dir='.', delete=False)
     tmpfn = os.path.join(os.getcwd(), f"jobpost_{random.randint(1,10000000):08d}.out")
-    debugfh = open(tmpfn, 'w')
-    #tmpfn = debugfh.name
-    outorig = sys.stdout
-    errorig = sys.stderr
-    sys.stdout = debugfh
-    sys.stderr = debugfh
-
-    miscutils.fwdebug_print(f"temp log name = {tmpfn}")
-    print('cmd>', ' '.join(argv))  # print command line for debugging
-
-    if len(argv) < 7:
-        # open file to catch error messages about command line
-        print("Usage: jobpost.py configfile block jobnum inputtar outputtar retval")
-        debugfh.close()
-        return pfwdefs.PF_EXIT_FAILURE
-
-    configfile = argv[1]
-    blockname = argv[2]
-    jobnum = argv[3]
-    inputtar = argv[4]
-    outputtar = argv[5]
-    retval = pfwdefs.PF_EXIT_FAILURE
-    if len(argv) == 7:
-        retval = int(sys.argv[6])
-
-    if miscutils.fwdebug_check(3, 'PFWPOST_DEBUG'):
-        miscutils.fwdebug_print("configfile = %s" % configfile)
-        miscutils.fwdebug_print("block = %s" % blockname)
-        miscutils.fwdebug_print("jobnum = %s" % jobnum)
-        miscutils.fwdebug_print("inputtar = %s" % inputtar)
-        miscutils.fwdebug_print("outputtar = %s" % outputtar)
-        miscutils.fwdebug_print("retval = %s" % retval)
-
-
-    # read sysinfo file
-    config = pfwconfig.PfwConfig({'wclfile': configfile})
-    if miscutils.fwdebug_check(3, 'PFWPOST_DEBUG'):
-        miscutils.fwdebug_print("done reading config file")
-
-
-    # now that have more information, rename output file
-    if miscutils.fwdebug_check(3, 'PFWPOST_DEBUG'):
-        miscutils.fwdebug_print("before get_filename")
-    blockname = config.getfull('blockname')
-    blkdir = config.getfull('block_dir')
-    tjpad = pfwutils.pad_jobnum(jobnum)
-
-    os.chdir("%s/%s" % (blkdir, tjpad))
-    new_log_name = config.get_filename('job', {pfwdefs.PF_CURRVALS: {pfwdefs.PF_JOBNUM: jobnum,
-                                                                     'flabel': 'jobpost',
-                                                                     'fsuffix':'out'}})
-    new_log_name = new_log_name
-    miscutils.fwdebug_print(f"new_log_name = {new_log_name}")
-
-    debugfh.close()
-    sys.stdout = outorig
-    sys.stderr = errorig
-    os.chmod(tmpfn, 0o666)
-    os.rename(tmpfn, new_log_name)
-    dbh = None
-    miscutils.fwdebug_print("H1")
-    if miscutils.convertBool(config.getfull(pfwdefs.PF_USE_DB_OUT)):
-        #if config.dbh is None:
-        dbh = pfwdb.PFWDB(config.getfull('submit_des_services'),
-                          config.getfull('submit_des_db_section'))
-        miscutils.fwdebug_print("GET DBH")
-        #else:
-        #    dbh = config.dbh
-        #    miscutils.fwdebug_print("HAVE DBH")
-    miscutils.fwdebug_print("H2")
-    if 'use_qcf' in config and config['use_qcf']:
-        debugfh = Messaging.Messaging(new_log_name, 'jobpre.py', config['pfw_attempt_id'], dbh=dbh, mode='a+', usedb=dbh is not None)
-        miscutils.fwdebug_print("USE QCF")
-    else:
-        debugfh = open(new_log_name, 'a+')
-        miscutils.fwdebug_print("NO QCF")
-
-    sys.stdout = debugfh
-    sys.stderr = debugfh
-
-
-    if miscutils.convertBool(config.getfull(pfwdefs.PF_USE_DB_OUT)):
-        # get job information from the job stdout if exists
-        (tjobinfo, tjobinfo_task) = parse_job_output(config, jobnum, dbh, retval)
-
-        if dbh and tjobinfo:
-            print("tjobinfo: ", tjobinfo)
-            dbh.update_tjob_info(config['task_id']['job'][jobnum], tjobinfo)
-
-        # get job information from the condor job log
-        logfilename = 'runjob.log'
-        if os.path.exists(logfilename) and os.path.getsize(logfilename) > 0:  # if made it to submitting/running jobs
-            try:
-                # update job info in DB from condor log
-                print("Updating job info in DB from condor log")
-                condorjobinfo = pfwcondor.parse_condor_user_log(logfilename)
-                if len(condorjobinfo) > 1:
-                    print("More than single job in job log")
-                j = list(condorjobinfo.keys())[0]
-                cjobinfo = condorjobinfo[j]
-                djobinfo = {}
-                for ckey, dkey in condor2db.items():
-                    if ckey in cjobinfo:
-                        djobinfo[dkey] = cjobinfo[ckey]
-                #print(djobinfo)
-                dbh.update_job_info(config, cjobinfo['jobname'], djobinfo)
-
-                if 'holdreason' in cjobinfo and cjobinfo['holdreason'] is not None:
-                    msg = f"Condor HoldReason: {cjobinfo['holdreason']}"
-                    print(msg)
-                    if dbh:
-                        Messaging.pfw_message(dbh, config['pfw_attempt_id'],
-                                              config['task_id']['job'][jobnum],
-                                              msg, pfwdefs.PFWDB_MSG_WARN, logfilename, 0)
-
-                if 'abortreason' in cjobinfo and cjobinfo['abortreason'] is not None:
-                    tjobinfo_task['start_time'] = cjobinfo['starttime']
-                    tjobinfo_task['end_time'] = cjobinfo['endtime']
-                    if 'condor_rm' in cjobinfo['abortreason']:
-                        tjobinfo_task['status'] = pfwdefs.PF_EXIT_OPDELETE
+    with HookRuntime('jobpost', tmpfn) as hook:
+        miscutils.fwdebug_print(f"temp log name = {tmpfn}")
+        print('cmd>', ' '.join(argv))  # print command line for debugging
+
+        if len(argv) < 7:
+            # open file to catch error messages about command line
+            print("Usage: jobpost.py configfile block jobnum inputtar outputtar retval")
+            return pfwdefs.PF_EXIT_FAILURE
+
+        configfile = argv[1]
+        blockname = argv[2]
+        jobnum = argv[3]
+        inputtar = argv[4]
+        outputtar = argv[5]
+        retval = pfwdefs.PF_EXIT_FAILURE
+        if len(argv) == 7:
+            retval = int(sys.argv[6])
+
+        if miscutils.fwdebug_check(3, 'PFWPOST_DEBUG'):
+            miscutils.fwdebug_print("configfile = %s" % configfile)
+            miscutils.fwdebug_print("block = %s" % blockname)
+            miscutils.fwdebug_print("jobnum = %s" % jobnum)
+            miscutils.fwdebug_print("inputtar = %s" % inputtar)
+            miscutils.fwdebug_print("outputtar = %s" % outputtar)
+            miscutils.fwdebug_print("retval = %s" % retval)
+
+
+        # read sysinfo file
+        config = pfwconfig.PfwConfig({'wclfile': configfile})
+        if miscutils.fwdebug_check(3, 'PFWPOST_DEBUG'):
+            miscutils.fwdebug_print("done reading config file")
+
+
+        # now that have more information, rename output file
+        if miscutils.fwdebug_check(3, 'PFWPOST_DEBUG'):
+            miscutils.fwdebug_print("before get_filename")
+        blockname = config.getfull('blockname')
+        blkdir = config.getfull('block_dir')
+        tjpad = pfwutils.pad_jobnum(jobnum)
+
+        os.chdir("%s/%s" % (blkdir, tjpad))
+        new_log_name = config.get_filename('job', {pfwdefs.PF_CURRVALS: {pfwdefs.PF_JOBNUM: jobnum,
+                                                                         'flabel': 'jobpost',
+                                                                         'fsuffix':'out'}})
+        new_log_name = new_log_name
+        miscutils.fwdebug_print(f"new_log_name = {new_log_name}")
+
+        hook.set_log_name(config, new_log_name)
+        dbh = hook.dbh
+
+        if miscutils.convertBool(config.getfull(pfwdefs.PF_USE_DB_OUT)):
+            # get job information from the job stdout if exists
+            (tjobinfo, tjobinfo_task) = parse_job_output(config, jobnum, hook, retval)
+            result = JobPostResult(config['task_id']['job'][jobnum])
+
+            if dbh and tjobinfo:
+                print("tjobinfo: ", tjobinfo)
+                result.add_job_values(tjobinfo)
+
+            # get job information from the condor job log
+            logfilename = 'runjob.log'
+            if os.path.exists(logfilename) and os.path.getsize(logfilename) > 0:  # if made it to submitting/running jobs
+                try:
+                    # update job info in DB from condor log
+                    print("Gathering job info for DB from condor log")
+                    condorjobinfo = pfwcondor.parse_condor_user_log(logfilename)
+                    if len(condorjobinfo) > 1:
+                        print("More than single job in job log")
+                    j = list(condorjobinfo.keys())[0]
+                    cjobinfo = condorjobinfo[j]
+                    djobinfo = {}
+                    for ckey, dkey in condor2db.items():
+                        if ckey in cjobinfo:
+                            djobinfo[dkey] = cjobinfo[ckey]
+                    #print(djobinfo)
+                    result.add_job_values(djobinfo, config['task_id']['job'][cjobinfo['jobname']])
+
+                    if 'holdreason' in cjobinfo and cjobinfo['holdreason'] is not None:
+                        msg = f"Condor HoldReason: {cjobinfo['holdreason']}"
+                        print(msg)
+                        if dbh:
+                            hook.message(config['task_id']['job'][jobnum],
+                                         msg, pfwdefs.PFWDB_MSG_WARN, logfilename, 0)
+
+                    if 'abortreason' in cjobinfo and cjobinfo['abortreason'] is not None:
+                        tjobinfo_task['start_time'] = cjobinfo['starttime']
+                        tjobinfo_task['end_time'] = cjobinfo['endtime']
+                        if 'condor_rm' in cjobinfo['abortreason']:
+                            tjobinfo_task['status'] = pfwdefs.PF_EXIT_OPDELETE
+                        else:
+                            tjobinfo_task['status'] = pfwdefs.PF_EXIT_CONDOR
                     else:
-                        tjobinfo_task['status'] = pfwdefs.PF_EXIT_CONDOR
-                else:
-                    pass
-            except Exception:
-                (extype, exvalue, trback) = sys.exc_info()
-                traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
+                        pass
+                except Exception:
+                    (extype, exvalue, trback) = sys.exc_info()
+                    traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
+            else:
+                print("Warning:  no job condor log file")
+
+            if dbh:
+                # update job task
+                if 'status' not in tjobinfo_task:
+                    tjobinfo_task['status'] = pfwdefs.PF_EXIT_CONDOR
+                if 'end_time' not in tjobinfo_task:
+                    tjobinfo_task['end_time'] = datetime.now()
+                result.add_task_values(tjobinfo_task)
+                result.apply(dbh)
+
+        log_pfw_event(config, blockname, jobnum, 'j', ['posttask', retval])
+
+        # input wcl should already exist in untar form
+        if os.path.exists(inputtar):
+            print(f"found inputtar: {inputtar}")
+            os.unlink(inputtar)
         else:
-            print("Warning:  no job condor log file")
-
-        if dbh:
-            # update job task
-            if 'status' not in tjobinfo_task:
-                tjobinfo_task['status'] = pfwdefs.PF_EXIT_CONDOR
-            if 'end_time' not in tjobinfo_task:
-                tjobinfo_task['end_time'] = datetime.now()
-            wherevals = {'id': config['task_id']['job'][jobnum]}
-            #print(tjobinfo_task)
-            #print(wherevals)
-            dbh.basic_update_row('task', tjobinfo_task, wherevals)
-            dbh.commit()
-
-    log_pfw_event(config, blockname, jobnum, 'j', ['posttask', retval])
-
-    # input wcl should already exist in untar form
-    if os.path.exists(inputtar):
-        print(f"found inputtar: {inputtar}")
-        os.unlink(inputtar)
-    else:
-        print(f"Could not find inputtar: {inputtar}")
-
-    # untar output wcl tar and delete tar
-    if os.path.exists(outputtar):
-        print("Size of output wcl tar:", os.path.getsize(outputtar))
-        if os.path.getsize(outputtar) > 0:
-            print(f"found outputtar: {outputtar}")
-            pfwutils.untar_dir(outputtar, '..')
-            os.unlink(outputtar)
+            print(f"Could not find inputtar: {inputtar}")
+
+        # untar output wcl tar and delete tar
+        if os.path.exists(outputtar):
+            print("Size of output wcl tar:", os.path.getsize(outputtar))
+            if os.path.getsize(outputtar) > 0:
+                print(f"found outputtar: {outputtar}")
+                pfwutils.untar_dir(outputtar, '..')
+                os.unlink(outputtar)
+            else:
+                msg = f"Warn: outputwcl tarball ({outputtar}) is 0 bytes."
+                miscutils.fwdebug_print(msg)
+                if dbh:
+                    hook.message(config['task_id']['job'][jobnum],
+                                 msg, pfwdefs.PFWDB_MSG_WARN, 'x')
+
         else:
-            msg = f"Warn: outputwcl tarball ({outputtar}) is 0 bytes."
+            msg = f"Warn: outputwcl tarball ({outputtar}) does not exist."
             miscutils.fwdebug_print(msg)
             if dbh:
-                try:
-                    Messaging.pfw_message(dbh, config['pfw_attempt_id'],
-                                          config['task_id']['job'][jobnum],
-                                          msg, pfwdefs.PFWDB_MSG_WARN, 'x')
-                except:
-                    miscutils.fwdebug_print("Warning: could not write to database")
-
-    else:
-        msg = f"Warn: outputwcl tarball ({outputtar}) does not exist."
-        miscutils.fwdebug_print(msg)
-        if dbh:
-            try:
-                Messaging.pfw_message(dbh, config['pfw_attempt_id'],
-                                      config['task_id']['job'][jobnum],
-                                      msg, pfwdefs.PFWDB_MSG_WARN, 'x')
-            except:
-                miscutils.fwdebug_print("Warning: could not write to database")
-
-    if retval != pfwdefs.PF_EXIT_SUCCESS:
-        miscutils.fwdebug_print("Setting failure retval")
-        retval = pfwdefs.PF_EXIT_FAILURE
+                hook.message(config['task_id']['job'][jobnum],
+                             msg, pfwdefs.PFWDB_MSG_WARN, 'x')
+
+        if retval != pfwdefs.PF_EXIT_SUCCESS:
+            miscutils.fwdebug_print("Setting failure retval")
+            retval = pfwdefs.PF_EXIT_FAILURE
 
-    miscutils.fwdebug_print(f"Returning retval = {retval}")
-    miscutils.fwdebug_print("jobpost done")
-    debugfh.close()
-    sys.stdout = outorig
-    sys.stderr = errorig
+        miscutils.fwdebug_print(f"Returning retval = {retval}")
+        miscutils.fwdebug_print("jobpost done")
     miscutils.fwdebug_print(f"Exiting with = {retval}")
     return int(retval)
 
@@ -4,6 +4,7 @@
 """ Executes a series of wrappers within a single job """
 
 import re
+import resource
 import subprocess
 import argparse
 import sys
@@ -15,6 +16,8 @@ import traceback
 import socket
 import collections
 import contextlib
+import fnmatch
+import itertools
 import multiprocessing as mp
 import multiprocessing.pool as pl
 import signal
@@ -35,6 +38,8 @@ import processingfw.pfwdefs as pfwdefs
 import processingfw.pfwutils as pfwutils
 import processingfw.pfwdb as pfwdb
 import processingfw.pfwcompression as pfwcompress
+import processingfw.pfwprov as pfwprov
+import processingfw.pfwsched as pfwsched
 import qcframework.Messaging as Messaging
 
 __version__ = '$Rev: 48552 $'
@@ -48,11 +53,18 @@ keeprunning = True
 terminating = False
 main_lock = threading.Lock()
 result_lock = threading.Lock()
+submit_lock = threading.Lock()   # serializes scheduler submissions with stopping the job
 lock_monitor = threading.Condition(threading.Lock())
 donejobs = 0
 needDBthreads = False
 results = []   # the results of running each task in the group
 
+# provenance edges accumulated from finished wrappers before they are written mid-job
+DEF_PROV_FLUSH_EDGES = 50000
+prov_lock = threading.Lock()
+prov_dbh = None          # DB connection used for mid-job provenance writes
+prov_retained = 0        # edges kept by the last flush (files not yet in desfile)
+
 os.environ['PYTHONUNBUFFERED'] = '1'
 
 class Capture:
@@ -144,6 +156,65 @@ class WrapOutput:
 
 
 
+class FileStateCache:
+    """ Per-job cache of existence, size and mtime of files in the job directory
+
+        Staging records the files it wrote so later checks don't need to
+        stat them again (each stat is a round trip on network filesystems).
+        Only files known to exist are cached.   Counts of cache hits and
+        stat calls are kept for reporting.
+    """
+    def __init__(self):
+        self.state = {}
+        self.hits = 0
+        self.stats = 0
+
+    @staticmethod
+    def _key(fullname):
+        return os.path.abspath(fullname)
+
+    def record(self, fullname, size=None, mtime=None):
+        """ Record that a file exists (e.g., just written by staging)
+
+            size and mtime are None when not known (not made up).
+        """
+        self.state[self._key(fullname)] = {'size': size, 'mtime': mtime}
+
+    def forget(self, fullname):
+        """ Remove a file from the cache (e.g., after it was deleted) """
+        self.state.pop(self._key(fullname), None)
+
+    def lookup(self, fullname, force=False):
+        """ Return cached state for the file, stat'ing it if not cached or if forced """
+        key = self._key(fullname)
+        if not force and key in self.state:
+            self.hits += 1
+            return self.state[key]
+
+        self.stats += 1
+        try:
+            fstat = os.stat(key)
+        except FileNotFoundError:
+            self.state.pop(key, None)
+            return None
+        self.state[key] = {'size': fstat.st_size, 'mtime': fstat.st_mtime}
+        return self.state[key]
+
+    def check_files(self, fullnames, force=False):
+        """ Return lists of existing and missing files (like intgmisc.check_files) """
+        exists = []
+        missing = []
+        for fname in fullnames:
+            if self.lookup(fname, force) is not None:
+                exists.append(fname)
+            else:
+                missing.append(fname)
+        return exists, missing
+
+
+file_state = FileStateCache()
+
+
 ######################################################################
 def get_batch_id_from_job_ad(jobad_file):
     """ Parse condor job ad to get condor job id """
@@ -361,6 +432,77 @@ def pfw_save_file_info(pfw_dbh, filemgmt, ftype, fullnames,
 
     return listing
 
+######################################################################
+def pfw_save_files_info(pfw_dbh, filemgmt, reginfo, pfw_attempt_id,
+                        attempt_tid, parent_tid):
+    """ Register data for all output files of a wrapper with a single commit
+
+        reginfo is a list of dicts (ftype, fullnames, wgb_tid, do_update,
+        update_info, filepat), one per exec output section.   The sections
+        are registered in order, their tasks ended without committing even
+        on errors, and everything is committed once at the end.
+
+        Returns list of files that failed to register and list of exceptions
+    """
+    if miscutils.fwdebug_check(3, "PFWRUNJOB_DEBUG"):
+        miscutils.fwdebug_print(f"BEG ({len(reginfo)} sections, {parent_tid})")
+
+    badfiles = []
+    excepts = []
+    if not reginfo:
+        return badfiles, excepts
+
+    starttime = time.time()
+    register_time = 0.
+    numfiles = 0
+    for rinfo in reginfo:
+        numfiles += len(rinfo['fullnames'])
+
+        task_id = -1
+        if pfw_dbh is not None:
+            task_id = pfw_dbh.create_task(name='save_file_info',
+                                          info_table=None,
+                                          parent_task_id=parent_tid,
+                                          root_task_id=attempt_tid,
+                                          label=rinfo['ftype'],
+                                          do_begin=True,
+                                          do_commit=False)
+        regstart = time.time()
+        try:
+            result = filemgmt.register_file_data(rinfo['ftype'], rinfo['fullnames'], pfw_attempt_id,
+                                                 rinfo['wgb_tid'], rinfo['do_update'],
+                                                 rinfo['update_info'], rinfo['filepat'])
+            listing = [k for k, v in result.items() if v is None]
+            badfiles.extend(listing)
+            if pfw_dbh is not None:
+                if listing:
+                    pfw_dbh.end_task(task_id, pfwdefs.PF_EXIT_FAILURE, False)
+                else:
+                    pfw_dbh.end_task(task_id, pfwdefs.PF_EXIT_SUCCESS, False)
+        except Exception as exc:
+            miscutils.fwdebug_print('An error occurred')
+            (extype, exvalue, trback) = sys.exc_info()
+            traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
+            excepts.append(exc)
+            if pfw_dbh is not None:
+                pfw_dbh.end_task(task_id, pfwdefs.PF_EXIT_FAILURE, False)
+        register_time += time.time() - regstart
+
+    commitstart = time.time()
+    filemgmt.commit()
+    if pfw_dbh is not None:
+        pfw_dbh.commit()
+    commit_time = time.time() - commitstart
+
+    print(f"DESDMTIME: pfw_save_files_info {time.time() - starttime:0.3f} ({numfiles} files, "
+          f"register {register_time:0.3f}, commit {commit_time:0.3f})")
+
+    if miscutils.fwdebug_check(3, "PFWRUNJOB_DEBUG"):
+        miscutils.fwdebug_print("END\n\n")
+
+    return badfiles, excepts
+
+
 ######################################################################
 def transfer_single_archive_to_job(pfw_dbh, wcl, files2get, jobfiles, dest, parent_tid):
     """ Handle the transfer of files from a single archive to the job directory """
@@ -421,6 +563,12 @@ def transfer_single_archive_to_job(pfw_dbh, wcl, files2get, jobfiles, dest, pare
         else:
             result = jobfilemvmt.home2job(transinfo)
 
+        # save state of staged files so later input checks don't have to stat them
+        if result:
+            for fname, finfo in result.items():
+                if 'err' not in finfo and fname in transinfo:
+                    file_state.record(transinfo[fname]['dst'], transinfo[fname].get('filesize'))
+
         if sem is not None:
             if miscutils.fwdebug_check(3, "PFWRUNJOB_DEBUG"):
                 miscutils.fwdebug_print("Releasing lock")
@@ -561,8 +709,11 @@ def get_wrapper_inputs(pfw_dbh, wcl, infiles):
         print("\tInfo: 0 inputs needed for wrapper")
         return
 
+    recheck = miscutils.checkTrue('recheck_staged_inputs', wcl, False)
+    (prevhits, prevstats) = (file_state.hits, file_state.stats)
+
     for isect in infiles:
-        exists, missing = intgmisc.check_files(infiles[isect])
+        exists, missing = file_state.check_files(infiles[isect])
 
         for efile in exists:
             existinginputs[miscutils.parse_fullname(efile, miscutils.CU_PARSE_FILENAME)] = efile
@@ -586,9 +737,10 @@ def get_wrapper_inputs(pfw_dbh, wcl, infiles):
             raise Exception("Error:  Cannot find all input files in an archive")
 
         # double-check: check that files are now on filesystem
+        #    (files recorded by staging are not stat'ed again unless recheck requested)
         errcnt = 0
         for sect in infiles:
-            _, missing = intgmisc.check_files(infiles[sect])
+            _, missing = file_state.check_files(infiles[sect], recheck)
 
             if missing:
                 for mfile in missing:
@@ -600,6 +752,9 @@ def get_wrapper_inputs(pfw_dbh, wcl, infiles):
     else:
         print(f"\tInfo: all {len(existinginputs)} input file(s) already in job directory.")
 
+    if miscutils.fwdebug_check(1, "PFWRUNJOB_DEBUG"):
+        miscutils.fwdebug_print(f"input file checks: {file_state.stats - prevstats} stat calls, {file_state.hits - prevhits} cache hits")
+
 
 
 ######################################################################
@@ -656,12 +811,14 @@ def setup_working_dir(workdir, files, jobroot):
     os.chdir(workdir)
 
     # create symbolic links for input files
+    madedirs = set()
     for isect in files:
         for ifile in files[isect]:
             # make subdir inside fw thread working dir so match structure of job scratch
             subdir = os.path.dirname(ifile)
-            if subdir != "":
+            if subdir != "" and subdir not in madedirs:
                 miscutils.coremakedirs(subdir)
+                madedirs.add(subdir)
             try:
                 os.symlink(os.path.join(jobroot, ifile), ifile)
             except FileExistsError:
@@ -1123,8 +1280,9 @@ def post_wrapper(pfw_dbh, wcl, ins, jobfiles, logfile, exitcode, workdir):
                     print(f"DESDMTIME: app_exec {sect} {float(outputwcl[sect]['walltime']):0.3f}")
 
             if pfwdefs.OW_OUTPUTS_BY_SECT in outputwcl and outputwcl[pfwdefs.OW_OUTPUTS_BY_SECT]:
-                badfiles = []
                 wrap_output_files = []
+                reginfo = []
+                sectfinfo = []
                 for sectname, byexec in outputwcl[pfwdefs.OW_OUTPUTS_BY_SECT].items():
                     sectkeys = sectname.split('.')
                     sectdict = wcl.get(f"{pfwdefs.IW_FILESECT}.{sectkeys[-1]}")
@@ -1152,27 +1310,30 @@ def post_wrapper(pfw_dbh, wcl, ins, jobfiles, logfile, exitcode, workdir):
                                 filepat = wcl['filename_pattern'][sectdict['filepat']]
                             else:
                                 raise KeyError(f"Missing file pattern ({sectname}, {sectdict['filetype']}, {sectdict['filepat']})")
-                        try:
-                            badfiles.extend(pfw_save_file_info(pfw_dbh, filemgmt, sectdict['filetype'],
-                                                               fullnames, wcl['pfw_attempt_id'],
-                                                               wcl['task_id']['attempt'],
-                                                               wcl['task_id']['jobwrapper'],
-                                                               task_id, True, updatedef, filepat))
-                        except Exception as e:
-                            miscutils.fwdebug_print('An error occurred')
-                            (extype, exvalue, trback) = sys.exc_info()
-                            traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
-                            excepts.append(e)
+                        reginfo.append({'ftype': sectdict['filetype'],
+                                        'fullnames': fullnames,
+                                        'wgb_tid': task_id,
+                                        'do_update': True,
+                                        'update_info': updatedef,
+                                        'filepat': filepat})
                         for fname in fullnames:
-                            if fname in badfiles:
-                                continue
-                            finfo[fname] = {'sectname': sectname,
-                                            'filetype': sectdict['filetype'],
-                                            'filesave': filesave,
-                                            'filecompress': filecompress,
-                                            'fullname': fname}
+                            fdict = {'sectname': sectname,
+                                     'filetype': sectdict['filetype'],
+                                     'filesave': filesave,
+                                     'filecompress': filecompress,
+                                     'fullname': fname}
                             if 'archivepath' in sectdict:
-                                finfo[fname]['path'] = sectdict['archivepath']
+                                fdict['path'] = sectdict['archivepath']
+                            sectfinfo.append(fdict)
+
+                badfiles, regexcepts = pfw_save_files_info(pfw_dbh, filemgmt, reginfo,
+                                                           wcl['pfw_attempt_id'],
+                                                           wcl['task_id']['attempt'],
+                                                           wcl['task_id']['jobwrapper'])
+                excepts.extend(regexcepts)
+                for fdict in sectfinfo:
+                    if fdict['fullname'] not in badfiles:
+                        finfo[fdict['fullname']] = fdict
 
                 wrap_output_files = list(set(wrap_output_files))
                 if badfiles:
@@ -1196,7 +1357,11 @@ def post_wrapper(pfw_dbh, wcl, ins, jobfiles, logfile, exitcode, workdir):
                 try:
                     prov = outputwcl[pfwdefs.OW_PROVSECT]
                     execids = wcl['task_id']['exec']
-                    excepts.extend(filemgmt.ingest_provenance(prov, execids))
+                    if wcl['use_db'] and 'provenance' in jobfiles:
+                        # written in bulk at end of job
+                        prov = jobfiles['provenance'].add(prov, execids)
+                    if prov:
+                        excepts.extend(filemgmt.ingest_provenance(prov, execids))
                 except Exception as ex:
                     miscutils.fwdebug_print('An error occurred')
                     (extype, exvalue, trback) = sys.exc_info()
@@ -1364,12 +1529,13 @@ def job_thread(argv):
                 print(f"Running wrapper: {wrappercmd}")
                 sys.stdout.flush()
                 starttime = time.time()
+                runstats = {}
                 try:
                     os.putenv("DESDMFW_TASKID", str(exectid))
                     exitcode = pfwutils.run_cmd_qcf(wrappercmd, task['logfile'],
                                                     wcl['task_id']['wrapper'],
                                                     wcl['execnames'], wcl['use_qcf'], pfw_dbh, wcl['pfw_attempt_id'], wcl['qcf'],
-                                                    threaded=needDBthreads)
+                                                    threaded=needDBthreads, stats=runstats)
                 except:
                     (extype, exvalue, trback) = sys.exc_info()
                     print('!' * 60)
@@ -1387,6 +1553,8 @@ def job_thread(argv):
                         pfw_dbh = pfwdb.PFWDB(threaded=needDBthreads)
                 else:
                     print(f"DESDMTIME: run_wrapper {time.time() - starttime:0.3f}")
+                if runstats:
+                    print(f"DESDMTIME: run_wrapper_output_wait {runstats['waittime']:0.3f} ({runstats['bytes_read']} bytes)")
 
                 #print("HERE1   %d" % (int(task['wrapnum'])))
                 post_wrapper(pfw_dbh, wcl, ins, jobfiles, task['logfile'], exitcode, workdir)
@@ -1505,6 +1673,64 @@ def results_error(err):
     print(err)
     raise err
 ######################################################################
+def flush_provenance(pfw_dbh, prov, final=False):
+    """ Write accumulated provenance, reporting any files it refers to not in desfile
+
+        The edges are taken out of prov so finished wrappers can keep adding
+        to it while they are written.   Edges that couldn't be written (DB
+        error or files not yet in desfile) go back into prov for a later
+        flush to retry.
+
+        Returns True if every edge was written
+    """
+    global prov_retained
+
+    with prov_lock:
+        pending = prov.take()
+    numused = len(pending.used)
+    numwdf = len(pending.wdf)
+    if not numused and not numwdf:
+        return True
+    starttime = time.time()
+    try:
+        (insused, inswdf, missing) = pending.flush(pfw_dbh)
+    finally:
+        with prov_lock:
+            prov.merge(pending)
+        prov_retained = len(pending)
+    print(f"DESDMTIME: ingest_provenance {time.time() - starttime:0.3f} ({numused} used and {numwdf} wdf edges, {insused} used and {inswdf} wdf rows inserted)")
+    if missing:
+        if final:
+            print(f"Error: could not save provenance for {len(missing)} file(s) not in desfile: {', '.join(missing)}")
+        else:
+            print(f"Warning: {len(missing)} file(s) not in desfile yet, keeping their provenance to retry later")
+    return not pending
+
+######################################################################
+def flush_provenance_midjob(jbwcl):
+    """ Write provenance from finished wrappers once enough has accumulated
+
+        So an evicted or killed job only loses the provenance of the last
+        few wrappers.   Called between polls of the running wrappers, not
+        from results_checker, so a large flush doesn't hold up the pool's
+        result handling.
+    """
+    global prov_dbh
+
+    prov = jobfiles_global['provenance']
+    flush_edges = int(jbwcl.getfull('prov_flush_edges', default=DEF_PROV_FLUSH_EDGES))
+    if not jbwcl['use_db'] or len(prov) - prov_retained < flush_edges:
+        return
+    try:
+        if prov_dbh is None:
+            prov_dbh = pfwdb.PFWDB(threaded=needDBthreads)
+        flush_provenance(prov_dbh, prov)
+    except:
+        (extype, exvalue, trback) = sys.exc_info()
+        print("Error ingesting provenance, will retry")
+        traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
+
+######################################################################
 def results_checker(result):
     """ method to collec the results  """
     #print("CALL CHECKER")
@@ -1526,6 +1752,8 @@ def results_checker(result):
         #print("CHECKING  %d  %d ====================================="% (int(wrapnum), res))
         jobfiles_global['outfullnames'].extend(jobf['outfullnames'])
         jobfiles_global['output_putinfo'].update(jobf['output_putinfo'])
+        with prov_lock:
+            jobfiles_global['provenance'].merge(jobf.get('provenance'))
         if not terminating:
             del job_track[wrapnum]
         if usage > jobwcl['job_max_usage']:
@@ -1537,7 +1765,9 @@ def results_checker(result):
         if (res != 0 and stop_all) and not terminating:
             if result_lock.acquire(False):
                 pfw_dbh = None
-                keeprunning = False
+                # wait for any submission in progress, none start afterwards
+                with submit_lock:
+                    keeprunning = False
                 try:
                     # manually end the child processes as pool.terminate can deadlock
                     # if multiple threads return with errors
@@ -1603,6 +1833,63 @@ def results_checker(result):
 
         #print('DONE  %d    %d' % (int(wrapnum), donejobs))
 
+######################################################################
+def read_wrapper_list(workflow):
+    """ Read the job's wrapper list (wrapnum -> task info) without parsing any wcl """
+    wraptasks = collections.OrderedDict()
+    with open(workflow, 'r') as workflowfh:
+        for linecnt, line in enumerate(workflowfh):
+            task = parse_wrapper_line(line, linecnt)
+            wraptasks[task['wrapnum']] = task
+    return wraptasks
+
+######################################################################
+def new_wrapper_jobfiles():
+    """ Empty per-wrapper container for the files and provenance a wrapper produces """
+    return {'infullnames': [],
+            'outfullnames': [],
+            'output_putinfo': {},
+            'provenance': pfwprov.ProvAccumulator()}
+
+######################################################################
+def load_wrapper_input(task, jbwcl, pfw_dbh):
+    """ Parse a wrapper's wcl just before it is needed
+
+        Returns the job_thread arguments (minus output queues), the wrapper's
+        input fullnames and its scheduling hints.   The parsed wcl isn't kept.
+    """
+    wcl = WCL()
+    with open(task['wclfile'], 'r') as wclfh:
+        wcl.read(wclfh, filename=task['wclfile'])
+    wcl.update(jbwcl)
+
+    # get fullnames for inputs and outputs
+    ins, outs = intgmisc.get_fullnames(wcl, wcl, None)
+    hints = pfwsched.get_wrapper_hints(wcl)
+    del wcl
+
+    infullnames = [ifile for isect in ins for ifile in ins[isect]]
+    return (task, new_wrapper_jobfiles(), jbwcl, ins, outs, pfw_dbh), infullnames, hints
+
+######################################################################
+def submit_ready(sched, inputs, outq, errq):
+    """ Hand wrappers the scheduler says can start now to the pool
+
+        results_checker clears keeprunning under submit_lock before it stops
+        the job after a failed wrapper (terminating the pool), so nothing is
+        submitted once the job is stopping.   result_lock is left to
+        results_checker.
+    """
+    with submit_lock:
+        while keeprunning and not terminating:
+            wrapnum = sched.next_wrapper(job_track)
+            if wrapnum is None:
+                break
+            if miscutils.fwdebug_check(3, 'PFWRUNJOB_DEBUG'):
+                miscutils.fwdebug_print(f"starting wrapper {wrapnum} ({len(sched.pending)} pending)")
+            pool.apply_async(job_thread, args=(inputs[wrapnum] + (outq, errq, True, ), ),
+                             callback=results_checker, error_callback=results_error)
+
 ######################################################################
 def job_workflow(workflow, jobfiles, jbwcl=WCL(), pfw_dbh=None):
     """ Run each wrapper execution sequentially """
@@ -1616,160 +1903,175 @@ def job_workflow(workflow, jobfiles, jbwcl=WCL(), pfw_dbh=None):
     global result_lock
     global lock_monitor
 
-    infullnames = {}
-    with open(workflow, 'r') as workflowfh:
-        # for each wrapper execution
-        lines = workflowfh.readlines()
-        sys.stdout.flush()
-        inputs = {}
-        # read in all of the lines in dictionaries
-        for linecnt, line in enumerate(lines):
-            wrapnum = miscutils.fwsplit(line.strip())[0]
-            task = parse_wrapper_line(line, linecnt)
-            #task['logfile'] = None
-            wcl = WCL()
-            with open(task['wclfile'], 'r') as wclfh:
-                wcl.read(wclfh, filename=task['wclfile'])
-                wcl.update(jbwcl)
-
-            # get fullnames for inputs and outputs
-            ins, outs = intgmisc.get_fullnames(wcl, wcl, None)
-            del wcl
-            # save input filenames to eliminate from junk tarball later
-            infullnames[wrapnum] = []
-            for isect in ins:
-                for ifile in ins[isect]:
-                    infullnames[wrapnum].append(ifile)
-                    jobfiles['infullnames'].extend(ifile)
-            inputs[wrapnum] = (task, copy.deepcopy(jobfiles), jbwcl, ins, outs, pfw_dbh)
-            job_track[task['wrapnum']] = (task['logfile'], jobfiles)
-        # get all of the task groupings, they will be run in numerical order
-        tasks = list(jbwcl["fw_groups"].keys())
-        tasks.sort()
-        # loop over each grouping
-        manager = mp.Manager()
-        for task in tasks:
-            results = []   # the results of running each task in the group
-            # get the maximum number of parallel processes to run at a time
-            nproc = int(jbwcl["fw_groups"][task]["fw_nthread"])
-            reuse_count = int(jbwcl["fw_groups"][task]['fw_thread_reuse'])
-            if miscutils.fwdebug_check(6, 'PFWRUNJOB_RESULTS'):
-                miscutils.fwdebug_print("REUSE COUNT %d"% (reuse_count))
-
-            procs = miscutils.fwsplit(jbwcl["fw_groups"][task]["wrapnums"])
-            tempproc = []
-            # pare down the list to include only those in this run
-            for p in procs:
-                if p in inputs:
-                    tempproc.append(p)
-            procs = tempproc
-            if nproc > 1:
-                #print("MULTITHREADED -------------------------------------------------------------")
-                numjobs = len(procs)
-                # set up the thread pool
-                pool = mp.Pool(processes=nproc, maxtasksperchild=reuse_count)
-                outq = manager.Queue()
-                errq = manager.Queue()
-                with lock_monitor:
-                    try:
-                        donejobs = 0
-                        # update the input files now, so that it only contains those from the current taks(s)
-                        for inp in procs:
-                            jobfiles_global['infullnames'].extend(infullnames[inp])
-                        # attach all the grouped tasks to the pool
+    wfstart = time.time()
+    first_start = None
+
+    # only the wrapper list is read up front, wrapper wcls are parsed
+    # group by group right before the group runs
+    wraptasks = read_wrapper_list(workflow)
+    for wrapnum, wtask in wraptasks.items():
+        job_track[wrapnum] = (wtask['logfile'], jobfiles)
+    sys.stdout.flush()
+
+    use_sched = miscutils.convertBool(jbwcl.getfull('use_wrapper_scheduler', default='false'))
+    mem_reserve_mb = float(jbwcl.getfull('sched_mem_reserve_mb', default=500))
+    max_load = jbwcl.getfull('sched_max_load', default=None)
+    if max_load is not None:
+        max_load = float(max_load)
+
+    # get all of the task groupings, they will be run in numerical order
+    tasks = list(jbwcl["fw_groups"].keys())
+    tasks.sort()
+    # loop over each grouping
+    manager = mp.Manager()
+    for task in tasks:
+        results = []   # the results of running each task in the group
+        # get the maximum number of parallel processes to run at a time
+        nproc = int(jbwcl["fw_groups"][task]["fw_nthread"])
+        reuse_count = int(jbwcl["fw_groups"][task]['fw_thread_reuse'])
+        if miscutils.fwdebug_check(6, 'PFWRUNJOB_RESULTS'):
+            miscutils.fwdebug_print("REUSE COUNT %d"% (reuse_count))
+
+        procs = miscutils.fwsplit(jbwcl["fw_groups"][task]["wrapnums"])
+        tempproc = []
+        # pare down the list to include only those in this run
+        for p in procs:
+            if p in wraptasks:
+                tempproc.append(p)
+        procs = tempproc
+        if nproc > 1:
+            #print("MULTITHREADED -------------------------------------------------------------")
+            numjobs = len(procs)
+            # set up the thread pool
+            pool = mp.Pool(processes=nproc, maxtasksperchild=reuse_count)
+            outq = manager.Queue()
+            errq = manager.Queue()
+            with lock_monitor:
+                try:
+                    donejobs = 0
+                    # parse this group's wcls and update the input files now,
+                    # so that it only contains those from the current taks(s)
+                    inputs = {}
+                    hints = {}
+                    for inp in procs:
+                        inputs[inp], infullnames, hints[inp] = load_wrapper_input(wraptasks[inp], jbwcl, pfw_dbh)
+                        jobfiles_global['infullnames'].extend(infullnames)
+                    if first_start is None:
+                        first_start = time.time()
+                        print(f"DESDMTIME: job_workflow_first_wrapper {first_start - wfstart:0.3f}")
+                    # start grouped tasks as the scheduler finds room for them
+                    sched = None
+                    if use_sched:
+                        sched = pfwsched.WrapperScheduler(procs, hints, nproc, mem_reserve_mb, max_load)
+                        submit_ready(sched, inputs, outq, errq)
+                        if not sched.pending:
+                            pool.close()
+                    else:
                         [pool.apply_async(job_thread, args=(inputs[inp] + (outq, errq, True, ), ), callback=results_checker, error_callback=results_error) for inp in procs]
                         pool.close()
-                        time.sleep(10)
-                        while donejobs < numjobs and keeprunning:
-                            #print("status %d / %d  %s  +++++++++++++++++++++++++++++++" % (donejobs, numjobs, keeprunning))
+                    time.sleep(10)
+                    while donejobs < numjobs and keeprunning:
+                        if sched is not None and sched.pending:
+                            submit_ready(sched, inputs, outq, errq)
+                            if not sched.pending:
+                                pool.close()
+                        flush_provenance_midjob(jbwcl)
+                        #print("status %d / %d  %s  +++++++++++++++++++++++++++++++" % (donejobs, numjobs, keeprunning))
+                        count = 0
+                        while count < 2:
                             count = 0
-                            while count < 2:
-                                count = 0
-                                try:
-                                    msg = outq.get_nowait()
-                                    print(msg)
-                                except:
-                                    count += 1
-                                try:
-                                    errm = errq.get_nowait()
-                                    sys.stderr.write(errm)
-                                except:
-                                    count += 1
-                            time.sleep(.1)
-                    except:
-                        results.append(1)
-                        exc_type, exc_value, exc_traceback = sys.exc_info()
-                        traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                                  limit=4, file=sys.stdout)
+                            try:
+                                msg = outq.get_nowait()
+                                print(msg)
+                            except:
+                                count += 1
+                            try:
+                                errm = errq.get_nowait()
+                                sys.stderr.write(errm)
+                            except:
+                                count += 1
+                        time.sleep(.1)
+                    if sched is not None and miscutils.fwdebug_check(1, 'PFWRUNJOB_DEBUG'):
+                        miscutils.fwdebug_print(f"wrapper scheduler: group {task} had to wait {sched.waits} times for resources")
+                except:
+                    results.append(1)
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                              limit=4, file=sys.stdout)
 
-                        raise
-
-                    finally:
-                        if stop_all and max(results) > 0:
-                            # wait to give everything time to do the first round of cleanup
-                            time.sleep(20)
-                            # get any waiting messages
-                            for _ in range(1000):
-                                try:
-                                    msg = outq.get_nowait()
-                                    print(msg)
-                                except:
-                                    break
-                            for _ in range(1000):
-                                try:
-                                    errm = errq.get_nowait()
-                                    sys.stderr.write(errm)
-                                except:
-                                    break
-                            if not result_lock.acquire(False):
-                                lock_monitor.wait(60)
-                            else:
-                                result_lock.release()
-                            # empty the worker queue so nothing else starts
-                            terminate(force=True)
-                            # wait so everything can clean up, otherwise risk a deadlock
-                            time.sleep(50)
-                        del pool
-                        while True:
+                    raise
+
+                finally:
+                    if stop_all and max(results) > 0:
+                        # wait to give everything time to do the first round of cleanup
+                        time.sleep(20)
+                        # get any waiting messages
+                        for _ in range(1000):
                             try:
-                                msg = outq.get(timeout=.1)
+                                msg = outq.get_nowait()
                                 print(msg)
                             except:
                                 break
-
-                        while True:
+                        for _ in range(1000):
                             try:
-                                errm = errq.get(timeout=.1)
+                                errm = errq.get_nowait()
                                 sys.stderr.write(errm)
                             except:
                                 break
-                        # in case the sci code crashed badly
-                        if not results:
-                            results.append(1)
-                        jobfiles = jobfiles_global
-                        jobfiles['infullnames'] = list(set(jobfiles['infullnames']))
-                        if stop_all and max(results) > 0:
-                            return max(results), jobfiles
-            # if running in single threaded mode
-            else:
-                temp_stopall = stop_all
-                stop_all = False
+                        if not result_lock.acquire(False):
+                            lock_monitor.wait(60)
+                        else:
+                            result_lock.release()
+                        # empty the worker queue so nothing else starts
+                        terminate(force=True)
+                        # wait so everything can clean up, otherwise risk a deadlock
+                        time.sleep(50)
+                    del pool
+                    while True:
+                        try:
+                            msg = outq.get(timeout=.1)
+                            print(msg)
+                        except:
+                            break
 
-                donejobs = 0
-                for inp in procs:
-                    try:
-                        jobfiles_global['infullnames'].extend(infullnames[inp])
-                        results_checker(job_thread(inputs[inp] + (sys.stdout, sys.stderr, False,)))
-                    except:
-                        (extype, exvalue, trback) = sys.exc_info()
-                        traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
-                        results = [1]
+                    while True:
+                        try:
+                            errm = errq.get(timeout=.1)
+                            sys.stderr.write(errm)
+                        except:
+                            break
+                    # in case the sci code crashed badly
+                    if not results:
+                        results.append(1)
                     jobfiles = jobfiles_global
-                    if results[-1] != 0:
-                        return results[-1], jobfiles
-                stop_all = temp_stopall
+                    jobfiles['infullnames'] = list(set(jobfiles['infullnames']))
+                    if stop_all and max(results) > 0:
+                        return max(results), jobfiles
+        # if running in single threaded mode
+        else:
+            temp_stopall = stop_all
+            stop_all = False
 
+            donejobs = 0
+            for inp in procs:
+                try:
+                    wrapinput, infullnames, _ = load_wrapper_input(wraptasks[inp], jbwcl, pfw_dbh)
+                    jobfiles_global['infullnames'].extend(infullnames)
+                    if first_start is None:
+                        first_start = time.time()
+                        print(f"DESDMTIME: job_workflow_first_wrapper {first_start - wfstart:0.3f}")
+                    results_checker(job_thread(wrapinput + (sys.stdout, sys.stderr, False,)))
+                    flush_provenance_midjob(jbwcl)
+                except:
+                    (extype, exvalue, trback) = sys.exc_info()
+                    traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
+                    results = [1]
+                jobfiles = jobfiles_global
+                if results[-1] != 0:
+                    return results[-1], jobfiles
+            stop_all = temp_stopall
 
+    print(f"DESDMTIME: job_workflow_peak_rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss} KB")
     return 0, jobfiles
 
 def run_job(args):
@@ -1783,10 +2085,12 @@ def run_job(args):
     jobwcl = WCL()
     jobfiles = {'infullnames': [args.config, args.workflow],
                 'outfullnames': [],
-                'output_putinfo': {}}
+                'output_putinfo': {},
+                'provenance': pfwprov.ProvAccumulator()}
     jobfiles_global = {'infullnames': [args.config, args.workflow],
                        'outfullnames': [],
-                       'output_putinfo': {}}
+                       'output_putinfo': {},
+                       'provenance': pfwprov.ProvAccumulator()}
 
     jobstart = time.time()
     with open(args.config, 'r') as wclfh:
@@ -1875,23 +2179,42 @@ def run_job(args):
         print("Aborting rest of wrapper executions.  Continuing to end-of-job tasks\n\n")
 
     try:
-        #if jobwcl['use_db'] and pfw_dbh is None:
-        #    pfw_dbh = pfwdb.PFWDB()
+        try:
+            #if jobwcl['use_db'] and pfw_dbh is None:
+            #    pfw_dbh = pfwdb.PFWDB()
 
-        # create junk tarball with any unknown files
-        create_junk_tarball(pfw_dbh, jobwcl, jobfiles, exitcode)
-    except:
-        print("Error creating junk tarball")
-    # if should transfer at end of job
-    if jobfiles['output_putinfo']:
-        print(f"\n\nCalling file transfer for end of job ({len(jobfiles['output_putinfo'])} files)")
+            # create junk tarball with any unknown files
+            create_junk_tarball(pfw_dbh, jobwcl, jobfiles, exitcode)
+        except:
+            print("Error creating junk tarball")
+        # if should transfer at end of job
+        if jobfiles['output_putinfo']:
+            print(f"\n\nCalling file transfer for end of job ({len(jobfiles['output_putinfo'])} files)")
+
+            copy_output_to_archive(pfw_dbh, jobwcl, jobfiles, jobfiles['output_putinfo'], 'job',
+                                   job_task_id, 'job_output', exitcode)
+        else:
+            print("\n\n0 files to transfer for end of job")
+            if miscutils.fwdebug_check(1, "PFWRUNJOB_DEBUG"):
+                miscutils.fwdebug_print(f"len(jobfiles['outfullnames'])={len(jobfiles['outfullnames'])}")
+    finally:
+        # write provenance not yet written from wrappers and compression
+        # even if the end of job tasks failed
+        if pfw_dbh is not None:
+            prov = jobfiles['provenance']
+            if jobfiles is not jobfiles_global:
+                prov.merge(jobfiles_global['provenance'])
+            try:
+                if not flush_provenance(pfw_dbh, prov, final=True):
+                    exitcode = pfwdefs.PF_EXIT_FAILURE
+            except:
+                (extype, exvalue, trback) = sys.exc_info()
+                print("Error ingesting provenance")
+                traceback.print_exception(extype, exvalue, trback, file=sys.stdout)
+                exitcode = pfwdefs.PF_EXIT_FAILURE
+            if prov_dbh is not None:
+                prov_dbh.close()
 
-        copy_output_to_archive(pfw_dbh, jobwcl, jobfiles, jobfiles['output_putinfo'], 'job',
-                               job_task_id, 'job_output', exitcode)
-    else:
-        print("\n\n0 files to transfer for end of job")
-        if miscutils.fwdebug_check(1, "PFWRUNJOB_DEBUG"):
-            miscutils.fwdebug_print(f"len(jobfiles['outfullnames'])={len(jobfiles['outfullnames'])}")
     if pfw_dbh is not None:
         disku = pfwutils.diskusage(jobwcl['jobroot'])
         curr_usage = disku - jobwcl['pre_job_disk_usage']
@@ -1970,6 +2293,9 @@ def call_compress_files(pfw_dbh, jbwcl, jobfiles, putinfo):
                 miscutils.fwdebug_print(f"{fname} = {fdict}")
 
             if fdict['err'] is None:
+                # uncompressed file may have been removed by compression cleanup
+                file_state.forget(fname)
+
                 # add new filename to jobfiles['outfullnames'] so not junk
                 jobfiles['outfullnames'].append(fdict['outname'])
 
@@ -2009,7 +2335,11 @@ def call_compress_files(pfw_dbh, jbwcl, jobfiles, putinfo):
         prov = {provdefs.PROV_USED: {'exec_1': provdefs.PROV_DELIM.join(used_fnames)},
                 #provdefs.PROV_WGB: {'exec_1': provdefs.PROV_DELIM.join(wgb_fnames)},
                 provdefs.PROV_WDF: create_compression_wdf(wgb_fnames)}
-        filemgmt.ingest_provenance(prov, {'exec_1': task_id})
+        if jbwcl['use_db'] and 'provenance' in jobfiles:
+            # written in bulk at end of job
+            prov = jobfiles['provenance'].add(prov, {'exec_1': task_id})
+        if prov:
+            filemgmt.ingest_provenance(prov, {'exec_1': task_id})
         #force_update_desfile_filetype(filemgmt, filelist)
         filemgmt.commit()
 
@@ -2034,6 +2364,37 @@ def force_update_desfile_filetype(dbh, filelist):
         curs.execute(None, params)
     dbh.commit()
 
+################################################################################
+def iter_junk_files(topdir, notjunk, excludes=None):
+    """ Yield relative names of junk files as the directory walk finds them
+
+        Files whose basename is in notjunk or matches one of the glob
+        patterns in excludes are skipped, as are symlinks.
+    """
+    dirs = [topdir]
+    while dirs:
+        dirpath = dirs.pop(0)
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name in notjunk or entry.is_symlink():
+                        continue
+                    elif excludes and any(fnmatch.fnmatch(entry.name, pat) for pat in excludes):
+                        continue
+                    else:
+                        fname = entry.path
+                        if fname.startswith('./'):
+                            fname = fname[2:]
+                        if miscutils.fwdebug_check(6, "PFWRUNJOB_DEBUG"):
+                            miscutils.fwdebug_print(f"Adding file to junk tar = {fname}")
+                        yield fname
+        except OSError as exc:
+            print(f"Warning: could not list {dirpath} for junk tar: {exc}")
+        dirs[0:0] = subdirs
+
 ################################################################################
 def create_junk_tarball(pfw_dbh, wcl, jobfiles, exitcode):
     """ Create the junk tarball """
@@ -2055,47 +2416,32 @@ def create_junk_tarball(pfw_dbh, wcl, jobfiles, exitcode):
 
     job_task_id = wcl['task_id']['job']
 
-    junklist = []
-
     # remove paths
     notjunk = {}
     for fname in jobfiles['infullnames']:
         notjunk[os.path.basename(fname)] = True
     for fname in jobfiles['outfullnames']:
         notjunk[os.path.basename(fname)] = True
+    # the tarball is written inside the directory being walked
+    notjunk[os.path.basename(wcl['junktar'])] = True
 
     if miscutils.fwdebug_check(11, "PFWRUNJOB_DEBUG"):
         miscutils.fwdebug_print(f"notjunk = {list(notjunk.keys())}")
-    # walk job directory to get all files
-    miscutils.fwdebug_print("Looking for files at add to junk tar")
-    cwd = '.'
-    for (dirpath, _, filenames) in os.walk(cwd):
-        for walkname in filenames:
-            if miscutils.fwdebug_check(13, "PFWRUNJOB_DEBUG"):
-                miscutils.fwdebug_print(f"walkname = {walkname}")
-            if walkname not in notjunk:
-                if miscutils.fwdebug_check(6, "PFWRUNJOB_DEBUG"):
-                    miscutils.fwdebug_print(f"Appending walkname to list = {walkname}")
-
-                if dirpath.startswith('./'):
-                    dirpath = dirpath[2:]
-                elif dirpath == '.':
-                    dirpath = ''
-                if dirpath:
-                    fname = f"{dirpath}/{walkname}"
-                else:
-                    fname = walkname
 
-                if not os.path.islink(fname):
-                    junklist.append(fname)
+    excludes = []
+    if 'junktar_exclude' in wcl:
+        excludes = miscutils.fwsplit(wcl['junktar_exclude'], ',')
+    maxbytes = None
+    if 'junktar_max_size' in wcl:
+        maxbytes = int(wcl['junktar_max_size'])
 
-    if miscutils.fwdebug_check(1, "PFWRUNJOB_DEBUG"):
-        miscutils.fwdebug_print(f"# in junklist = {len(junklist)}")
-    if miscutils.fwdebug_check(11, "PFWRUNJOB_DEBUG"):
-        miscutils.fwdebug_print(f"junklist = {junklist}")
+    # walk job directory adding files to the tarball as they are found
+    miscutils.fwdebug_print("Looking for files at add to junk tar")
+    junkiter = iter_junk_files('.', notjunk, excludes)
+    firstjunk = next(junkiter, None)
 
     putinfo = {}
-    if junklist:
+    if firstjunk is not None:
         task_id = -1
         if pfw_dbh is not None:
             task_id = pfw_dbh.create_task(name='create_junktar',
@@ -2106,7 +2452,13 @@ def create_junk_tarball(pfw_dbh, wcl, jobfiles, exitcode):
                                           do_begin=True,
                                           do_commit=True)
 
-        pfwutils.tar_list(wcl['junktar'], junklist)
+        starttime = time.time()
+        (numjunk, junkbytes, truncated) = pfwutils.tar_stream(wcl['junktar'],
+                                                              itertools.chain([firstjunk], junkiter),
+                                                              maxbytes)
+        if truncated:
+            print(f"Warning: junk tarball reached junktar_max_size ({maxbytes} bytes).  Remaining junk files not saved.")
+        print(f"DESDMTIME: create_junktar {time.time() - starttime:0.3f} ({numjunk} files, {junkbytes} bytes)")
 
         if pfw_dbh is not None:
             pfw_dbh.update_job_junktar(wcl, wcl['junktar'])
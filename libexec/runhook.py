@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+""" Run a DAG hook script once a slot in its hook pool is free """
+
+import argparse
+import os
+import subprocess
+import sys
+
+import processingfw.pfwhookpool as pfwhookpool
+
+######################################################################
+def parse_args(argv):
+    """ Parse command line arguments """
+    parser = argparse.ArgumentParser(description='Run a hook script limited by a hook pool')
+    parser.add_argument('--pool', action='store', required=True,
+                        help='Name of pool (e.g., db, fs)')
+    parser.add_argument('--limit', action='store', type=int, default=pfwhookpool.DEF_LIMIT)
+    parser.add_argument('--pooldir', action='store', default=pfwhookpool.DEF_POOLDIR)
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Lower limit when hooks report slow DB responses')
+    parser.add_argument('--target_latency', action='store', type=float,
+                        default=pfwhookpool.DEF_TARGET_LATENCY)
+    parser.add_argument('--min_limit', action='store', type=int,
+                        default=pfwhookpool.DEF_MIN_LIMIT)
+    parser.add_argument('cmd', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if args.cmd and args.cmd[0] == '--':
+        args.cmd = args.cmd[1:]
+    if not args.cmd:
+        parser.error('missing hook command')
+    return args
+
+
+######################################################################
+def main(argv):
+    """ Program entry point """
+    args = parse_args(argv)
+    pool = pfwhookpool.HookPool(args.pooldir, args.pool, args.limit, args.adaptive,
+                                args.target_latency, args.min_limit)
+    with pool:
+        print(f"DESDMTIME: hook_queue_wait {args.pool} {pool.waittime:0.3f}")
+        sys.stdout.flush()
+        env = dict(os.environ)
+        env[pfwhookpool.POOLDIR_ENV] = pool.pooldir
+        retval = subprocess.call(args.cmd, env=env)
+    return retval
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -16,6 +16,7 @@ import re
 import time
 import json
 import collections
+import hashlib
 
 import despymisc.miscutils as miscutils
 import despydmdb.dbsemaphore as dbsem
@@ -33,6 +34,7 @@ import intgutils.queryutils as queryutils
 import processingfw.pfwdefs as pfwdefs
 import processingfw.pfwutils as pfwutils
 import processingfw.pfwcondor as pfwcondor
+import processingfw.pfwhookpool as pfwhookpool
 
 #######################################################################
 def get_datasect_types(config, modname):
@@ -1163,7 +1165,7 @@ def write_jobwcl(config, jobkey, jobdict):
     jobdict['outputwcltar'] = config.get_filename('outputwcltar', {pfwdefs.PF_CURRVALS:{'jobnum': jobdict['jobnum']},
                                                                    'required': True, intgdefs.REPLACE_VARS: True})
 
-    jobdict['envfile'] = config.get_filename('envfile')
+    jobdict['envfile'] = config.get_filename('envfile', {pfwdefs.PF_CURRVALS:{'jobnum': jobdict['jobnum']}})
 
     modulelist = miscutils.fwsplit(config.getfull(pfwdefs.SW_MODULELIST).lower())
     fwgroups = collections.OrderedDict()
@@ -2455,8 +2457,8 @@ def write_runjob_script(config):
 
     scriptstr = """#!/usr/bin/env sh
 echo "PFW: job_shell_script cmd: $0 $@";
-if [ $# -ne 6 ]; then
-    echo "Usage: $0 <jobnum> <input tar> <job wcl> <tasklist> <env file> <output tar>";
+if [ $# -ne 6 -a $# -ne 7 ]; then
+    echo "Usage: $0 <jobnum> <input tar> <job wcl> <tasklist> <env file> <output tar> [<shared input tar>]";
     echo "PFW: job_shell_script exit_status: 1"
     exit 1;
 fi
@@ -2477,6 +2479,7 @@ jobwcl=$3
 tasklist=$4
 envfile=$5
 outputtar=$6
+sharedtars=$7
 initdir=`pwd`
 
 """
@@ -2485,9 +2488,22 @@ initdir=`pwd`
     if 'max_eups_tries' in config:
         max_eups_tries = config.getfull('max_eups_tries')
 
+    # initial delay between eups setup tries, doubles after each failure
+    eups_retry_delay = int(config.getfull('eups_retry_delay', default=30))
+
+    # node-local cache of environment produced by a successful eups setup
+    # keyed by the setup script and product/version being set up
+    setupeups = config.getfull('setupeups')
+    pipeprod = config.getfull('pipeprod')
+    pipever = config.getfull('pipever')
+    # not $TMPDIR which is the per-job scratch dir under HTCondor
+    eups_cache_dir = config.getfull('eups_cache_dir', default='/tmp/pfw_eups_cache_`id -u`')
+    eups_cache_maxage = int(config.getfull('eups_cache_maxage', default=1440))   # minutes
+    use_eups_cache = miscutils.convertBool(config.getfull('use_eups_cache', default='true'))
+    eups_key = hashlib.md5(f"{setupeups} {pipeprod} {pipever}".encode('utf-8')).hexdigest()
 
     # setup job environment
-    scriptstr += f"""
+    scriptstr += """
 export SHELL=/bin/bash    # needed for setup to work in Condor environment
 export PFW_JOB_START_EPOCH=`date "+%s"`
 echo "PFW: job_shell_script starttime: $PFW_JOB_START_EPOCH"
@@ -2504,13 +2520,13 @@ fi
 ### specific to batch scheduler
 if test -n "$PBS_JOBID"; then
    BATCHID=`echo $PBS_JOBID | cut -d'.' -f1`
-   NP=`awk 'END {{print NR}}' $PBS_NODEFILE`
+   NP=`awk 'END {print NR}' $PBS_NODEFILE`
 fi
 if test -n "$LSB_JOBID"; then
    BATCHID=$LSB_JOBID
 fi
 if test -n "$LOADL_STEP_ID"; then
-   BATCHID=`echo $LOADL_STEP_ID | awk -F "." '{{print $(NF-1) "." $(NF) }}'`
+   BATCHID=`echo $LOADL_STEP_ID | awk -F "." '{print $(NF-1) "." $(NF) }'`
 fi
 if test -n "$BATCHID"; then
     echo "PFW: batchid $BATCHID"
@@ -2529,32 +2545,99 @@ tar -cvf $outputtar --files-from /dev/null
 
 d1=`date "+%s"`
 echo "PFW: eups_setup starttime: $d1"
+mystat=1
+eupscache=""
+"""
+    if use_eups_cache:
+        # cache needs bash (associative arrays, printf %q) to save any value
+        # including multi-line ones and variables that setup unset
+        scriptstr += f"""
+if [ -n "$BASH_VERSION" ]; then
+    eupscachedir={eups_cache_dir}
+    eupscache=$eupscachedir/env_{eups_key}.sh
+
+    # snapshot exported environment before anything is sourced
+    declare -A pfw_env_before
+    for pfwvar in `compgen -e`; do
+        pfw_env_before[$pfwvar]="${{!pfwvar}}"
+    done
+
+    # print commands that redo the changes setup made to the exported environment
+    pfw_write_env_cache() {{
+        local pfwvar
+        local -A pfw_env_after
+        for pfwvar in `compgen -e`; do
+            pfw_env_after[$pfwvar]=1
+            case $pfwvar in
+                _|PWD|OLDPWD|SHLVL) continue;;
+            esac
+            if [ -z "${{pfw_env_before[$pfwvar]+x}}" ] || [ "${{pfw_env_before[$pfwvar]}}" != "${{!pfwvar}}" ]; then
+                printf 'export %s=%q\\n' "$pfwvar" "${{!pfwvar}}"
+            fi
+        done
+        for pfwvar in "${{!pfw_env_before[@]}}"; do
+            if [ -z "${{pfw_env_after[$pfwvar]+x}}" ]; then
+                printf 'unset %s\\n' "$pfwvar"
+            fi
+        done
+    }}
+
+    if [ -r $eupscache ] && [ -n "`find $eupscache -mmin -{eups_cache_maxage}`" ]; then
+        # try the cache in a subshell so a stale one never touches this environment
+        if ( . $eupscache && [ -x "$PROCESSINGFW_DIR/libexec/pfwrunjob.py" ] ); then
+            echo "Sourcing cached eups environment ($eupscache)"
+            . $eupscache
+            mystat=0
+            echo "PFW: eups_setup cache: hit"
+        else
+            echo "Warning: cached eups environment is not usable, doing full setup"
+        fi
+    fi
+    if [ $mystat -ne 0 ]; then
+        echo "PFW: eups_setup cache: miss"
+    fi
+fi
+"""
+    scriptstr += f"""
 cnt=0
 maxtries={max_eups_tries}
-mydelay=300
-mystat=1
+mydelay={eups_retry_delay}
 while [ $mystat -ne 0 -a $cnt -lt $maxtries ]; do
     let cnt=cnt+1
-    if [ ! -r {config.getfull('setupeups')} ]; then
-        echo "Error: eups setup script is not readable ({config.getfull('setupeups')})"
-        edir=`dirname {config.getfull('setupeups')}`
+    if [ ! -r {setupeups} ]; then
+        echo "Error: eups setup script is not readable ({setupeups})"
+        edir=`dirname {setupeups}`
         echo $edir
         ls -l $edir || sleep 60
         mystat=1
     else
-        echo "Sourcing script to set up EUPS ({config.getfull('setupeups')})"
-        source {config.getfull('setupeups')}
+        echo "Sourcing script to set up EUPS ({setupeups})"
+        source {setupeups}
 
-        echo "Using eups to setup up {config.getfull('pipeprod')} {config.getfull('pipever')}"
-        setup --nolock {config.getfull('pipeprod')} {config.getfull('pipever')}
+        echo "Using eups to setup up {pipeprod} {pipever}"
+        setup --nolock {pipeprod} {pipever}
         mystat=$?
         if [ $mystat -ne 0 ]; then
             echo "Warning: eups setup had non-zero exit code ($mystat)"
+        elif [ -n "$eupscache" ]; then
+            # save only what setup changed, write under a lock then rename
+            # so other jobs never source a partial file
+            mkdir -p $eupscachedir
+            find $eupscache.lock -maxdepth 0 -mmin +10 -exec rmdir {{}} \\; 2>/dev/null
+            if mkdir $eupscache.lock 2>/dev/null; then
+                pfw_write_env_cache > $eupscache.$$ && mv $eupscache.$$ $eupscache
+                rmdir $eupscache.lock
+                echo "Saved eups environment to cache ($eupscache)"
+            fi
         fi
     fi
     if [ $mystat -ne 0 -a $cnt -lt $maxtries ]; then
-        echo "Sleeping then retrying..."
+        echo "Sleeping $mydelay secs then retrying..."
         sleep $mydelay
+        mydelay=$((mydelay*2))
+        if [ $mydelay -gt 300 ]; then
+            mydelay=300
+        fi
     fi
 done
 d2=`date "+%s"`
@@ -2624,6 +2707,69 @@ echo "PFW: untaring_input_tar endtime: $d2"
     if not usedb:
         scriptstr += 'echo "DESDMTIME: untar_input_tar $((d2-d1)) secs"'
 
+    # input files shared by several jobs are extracted once per node into a
+    # cache keyed by the content hash in the tarball name, then linked in.
+    # The cache is node-local, not $TMPDIR which is the per-job scratch dir
+    # under HTCondor.   Trees no job has used for input_cache_maxage minutes
+    # are removed (.complete is touched on every use).
+    input_cache_dir = config.getfull('input_cache_dir', default='/tmp/pfw_input_cache_`id -u`')
+    input_cache_maxage = int(config.getfull('input_cache_maxage', default=2880))   # minutes
+    scriptstr += f"""
+if [ -n "$sharedtars" ]; then
+    d1=`date "+%s"`
+    echo "PFW: shared_input_tar starttime: $d1"
+    inputcachedir={input_cache_dir}
+    mkdir -p $inputcachedir
+    for sharedtar in `echo $sharedtars | tr ',' ' '`; do
+        sharedpath=$initdir/$sharedtar
+        if [ ! -r $sharedpath ]; then
+            sharedpath=$initdir/../$sharedtar    # not using condor file transfer
+        fi
+        shareddir=$inputcachedir/`basename $sharedtar .tar.gz`
+        waited=0
+        while [ ! -e $shareddir/.complete -a $waited -lt 300 ]; do
+            find $shareddir.lock -maxdepth 0 -mmin +30 -exec rmdir {{}} \\; 2>/dev/null
+            if mkdir $shareddir.lock 2>/dev/null; then
+                echo "Extracting shared input tar into node cache ($shareddir)"
+                rm -rf $shareddir
+                mkdir -p $shareddir
+                tar -xzf $sharedpath -C $shareddir && touch $shareddir/.complete
+                rmdir $shareddir.lock
+                break
+            fi
+            sleep 5
+            waited=$((waited+5))
+        done
+        if [ -e $shareddir/.complete ]; then
+            touch $shareddir/.complete
+            echo "PFW: shared_input_tar cache: $shareddir"
+            for f in `cd $shareddir && find . -type f ! -name .complete`; do
+                mkdir -p `dirname $f`
+                ln -sf $shareddir/$f $f
+            done
+        else
+            echo "Warning: could not use node cache for shared input tar, extracting into job dir"
+            tar -xzf $sharedpath
+        fi
+    done
+
+    # remove cached trees (including partial ones) no job used recently
+    for olddir in `find $inputcachedir -mindepth 1 -maxdepth 1 -type d -name 'inputshared_*' ! -name '*.lock' -mmin +{input_cache_maxage}`; do
+        if [ -z "`find $olddir/.complete -mmin -{input_cache_maxage} 2>/dev/null`" ] && mkdir $olddir.lock 2>/dev/null; then
+            if [ -z "`find $olddir/.complete -mmin -{input_cache_maxage} 2>/dev/null`" ]; then
+                echo "Removing unused shared input cache ($olddir)"
+                rm -rf $olddir
+            fi
+            rmdir $olddir.lock
+        fi
+    done
+    d2=`date "+%s"`
+    echo "PFW: shared_input_tar endtime: $d2"
+fi
+"""
+    if not usedb:
+        scriptstr += 'echo "DESDMTIME: shared_input_tar $((d2-d1)) secs"'
+
     # copy files so can test by hand after job
     # save initial directory to job wcl file
     scriptstr += """
@@ -2739,28 +2885,38 @@ def create_jobmngr_dag(config, dagfile, scriptfile, joblist):
         use_condor_transfer_output = miscutils.convertBool(config.getfull('use_condor_transfer_output'))
 
 
+    # one jobpost script for the whole block, per-job values are passed as arguments
+    hookprefix = pfwhookpool.get_hook_prefix(config, 'jobpost', 'db')
+    jobpostfile = f"{blkdir}/jobpost.sh"
+    with open(jobpostfile, 'w') as jpostfh:
+        jpostfh.write("#!/usr/bin/env sh\n")
+        jpostfh.write(f"{hookprefix} {pfwdir}/libexec/jobpost.py ../uberctrl/config.des {blockname} \"$@\"\n")
+    os.chmod(jobpostfile, stat.S_IRWXU | stat.S_IRWXG)
+
+    # the runjob condor file is shared by all jobs, so write every per-job
+    # macro on a single VARS line
     with open(f"{blkdir}/{dagfile}", 'w') as dagfh:
         for _, jobdict in joblist.items():
             jobnum = jobdict['jobnum']
             tjpad = pfwutils.pad_jobnum(jobnum)
 
-            dagfh.write(f"JOB {tjpad} {condorfile}\n")
-            dagfh.write(f"VARS {tjpad} jobnum=\"{tjpad}\"\n")
-            dagfh.write(f"VARS {tjpad} exec=\"../{scriptfile}\"\n")
-            dagfh.write(f"VARS {tjpad} args=\"{jobnum} {jobdict['inputwcltar']} {jobdict['jobwclfile']} {jobdict['tasksfile']} {jobdict['envfile']} {jobdict['outputwcltar']}\"\n")
-            dagfh.write(f"VARS {tjpad} transinput=\"{jobdict['inputwcltar']},{jobdict['jobwclfile']},{jobdict['tasksfile']},jobpost_{tjpad}.sh\"\n")
-            if 'wall' in jobdict:
-                dagfh.write(f"VARS {tjpad} wall=\"{jobdict['wall']}\"\n")
+            args = f"{jobnum} {jobdict['inputwcltar']} {jobdict['jobwclfile']} {jobdict['tasksfile']} {jobdict['envfile']} {jobdict['outputwcltar']}"
+            transinput = f"{jobdict['inputwcltar']},{jobdict['jobwclfile']},{jobdict['tasksfile']}"
+            sharedtars = jobdict.get('inputsharedtars')
+            if sharedtars:
+                args += f" {','.join(sharedtars)}"
+                transinput += ''.join([f",../{sharedtar}" for sharedtar in sharedtars])
 
+            varstr = f"VARS {tjpad} jobnum=\"{tjpad}\" args=\"{args}\" transinput=\"{transinput}\""
+            if 'wall' in jobdict:
+                varstr += f" wall=\"{jobdict['wall']}\""
             if use_condor_transfer_output:
-                dagfh.write(f"VARS {tjpad} transoutput=\"{jobdict['outputwcltar']},{jobdict['envfile']}\"\n")
+                varstr += f" transoutput=\"{jobdict['outputwcltar']},{jobdict['envfile']}\""
+
+            dagfh.write(f"JOB {tjpad} {condorfile}\n")
+            dagfh.write(f"{varstr}\n")
             dagfh.write(f"SCRIPT pre {tjpad} {pfwdir}/libexec/jobpre.py ../uberctrl/config.des $JOB\n")
-            dagfh.write(f"SCRIPT post {tjpad} {tjpad}/jobpost_{tjpad}.sh $RETURN\n")
-            with open(f"{tjpad}/jobpost_{tjpad}.sh", 'w') as jpostfh:
-                jpostfh.write("#!/usr/bin/env sh\n")
-                jpostfh.write("sem --record-env\n")
-                jpostfh.write(f"sem --fg --id jobpost -j 20 {pfwdir}/libexec/jobpost.py ../uberctrl/config.des {blockname} {tjpad} {jobdict['inputwcltar']} {jobdict['outputwcltar']} $1\n")
-            os.chmod(f"{tjpad}/jobpost_{tjpad}.sh", stat.S_IRWXU | stat.S_IRWXG)
+            dagfh.write(f"SCRIPT post {tjpad} {jobpostfile} {tjpad} {jobdict['inputwcltar']} {jobdict['outputwcltar']} $RETURN\n")
 
 
     miscutils.fwdebug_print("END\n\n")
@@ -2778,6 +2934,68 @@ def tar_inputfiles(config, jobnum, inlist):
     return inputtar
 
 
+#######################################################################
+def find_shared_inputs(joblist):
+    """ Return the set of input list files used by more than one job """
+    counts = collections.Counter()
+    for jobdict in joblist.values():
+        counts.update(set(jobdict['inlist']))
+    return {fname for fname, cnt in counts.items() if cnt > 1}
+
+
+#######################################################################
+def group_shared_inputs(joblist, shared_inputs):
+    """ Group shared input files by the exact set of jobs using them
+
+        Each file is in exactly one group so its content is only in one
+        shared tarball.   Returns a list of (jobkeys, filenames) sorted by
+        filenames.
+    """
+    users = collections.defaultdict(set)
+    for jobkey, jobdict in joblist.items():
+        for fname in jobdict['inlist']:
+            if fname in shared_inputs:
+                users[fname].add(jobkey)
+
+    groups = collections.defaultdict(list)
+    for fname, jobkeys in users.items():
+        groups[frozenset(jobkeys)].append(fname)
+    return sorted([(jobkeys, sorted(fnames)) for jobkeys, fnames in groups.items()],
+                  key=lambda grp: grp[1])
+
+
+#######################################################################
+def tar_shared_inputfiles(sharedlist, filehashes):
+    """ Tar input files shared between jobs into a content-addressed tarball
+
+        The tarball is named by a hash of the files' names and contents and
+        written in the block dir only once no matter how many jobs use it.
+        filehashes caches per-file content hashes between calls.
+    """
+    tarhash = hashlib.sha1()
+    for fname in sorted(set(sharedlist)):
+        if fname not in filehashes:
+            fhash = hashlib.sha1()
+            with open(fname, 'rb') as infh:
+                for chunk in iter(lambda: infh.read(1024*1024), b''):
+                    fhash.update(chunk)
+            filehashes[fname] = fhash.hexdigest()
+        tarhash.update(f"{fname} {filehashes[fname]}\n".encode('utf-8'))
+
+    sharedtar = f"inputshared_{tarhash.hexdigest()[:20]}.tar.gz"
+    if not os.path.exists(sharedtar):
+        # write under a temporary name (keeping the suffix which picks the
+        # compression) so a crash never leaves a partial tarball to be reused
+        tmptar = f".tmp{os.getpid()}_{sharedtar}"
+        try:
+            pfwutils.tar_list(tmptar, sorted(set(sharedlist)))
+            os.rename(tmptar, sharedtar)
+        finally:
+            if os.path.exists(tmptar):
+                os.unlink(tmptar)
+    return sharedtar
+
+
 #######################################################################
 def create_runjob_condorfile(config, scriptfile):
     """ Write runjob condor description file for target job """
@@ -15,9 +15,15 @@
 
 __version__ = "$Rev: 48552 $"
 
+import gzip
 import os
+import pickle
+import re
 import socket
+import string
 import sys
+import threading
+import time
 from datetime import datetime
 import collections
 import pytz
@@ -39,12 +45,120 @@ class PFWDB(desdmdbi.DesDmDbi):
         filetypes and to ingest metadata associated with those headers.
     """
 
+    # Statements run through execute_stmt, defined once with bind variables.
+    # {name} fields become the DB's bind string for name except for {where}
+    # ("col=bind and ..." for the caller's where columns), {setvals}
+    # ("col=bind,..." for the caller's set columns) and any table names
+    # given by the caller.
+    STATEMENTS = {
+        'get_job_info': "select j.jobkeys as jobkeys,j.jobnum as jobnum, j.expect_num_wrap as expect_num_wrap, j.task_id as task_id, j.pfw_block_task_id as pfw_block_task_id, t.status as status, t.start_time as start_time, t.end_time as end_time from pfw_job j, task t where t.id=j.task_id and {where}",
+        'get_jobwrapper_info': "select task.* from pfw_attempt, task where pfw_attempt.task_id=task.root_task_id and task.name='jobwrapper' and {where}",
+        'get_wrapper_info': "select pw.*,t.* from pfw_wrapper pw, task t where pw.task_id=t.id and {where}",
+        'get_wrapper_info.attempt': "select * from pfw_attempt, pfw_wrapper, task where pfw_attempt.id=pfw_wrapper.pfw_attempt_id and pfw_attempt.task_id=task.id and {where}",
+        'get_fail_log_fullnames': "select a.root, fai.path, fai.filename from ops_archive a, task t, pfw_wrapper w, file_archive_info fai where w.log=fai.filename and a.name = {archive_name} and fai.archive_name={archive_name} and pfw_attempt_id={pfw_attempt_id} and w.task_id=t.id and (t.status is null or t.status != 0)",
+        'get_fail_log_fullnames.noarchive': "select 'NO-HOME-ARCHIVE-ROOT', fai.path, fai.filename from task t, pfw_wrapper w, file_archive_info fai where w.log=fai.filename and pfw_attempt_id={pfw_attempt_id} and w.task_id=t.id and (t.status is null or t.status != 0)",
+        'get_log_fullnames': "select a.root, fai.path, fai.filename from ops_archive a, pfw_wrapper w, file_archive_info fai where w.log=fai.filename and a.name = {archive_name} and fai.archive_name={archive_name} and w.pfw_attempt_id={pfw_attempt_id}",
+        'get_log_fullnames.noarchive': "select 'NO-HOME-ARCHIVE-ROOT', fai.path, fai.filename from pfw_wrapper w, file_archive_info fai where w.log=fai.filename and w.pfw_attempt_id={pfw_attempt_id}",
+        'update_job_target_info.pfw_job': "update pfw_job set {setvals} where task_id={task_id} and condor_job_id is NULL",
+        'update_job_target_info.task': "update task set exec_host={exec_host} where id={id}",
+        # doing epoch conversion on DB to avoid any timezone issues
+        'update_job_target_info.task_start': "update task set exec_host={exec_host}, start_time = (from_tz(to_timestamp('1970-01-01','YYYY-MM-DD') + numtodsinterval({start_epoch},'SECOND'), 'UTC') at time zone 'US/Central') where id={id}",
+        'check_files': "select filename, compression from {gtt} gtt where not exists (select df.filename,df.compression from desfile df, file_archive_info fai where gtt.filename=df.filename and nullcmp(gtt.compression, df.compression)=1 and df.id=fai.desfile_id and fai.archive_name={archive_name})",
+    }
+
     def __init__(self, desfile=None, section=None, threaded=False):
         """ Initialize object """
         if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
             miscutils.fwdebug_print(f"{desfile},{section}")
 
         desdmdbi.DesDmDbi.__init__(self, desfile, section, threaded=threaded)
+        self._section = section or os.environ.get('DES_DB_SECTION')
+        self._stmt_cursors = {}
+        self._stmt_sqls = {}
+        self._stmt_stats = {}
+        self._stmt_lock = threading.Lock()
+
+    def _stmt_cursor(self, name):
+        """ Return the cursor kept for statement name (per thread)
+
+            Executing the same SQL text again on the same cursor lets the
+            driver reuse the prepared statement instead of parsing it again.
+        """
+        key = (name, threading.get_ident())
+        curs = self._stmt_cursors.get(key)
+        if curs is None:
+            curs = self.cursor()
+            self._stmt_cursors[key] = curs
+        return curs
+
+    def _stmt_sql(self, name, where=(), setcols=(), tables=None):
+        """ Return (key, sql) for registered statement, building sql only once
+
+            Where columns may be qualified (e.g., pfw_attempt.reqnum) in
+            which case the bind variable is the unqualified name.
+        """
+        tables = tables or {}
+        key = (name, tuple(where), tuple(setcols), tuple(sorted(tables.items())))
+        sql = self._stmt_sqls.get(key)
+        if sql is None:
+            fields = {}
+            for (_, fname, _, _) in string.Formatter().parse(self.STATEMENTS[name]):
+                if fname is None or fname in fields:
+                    continue
+                if fname == 'where':
+                    fields[fname] = ' and '.join([f"{c}={self.get_named_bind_string(c.split('.')[-1])}" for c in where])
+                elif fname == 'setvals':
+                    fields[fname] = ','.join([f"{c}={self.get_named_bind_string(c)}" for c in setcols])
+                elif fname in tables:
+                    fields[fname] = tables[fname]
+                else:
+                    fields[fname] = self.get_named_bind_string(fname)
+            sql = self.STATEMENTS[name].format(**fields)
+            self._stmt_sqls[key] = sql
+        return key, sql
+
+    def execute_stmt(self, name, params, where=(), setcols=(), tables=None):
+        """ Execute registered statement name on its cached cursor
+
+            Returns the cursor which must be done with before the same
+            statement is executed again by the same thread.
+        """
+        key, sql = self._stmt_sql(name, where, setcols, tables)
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"params> {params}")
+        curs = self._stmt_cursor(key)
+        starttime = time.time()
+        try:
+            curs.execute(sql, params)
+        finally:
+            secs = time.time() - starttime
+            with self._stmt_lock:
+                stats = self._stmt_stats.setdefault(name, [0, 0.0])
+                stats[0] += 1
+                stats[1] += secs
+        return curs
+
+    def get_stmt_stats(self):
+        """ Return dict of statement name -> (number of executions, total secs) """
+        with self._stmt_lock:
+            return {name: tuple(stats) for name, stats in self._stmt_stats.items()}
+
+    def print_stmt_stats(self):
+        """ Print execution count and latency of each registered statement run """
+        for name, (cnt, secs) in sorted(self.get_stmt_stats().items()):
+            print(f"DESDMTIME: pfwdb_stmt {name} {cnt} {secs:0.3f} ({secs / cnt * 1000:0.1f} ms/exec)")
+
+    def close(self):
+        """ Close cached statement cursors and the connection """
+        for curs in self._stmt_cursors.values():
+            try:
+                curs.close()
+            except Exception:
+                pass
+        self._stmt_cursors = {}
+        desdmdbi.DesDmDbi.close(self)
 
     def get_database_defaults(self):
         """ Grab default configuration information stored in database """
@@ -393,47 +507,119 @@ class PFWDB(desdmdbi.DesDmDbi):
         self.insert_PFW_row('PFW_JOB', row)
 
 
+    def insert_jobs(self, wcl, jobdicts):
+        """ Insert task and pfw_job rows for many jobs with array inserts and one commit
+
+            Task ids are pulled from the task sequence in one query and saved
+            in wcl['task_id']['job'] like insert_job does.
+        """
+        jobdicts = list(jobdicts)
+        if not jobdicts:
+            return
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"Inserting {len(jobdicts)} jobs to pfw_job table\n")
+
+        blknum = wcl[pfwdefs.PF_BLKNUM]
+        blktid = int(wcl['task_id']['block'][blknum])
+        attempt_tid = int(wcl['task_id']['attempt'])
+
+        curs = self.cursor()
+        curs.execute(f"select {pfwdefs.DB_TASK_SEQ}.nextval from dual connect by level <= {self.get_named_bind_string('numjobs')}",
+                     {'numjobs': len(jobdicts)})
+        taskids = [row[0] for row in curs.fetchall()]
+
+        taskrows = []
+        jobrows = []
+        for jobdict, task_id in zip(jobdicts, taskids):
+            wcl['task_id']['job'][jobdict['jobnum']] = task_id
+            taskrows.append({'id': task_id,
+                             'name': 'job',
+                             'info_table': 'pfw_job',
+                             'parent_task_id': blktid,
+                             'root_task_id': attempt_tid})
+            jobrows.append({'pfw_attempt_id': wcl['pfw_attempt_id'],
+                            'pfw_block_task_id': blktid,
+                            'jobnum': int(jobdict['jobnum']),
+                            'expect_num_wrap': jobdict['numexpwrap'],
+                            'pipeprod': wcl['pipeprod'],
+                            'pipever': wcl['pipever'],
+                            'task_id': task_id,
+                            'jobkeys': jobdict.get('jobkeys')})
+
+        for (table, rows) in [('task', taskrows), ('pfw_job', jobrows)]:
+            cols = list(rows[0].keys())
+            sql = f"insert into {table} ({','.join(cols)}) values ({','.join([self.get_named_bind_string(c) for c in cols])})"
+            if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+                miscutils.fwdebug_print(f"sql> {sql}")
+            for i in range(0, len(rows), pfwdefs.DB_JOB_BATCH_SIZE):
+                curs.executemany(sql, rows[i:i + pfwdefs.DB_JOB_BATCH_SIZE])
+        curs.close()
+        self.commit()
+
+
+    def insert_task_messages(self, pfw_attempt_id, messages):
+        """ Insert many task_message rows with one array insert and one commit
+
+            messages is a list of tuples (task_id, message, message_lvl
+            [, log_file[, log_line]]), i.e., the Messaging.pfw_message
+            arguments after the attempt id.
+        """
+        if not messages:
+            return
+        cols = ['task_id', 'pfw_attempt_id', 'message', 'message_lvl', 'log_file', 'log_line']
+        rows = []
+        for msgargs in messages:
+            rows.append({'task_id': msgargs[0],
+                         'pfw_attempt_id': pfw_attempt_id,
+                         'message': msgargs[1],
+                         'message_lvl': msgargs[2],
+                         'log_file': msgargs[3] if len(msgargs) > 3 else '',
+                         'log_line': msgargs[4] if len(msgargs) > 4 else 0})
+
+        sql = f"insert into task_message ({','.join(cols)}, message_time) values ({','.join([self.get_named_bind_string(c) for c in cols])}, {self.get_current_timestamp_str()})"
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+        curs = self.cursor()
+        try:
+            curs.executemany(sql, rows)
+        finally:
+            curs.close()
+        self.commit()
+
+
     def update_job_target_info(self, wcl, submit_condor_id=None,
                                target_batch_id=None, exechost=None):
-        """ Save information about target job from pfwrunjob """
-
+        """ Save information about target job from pfwrunjob
 
+            Updates the pfw_job row (guarded so a job cannot register twice)
+            and the job's task row with fixed bind-variable statements in a
+            single transaction.
+        """
+        task_id = wcl['task_id']['job']
         params = {}
-        setvals = []
         if submit_condor_id is not None:
-            setvals.append(f"condor_job_id={self.get_named_bind_string('condor_job_id')}")
             params['condor_job_id'] = float(submit_condor_id)
-
         if target_batch_id is not None:
-            setvals.append(f"target_job_id={self.get_named_bind_string('target_job_id')}")
             params['target_job_id'] = target_batch_id
-
         if 'jobroot' in wcl:
-            setvals.append(f"jobroot={self.get_named_bind_string('jobroot')}")
             params['jobroot'] = wcl['jobroot']
 
-        if setvals:
-            params['task_id'] = wcl['task_id']['job']
-
-            sql = f"update pfw_job set {','.join(setvals)} where task_id={self.get_named_bind_string('task_id')} and condor_job_id is NULL"
-
-            if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
-                miscutils.fwdebug_print(f"sql> {sql}")
-            if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
-                miscutils.fwdebug_print(f"params> {params}")
-            curs = self.cursor()
+        if params:
+            # only a few column combinations so each gets its own reused statement
+            setcols = tuple(params.keys())
+            params['task_id'] = task_id
             try:
-                curs.execute(sql, params)
+                curs = self.execute_stmt('update_job_target_info.pfw_job', params, setcols=setcols)
             except:
                 (typ, value, _) = sys.exc_info()
                 print("******************************")
                 print("Error:", typ, value)
-                print(f"sql> {sql}\n")
+                print(f"sql> {self._stmt_sql('update_job_target_info.pfw_job', setcols=setcols)[1]}\n")
                 print(f"params> {params}\n")
                 raise
 
             if curs.rowcount == 0:
-                Messaging.pfw_message(self, wcl['pfw_attempt_id'], wcl['task_id']['job'],
+                Messaging.pfw_message(self, wcl['pfw_attempt_id'], task_id,
                                       "Job attempted to run more than once", pfwdefs.PFWDB_MSG_ERROR)
 
                 print("******************************")
@@ -444,12 +630,12 @@ class PFWDB(desdmdbi.DesDmDbi):
                 print("attnum = ", wcl[pfwdefs.ATTNUM])
                 print("blknum = ", wcl[pfwdefs.PF_BLKNUM])
                 print("jobnum = ", wcl[pfwdefs.PF_JOBNUM])
-                print("job task_id = ", wcl['task_id']['job'])
+                print("job task_id = ", task_id)
 
                 print("\nThe 1st job information:")
                 curs2 = self.cursor()
-                sql = f"select * from pfw_job, task where pfw_job.task_id=task.id and pfw_job.task_id={self.get_named_bind_string('task_id')}"
-                curs2.execute(sql, {'task_id': wcl['task_id']['job']})
+                sql2 = f"select * from pfw_job, task where pfw_job.task_id=task.id and pfw_job.task_id={self.get_named_bind_string('task_id')}"
+                curs2.execute(sql2, {'task_id': task_id})
                 desc = [d[0].lower() for d in curs2.description]
                 for row in curs2:
                     d = dict(zip(desc, row))
@@ -457,8 +643,6 @@ class PFWDB(desdmdbi.DesDmDbi):
                         print(k, v)
                     print("\n")
 
-
-
                 print("\nThe 2nd job information:")
                 print("submit_condor_id = ", submit_condor_id)
                 print("target_batch_id = ", target_batch_id)
@@ -466,28 +650,20 @@ class PFWDB(desdmdbi.DesDmDbi):
                 print("current time = ", str(datetime.now()))
 
                 print("\nupdate statement information")
-                print(f"sql> {sql}\n")
+                print(f"sql> {self._stmt_sql('update_job_target_info.pfw_job', setcols=setcols)[1]}\n")
                 print(f"params> %{params}\n")
 
-
                 raise Exception("Error: job attempted to run more than once")
 
         if exechost is not None:
-            sql = f"update task set exec_host='{exechost}'"
-
+            tparams = {'exec_host': exechost, 'id': task_id}
             if 'PFW_JOB_START_EPOCH' in os.environ:
-                # doing conversion on DB to avoid any timezone issues
-                sql += f", start_time = (from_tz(to_timestamp('1970-01-01','YYYY-MM-DD') + numtodsinterval({os.environ['PFW_JOB_START_EPOCH']},'SECOND'), 'UTC') at time zone 'US/Central')"
+                tparams['start_epoch'] = float(os.environ['PFW_JOB_START_EPOCH'])
+                self.execute_stmt('update_job_target_info.task_start', tparams)
+            else:
+                self.execute_stmt('update_job_target_info.task', tparams)
 
-            sql += f" where id={wcl['task_id']['job']}"
-            curs = self.cursor()
-            curs.execute(sql)
-            self.commit()
-            #wherevals = {}
-            #wherevals['id'] = wcl['task_id']['job']
-            #updatevals = {}
-            #updatevals['exec_host'] = exechost
-            #self.update_PFW_row('TASK', updatevals, wherevals)
+        self.commit()
 
 
     def update_job_junktar(self, wcl, junktar=None):
@@ -535,6 +711,23 @@ class PFWDB(desdmdbi.DesDmDbi):
         self.basic_update_row('pfw_job', jobinfo, wherevals)
         self.commit()
 
+    def update_job_results(self, task_id, jobvals, taskvals):
+        """ Apply post-job pfw_job and task values in a single transaction
+
+            jobvals maps job task ids to pfw_job values, taskvals are the values
+            for the job's row in the task table.  Returns number of update statements.
+        """
+        numstmts = 0
+        for jobtid, vals in jobvals.items():
+            if vals:
+                self.basic_update_row('pfw_job', vals, {'task_id': jobtid})
+                numstmts += 1
+        if taskvals:
+            self.basic_update_row('task', taskvals, {'id': task_id})
+            numstmts += 1
+        self.commit()
+        return numstmts
+
     ##### WRAPPER #####
     def insert_wrapper(self, wcl, iwfilename, parent_tid):
         """ insert row into pfw_wrapper """
@@ -712,6 +905,66 @@ class PFWDB(desdmdbi.DesDmDbi):
         self.commit()
 
 
+    ######################################################################
+    def ingest_provenance_bulk(self, used, wdf):
+        """ Insert deduplicated used and was_derived_from edges set-based
+
+            used is an iterable of (task_id, filename, compression)
+            wdf is an iterable of (parent_filename, parent_compression,
+                                   child_filename, child_compression)
+            The edges are staged in global temporary tables with array
+            inserts, then each provenance table gets a single insert-select
+            joining the staged edges to desfile.   Everything is one
+            transaction, committed at the end.
+            Returns (number of used rows inserted, number of wdf rows inserted,
+                     sorted list of fullnames the edges refer to that are not
+                     in desfile and so could not be inserted)
+        """
+        usedgtt = pfwdefs.DB_PROV_USED_GTT
+        wdfgtt = pfwdefs.DB_PROV_WDF_GTT
+        curs = self.cursor()
+
+        # stage the edges
+        cols = ['task_id', 'filename', 'compression']
+        self._stage_prov_rows(curs, usedgtt, cols, used)
+        cols = ['parent_filename', 'parent_compression', 'child_filename', 'child_compression']
+        self._stage_prov_rows(curs, wdfgtt, cols, wdf)
+
+        # find files the edges refer to which are not in desfile
+        notindesfile = "not exists (select null from desfile df where df.filename=g.{0}filename and nullcmp(g.{0}compression, df.compression)=1)"
+        sql = f"select g.filename, g.compression from {usedgtt} g where {notindesfile.format('')} union select g.parent_filename, g.parent_compression from {wdfgtt} g where {notindesfile.format('parent_')} union select g.child_filename, g.child_compression from {wdfgtt} g where {notindesfile.format('child_')}"
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+        curs.execute(sql)
+        missing = sorted([fname if comp is None else fname + comp for (fname, comp) in curs])
+
+        sql = f"insert into {pfwdefs.DB_PROV_USED_TABLE} (task_id, desfile_id) select distinct g.task_id, df.id from {usedgtt} g, desfile df where df.filename=g.filename and nullcmp(g.compression, df.compression)=1 and not exists (select null from {pfwdefs.DB_PROV_USED_TABLE} u where u.task_id=g.task_id and u.desfile_id=df.id)"
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+        curs.execute(sql)
+        numused = max(curs.rowcount, 0)
+
+        sql = f"insert into {pfwdefs.DB_PROV_WDF_TABLE} (parent_desfile_id, child_desfile_id) select distinct p.id, c.id from {wdfgtt} g, desfile p, desfile c where p.filename=g.parent_filename and nullcmp(g.parent_compression, p.compression)=1 and c.filename=g.child_filename and nullcmp(g.child_compression, c.compression)=1 and not exists (select null from {pfwdefs.DB_PROV_WDF_TABLE} w where w.parent_desfile_id=p.id and w.child_desfile_id=c.id)"
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+        curs.execute(sql)
+        numwdf = max(curs.rowcount, 0)
+
+        curs.close()
+        self.commit()
+        return numused, numwdf, missing
+
+    def _stage_prov_rows(self, curs, gtt, cols, rows):
+        """ Empty the staging table then load rows (tuples in cols order) in batches """
+        curs.execute(f"delete from {gtt}")
+        sql = f"insert into {gtt} ({','.join(cols)}) values ({','.join([self.get_named_bind_string(c) for c in cols])})"
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+        rows = [dict(zip(cols, row)) for row in rows]
+        for i in range(0, len(rows), pfwdefs.DB_PROV_BATCH_SIZE):
+            curs.executemany(sql, rows[i:i + pfwdefs.DB_PROV_BATCH_SIZE])
+
+
     #####
     def insert_data_query(self, wcl, modname, datatype, dataname, execname, cmdargs, version):
         """ insert row into pfw_data_query table """
@@ -762,17 +1015,7 @@ class PFWDB(desdmdbi.DesDmDbi):
 
     def get_job_info(self, wherevals):
         """ Get job information """
-        whclause = []
-        for c in wherevals.keys():
-            whclause.append(f"{c}={self.get_named_bind_string(c)}")
-        sql = f"select j.jobkeys as jobkeys,j.jobnum as jobnum, j.expect_num_wrap as expect_num_wrap, j.task_id as task_id, j.pfw_block_task_id as pfw_block_task_id, t.status as status, t.start_time as start_time, t.end_time as end_time from pfw_job j, task t where t.id=j.task_id and {' and '.join(whclause)}"
-        #sql = "select j.*,t.* from pfw_job j, task t where t.id=j.task_id and %s" % (' and '.join(whclause))
-        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
-            miscutils.fwdebug_print(f"sql> {sql}")
-        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
-            miscutils.fwdebug_print(f"params> {wherevals}")
-        curs = self.cursor()
-        curs.execute(sql, wherevals)
+        curs = self.execute_stmt('get_job_info', wherevals, where=tuple(wherevals.keys()))
         desc = [d[0].lower() for d in curs.description]
 
 
@@ -839,15 +1082,8 @@ class PFWDB(desdmdbi.DesDmDbi):
     def get_jobwrapper_info(self, **kwargs):
         """ Get wrapper information for an attempt """
 
-        sql = "select task.* from pfw_attempt, task where pfw_attempt.task_id=task.root_task_id and task.name='jobwrapper' and "
-
-        wherevals = [f"pfw_attempt.{k}='{v}'" for k, v in kwargs.items()]
-        sql += ' and '.join(wherevals)
-
-        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
-            miscutils.fwdebug_print(f"sql> {sql}")
-        curs = self.cursor()
-        curs.execute(sql)
+        curs = self.execute_stmt('get_jobwrapper_info', kwargs,
+                                 where=tuple([f"pfw_attempt.{k}" for k in kwargs]))
         desc = [d[0].lower() for d in curs.description]
         jobwraps = {}
         for line in curs:
@@ -861,17 +1097,11 @@ class PFWDB(desdmdbi.DesDmDbi):
         """ Get wrapper information for an attempt """
 
         if 'reqnum' in kwargs or 'unitname' in kwargs or 'attnum' in kwargs:   # join to attempt table
-            sql = 'select * from pfw_attempt, pfw_wrapper, task where pfw_attempt.id=pfw_wrapper.pfw_attempt_id and pfw_attempt.task_id=task.id and '
+            name = 'get_wrapper_info.attempt'
         else:
-            sql = 'select pw.*,t.* from pfw_wrapper pw, task t where pw.task_id=t.id and '
+            name = 'get_wrapper_info'
 
-        wherevals = [f"{k}='{v}'" for k, v in kwargs.items()]
-        sql += ' and '.join(wherevals)
-
-        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
-            miscutils.fwdebug_print(f"sql> {sql}")
-        curs = self.cursor()
-        curs.execute(sql)
+        curs = self.execute_stmt(name, kwargs, where=tuple(kwargs.keys()))
         desc = [d[0].lower() for d in curs.description]
         wrappers = {}
         for line in curs:
@@ -896,6 +1126,193 @@ class PFWDB(desdmdbi.DesDmDbi):
         return info
 
 
+    def get_block_state(self, blktid, attid):
+        """ Return task, job, wrapper and jobwrapper state for a single block
+
+            Uses two queries restricted to the block: one for the block's
+            child tasks (non-job tasks and jobs) and one for its wrappers
+            joined to their jobwrapper tasks.   Returns (bltasks, jobinfo,
+            wrapinfo, jobwrap, stats) where the first four match the
+            results of get_block_task_info, get_job_info, get_wrapper_info
+            and get_jobwrapper_info and stats has the number of queries,
+            rows and (approximate) bytes fetched.
+        """
+        stats = {'queries': 0, 'rows': 0, 'bytes': 0}
+        params = {'blktid': blktid}
+
+        # block's child tasks, with pfw_job columns for jobs
+        sql = f"select t.*, j.jobkeys, j.jobnum, j.expect_num_wrap, j.pfw_block_task_id from task t left join pfw_job j on j.task_id=t.id where t.parent_task_id={self.get_named_bind_string('blktid')}"
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+        bltasks = {}
+        jobinfo = {}
+        failedjobs = []
+        jobcols = ['jobkeys', 'jobnum', 'expect_num_wrap', 'task_id', 'pfw_block_task_id',
+                   'status', 'start_time', 'end_time']
+        for d in self._fetch_state_rows(sql, params, stats):
+            if d['info_table'] is not None and d['info_table'].lower() == 'pfw_job':
+                d['task_id'] = d['id']
+                job = {k: d[k] for k in jobcols}
+                job['message'] = []
+                if job['status'] != pfwdefs.PF_EXIT_SUCCESS:
+                    failedjobs.append(job['task_id'])
+                jobinfo[job['task_id']] = job
+            else:
+                for k in ['jobkeys', 'jobnum', 'expect_num_wrap', 'pfw_block_task_id']:
+                    del d[k]
+                bltasks[d['name']] = d
+
+        if failedjobs:
+            qdbh = qcfdb.QCFDB(connection=self)
+            qcmsg = qdbh.get_all_qcf_messages_by_task_id(failedjobs, level=3)
+            stats['queries'] += 1
+            for tid, val in qcmsg.items():
+                jobinfo[tid]['message'] = val
+
+        # block's wrappers with the status of their jobwrapper task
+        params['attid'] = attid
+        sql = f"select pw.*, t.*, jw.id as jobwrapper_id, jw.status as jobwrapper_status from pfw_wrapper pw join task t on pw.task_id=t.id left join task jw on jw.id=t.parent_task_id and jw.name='jobwrapper' where pw.pfw_attempt_id={self.get_named_bind_string('attid')} and pw.pfw_block_task_id={self.get_named_bind_string('blktid')}"
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+        wrapinfo = {}
+        jobwrap = {}
+        for d in self._fetch_state_rows(sql, params, stats):
+            jwid = d.pop('jobwrapper_id')
+            jwstatus = d.pop('jobwrapper_status')
+            if jwid is not None:
+                jobwrap[jwid] = {'id': jwid, 'status': jwstatus}
+            wrapinfo[d['task_id']] = d
+
+        return bltasks, jobinfo, wrapinfo, jobwrap, stats
+
+
+    def _fetch_state_rows(self, sql, params, stats):
+        """ Yield rows as dicts, counting queries, rows and bytes in stats """
+        curs = self.cursor()
+        curs.execute(sql, params)
+        stats['queries'] += 1
+        desc = [d[0].lower() for d in curs.description]
+        for line in curs:
+            stats['rows'] += 1
+            stats['bytes'] += sum([len(v) if isinstance(v, (str, bytes)) else 8
+                                   for v in line if v is not None])
+            yield dict(zip(desc, line))
+        curs.close()
+
+
+    def get_task_tree(self, root_task_id, subtree_task_id=None, maxdepth=None,
+                      maxnodes=None, cachedir=None, arraysize=1000):
+        """ Yield task rows (dicts with added depth) in tree order
+
+            Uses a hierarchical query starting at subtree_task_id (default
+            root_task_id) with siblings ordered by start_time.   maxdepth
+            limits levels below the start task (start task is depth 1),
+            maxnodes limits number of rows returned.
+
+            If cachedir is given and the root task has ended, the complete
+            tree is saved in a compressed local file (one per DB section
+            and root task) the first time and later calls read it instead
+            of querying the DB.
+        """
+        if subtree_task_id is None:
+            subtree_task_id = root_task_id
+
+        if cachedir is not None:
+            section = re.sub(r'[^\w.-]', '_', self._section or 'default')
+            cachefile = os.path.join(cachedir, f"task_tree_{section}_{root_task_id}.pkl.gz")
+            nodes = None
+            if os.path.exists(cachefile):
+                with gzip.open(cachefile, 'rb') as cachefh:
+                    nodes = pickle.load(cachefh)
+            elif self._task_ended(root_task_id):
+                nodes = list(self._query_task_tree(root_task_id, None, None, arraysize))
+                miscutils.coremakedirs(cachedir)
+                tmpfile = f"{cachefile}.{os.getpid()}"
+                with gzip.open(tmpfile, 'wb') as cachefh:
+                    pickle.dump(nodes, cachefh, protocol=pickle.HIGHEST_PROTOCOL)
+                os.rename(tmpfile, cachefile)
+
+            if nodes is not None:
+                yield from self._filter_task_tree(nodes, subtree_task_id, maxdepth, maxnodes)
+                return
+
+        yield from self._query_task_tree(subtree_task_id, maxdepth, maxnodes, arraysize)
+
+
+    def _task_ended(self, task_id):
+        """ Whether the task has an end_time (i.e., its tree no longer changes) """
+        curs = self.cursor()
+        curs.execute(f"select end_time from task where id={self.get_named_bind_string('id')}", {'id': task_id})
+        row = curs.fetchone()
+        curs.close()
+        return row is not None and row[0] is not None
+
+
+    def _query_task_tree(self, subtree_task_id, maxdepth, maxnodes, arraysize):
+        """ Stream task tree rows from the DB using a hierarchical query """
+        params = {'start_id': subtree_task_id}
+        connectby = "prior t.id = t.parent_task_id"
+        if maxdepth is not None:
+            connectby += f" and level <= {self.get_named_bind_string('maxdepth')}"
+            params['maxdepth'] = maxdepth
+        sql = f"select level as depth, t.* from task t start with t.id={self.get_named_bind_string('start_id')} connect by {connectby} order siblings by t.start_time nulls last, t.id"
+
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+            miscutils.fwdebug_print(f"params> {params}")
+
+        curs = self.cursor()
+        curs.arraysize = arraysize
+        curs.execute(sql, params)
+        desc = [d[0].lower() for d in curs.description]
+        cnt = 0
+        try:
+            for line in curs:
+                if maxnodes is not None and cnt >= maxnodes:
+                    break
+                cnt += 1
+                yield dict(zip(desc, line))
+        finally:
+            curs.close()
+
+
+    @staticmethod
+    def _filter_task_tree(nodes, subtree_task_id, maxdepth, maxnodes):
+        """ Apply subtree, depth and node limits to a full tree in tree order """
+        basedepth = None
+        cnt = 0
+        for node in nodes:
+            if basedepth is None:
+                if node['id'] != subtree_task_id:
+                    continue
+                basedepth = node['depth'] - 1
+            elif node['depth'] <= basedepth + 1:
+                break   # left the subtree
+
+            if maxdepth is not None and node['depth'] - basedepth > maxdepth:
+                continue
+            if maxnodes is not None and cnt >= maxnodes:
+                break
+            cnt += 1
+            tnode = dict(node)
+            tnode['depth'] = node['depth'] - basedepth
+            yield tnode
+
+
+    def get_orphan_tasks(self, root_task_id):
+        """ Return tasks for the attempt whose parent task isn't in the attempt
+
+            Attempt tasks have no parent so they are never orphans.
+        """
+        sql = f"select * from task t where t.root_task_id={self.get_named_bind_string('root_task_id')} and ((t.parent_task_id is null and t.name != 'attempt') or (t.parent_task_id is not null and not exists (select null from task p where p.id=t.parent_task_id and p.root_task_id=t.root_task_id)))"
+        curs = self.cursor()
+        curs.execute(sql, {'root_task_id': root_task_id})
+        desc = [d[0].lower() for d in curs.description]
+        orphans = [dict(zip(desc, line)) for line in curs]
+        curs.close()
+        return orphans
+
+
     def get_run_filelist(self, reqnum, unitname, attnum,
                          blknum=None, archive=None):
 
@@ -972,18 +1389,68 @@ class PFWDB(desdmdbi.DesDmDbi):
         return filelist
 
 
-    def get_fail_log_fullnames(self, pfw_attempt_id, archive):
+    def iter_run_filelist(self, reqnum, unitname, attnum, blknum=None,
+                          archive=None, batchsize=10000):
+        """ Yield lists of (filename, compression, path) for a run's files
+
+            Same files as get_run_filelist (outputs, logs, junk tarballs) but
+            found with a single query.  If archive is given, the files are
+            limited to those in file_archive_info for that archive inside
+            the query itself, otherwise compression and path are None.
+            Results are fetched and yielded batchsize rows at a time.
+        """
+        wherevals = {'reqnum': reqnum, 'unitname':unitname, 'attnum': attnum}
+        if blknum is not None:
+            wherevals['blknum'] = blknum
+        whclause = ' and '.join([f"{k}={self.get_named_bind_string(k)}" for k in wherevals])
+
+        runfiles = f"select wgb.filename from wgb where {whclause} union select log from pfw_wrapper where log is not NULL and {whclause} union select junktar from pfw_job where junktar is not NULL and {whclause}"
+
+        params = dict(wherevals)
+        if archive is not None:
+            sql = f"select fai.filename, fai.compression, fai.path from file_archive_info fai where fai.archive_name={self.get_named_bind_string('archive_name')} and fai.filename in ({runfiles})"
+            params['archive_name'] = archive
+        else:
+            sql = f"select rf.filename, NULL, NULL from ({runfiles}) rf"
+
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
+            miscutils.fwdebug_print(f"params> {params}")
+
+        curs = self.cursor()
+        curs.arraysize = batchsize
+        curs.execute(sql, params)
+        try:
+            while True:
+                rows = curs.fetchmany(batchsize)
+                if not rows:
+                    break
+                yield [tuple(r) for r in rows]
+        finally:
+            curs.close()
+
+
+    def get_attempt_archive_files(self, pfw_attempt_id, archive):
+        """ Return DB information (filename, compression, path, filetype,
+            filesize, md5sum) for the attempt's files in the given archive """
+        sql = f"select df.filename, df.compression, fai.path, df.filetype, df.filesize, df.md5sum from desfile df, file_archive_info fai where df.id=fai.desfile_id and df.pfw_attempt_id={self.get_named_bind_string('pfw_attempt_id')} and fai.archive_name={self.get_named_bind_string('archive_name')}"
+        if miscutils.fwdebug_check(3, 'PFWDB_DEBUG'):
+            miscutils.fwdebug_print(f"sql> {sql}")
         curs = self.cursor()
+        curs.execute(sql, {'pfw_attempt_id': pfw_attempt_id, 'archive_name': archive})
+        desc = [d[0].lower() for d in curs.description]
+        files = [dict(zip(desc, line)) for line in curs]
+        curs.close()
+        return files
+
 
+    def get_fail_log_fullnames(self, pfw_attempt_id, archive):
         if archive is not None:
-            sqlstr = f"select a.root, fai.path, fai.filename from ops_archive a, task t, pfw_wrapper w, file_archive_info fai where w.log=fai.filename and a.name = {self.get_named_bind_string('archive_name')} and fai.archive_name={self.get_named_bind_string('archive_name')} and pfw_attempt_id={self.get_named_bind_string('pfw_attempt_id')} and w.task_id=t.id and (t.status is null or t.status != 0)"
-            curs.execute(sqlstr, {'archive_name': archive, 'pfw_attempt_id': pfw_attempt_id})
+            curs = self.execute_stmt('get_fail_log_fullnames', {'archive_name': archive, 'pfw_attempt_id': pfw_attempt_id})
         else:
-            sqlstr = f"select 'NO-HOME-ARCHIVE-ROOT', fai.path, fai.filename from task t, pfw_wrapper w, file_archive_info fai where w.log=fai.filename and pfw_attempt_id={self.get_named_bind_string('pfw_attempt_id')} and w.task_id=t.id and (t.status is null or t.status != 0)"
-            curs.execute(sqlstr, {'pfw_attempt_id': pfw_attempt_id})
+            curs = self.execute_stmt('get_fail_log_fullnames.noarchive', {'pfw_attempt_id': pfw_attempt_id})
 
         results = curs.fetchall()
-        curs.close()
 
         logfullnames = {}
         for x in results:
@@ -992,17 +1459,12 @@ class PFWDB(desdmdbi.DesDmDbi):
         return logfullnames
 
     def get_log_fullnames(self, pfw_attempt_id, archive):
-        curs = self.cursor()
-
         if archive is not None:
-            sqlstr = f"select a.root, fai.path, fai.filename from ops_archive a, pfw_wrapper w, file_archive_info fai where w.log=fai.filename and a.name = {self.get_named_bind_string('archive_name')} and fai.archive_name={self.get_named_bind_string('archive_name')} and w.pfw_attempt_id={self.get_named_bind_string('pfw_attempt_id')}"
-            curs.execute(sqlstr, {'archive_name': archive, 'pfw_attempt_id' :pfw_attempt_id})
+            curs = self.execute_stmt('get_log_fullnames', {'archive_name': archive, 'pfw_attempt_id': pfw_attempt_id})
         else:
-            sqlstr = f"select 'NO-HOME-ARCHIVE-ROOT', fai.path, fai.filename from pfw_wrapper w, file_archive_info fai where w.log=fai.filename and w.pfw_attempt_id={self.get_named_bind_string('pfw_attempt_id')}"
-            curs.execute(sqlstr, {'pfw_attempt_id': pfw_attempt_id})
+            curs = self.execute_stmt('get_log_fullnames.noarchive', {'pfw_attempt_id': pfw_attempt_id})
 
         results = curs.fetchall()
-        curs.close()
 
         logfullnames = {}
         for x in results:
@@ -1012,12 +1474,11 @@ class PFWDB(desdmdbi.DesDmDbi):
 
     def check_files(self, config, filelist):
         missingfiles = []
-        curs = self.cursor()
         home_archive = config.getfull('home_archive')
 
         gtt = self.load_filename_gtt(filelist)
 
-        curs.execute(f"select filename, compression from {gtt} gtt where not exists (select df.filename,df.compression from desfile df, file_archive_info fai where gtt.filename=df.filename and nullcmp(gtt.compression, df.compression)=1 and df.id=fai.desfile_id and fai.archive_name='{home_archive}')")
+        curs = self.execute_stmt('check_files', {'archive_name': home_archive}, tables={'gtt': gtt})
 
         results = curs.fetchall()
         for res in results:
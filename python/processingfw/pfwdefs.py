@@ -178,3 +178,14 @@ PF_VERIFY_FILES = 'verify_files'
 PFWDB_MSG_ERROR = 1
 PFWDB_MSG_WARN = 2
 PFWDB_MSG_INFO = 3
+
+DB_PROV_USED_TABLE = 'opm_used'
+DB_PROV_WDF_TABLE = 'opm_was_derived_from'
+# global temporary tables (on commit delete rows) staging provenance edges
+#   gtt_opm_used (task_id, filename, compression)
+#   gtt_opm_wdf (parent_filename, parent_compression, child_filename, child_compression)
+DB_PROV_USED_GTT = 'gtt_opm_used'
+DB_PROV_WDF_GTT = 'gtt_opm_wdf'
+DB_PROV_BATCH_SIZE = 5000
+DB_TASK_SEQ = 'task_seq'
+DB_JOB_BATCH_SIZE = 1000
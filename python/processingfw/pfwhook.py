@@ -0,0 +1,150 @@
+# pylint: disable=print-statement
+
+""" Runtime shared by the DAG hook scripts (jobpre, jobpost, logpre, logpost)
+
+    A HookRuntime owns the hook's log file and its DB connection:
+
+    * the log is opened once under a temporary name and renamed in place
+      once the real name is known (no close/reopen when not using QCF)
+    * the DB connection is only made the first time something needs it
+    * pfw_messages are queued and written with one array insert when the
+      hook closes or MSG_FLUSH_SIZE of them are waiting
+"""
+
+import os
+import sys
+import time
+import traceback
+
+import despymisc.miscutils as miscutils
+import processingfw.pfwdefs as pfwdefs
+import processingfw.pfwhookpool as pfwhookpool
+from qcframework import Messaging
+
+MSG_FLUSH_SIZE = 100   # queued pfw_messages written before the hook closes
+
+class HookRuntime:
+    """ Log and DB channel for a single hook execution """
+
+    def __init__(self, progname, tmplog, qcf_own_db=False):
+        self.starttime = time.time()
+        self.progname = progname
+        self.qcf_own_db = qcf_own_db   # QCF makes its own DB connection when hook isn't using DB
+        self.config = None
+        self.logname = os.path.abspath(tmplog)
+        self.logfh = open(self.logname, 'w')
+        self.outorig = sys.stdout
+        self.errorig = sys.stderr
+        self._dbh = None
+        self.messages = []
+        self.closed = False
+        self._redirect()
+
+    def _redirect(self):
+        """ Send stdout/stderr to the current log handle """
+        sys.stdout = self.logfh
+        sys.stderr = self.logfh
+
+    def _restore(self):
+        """ Send stdout/stderr back to where they were """
+        sys.stdout = self.outorig
+        sys.stderr = self.errorig
+
+    def use_db(self):
+        """ Whether the hook should write to the DB """
+        return (self.config is not None and
+                miscutils.convertBool(self.config.getfull(pfwdefs.PF_USE_DB_OUT)))
+
+    @property
+    def dbh(self):
+        """ DB connection, made the first time it is asked for (None if not using DB) """
+        if self._dbh is None and self.use_db():
+            if self.config.dbh is not None:
+                self._dbh = self.config.dbh
+            else:
+                # only hooks that need the DB pay for importing the DB modules
+                import processingfw.pfwdb as pfwdb
+                dbstart = time.time()
+                self._dbh = pfwdb.PFWDB(self.config.getfull('submit_des_services'),
+                                        self.config.getfull('submit_des_db_section'))
+                pfwhookpool.record_db_latency(time.time() - dbstart)
+        return self._dbh
+
+    def set_log_name(self, config, new_log_name):
+        """ Rename the temporary log to its real name and keep writing to it
+
+            If the run uses QCF, the rest of the output goes through a
+            Messaging object appending to the renamed log.
+        """
+        self.config = config
+        self.logfh.flush()
+        os.chmod(self.logname, 0o666)
+        os.rename(self.logname, new_log_name)
+        self.logname = new_log_name
+
+        if 'use_qcf' in config and config['use_qcf']:
+            self.logfh.close()
+            dbh = self.dbh
+            if dbh is None and self.qcf_own_db:
+                if 'submit_des_services' in config:
+                    os.environ['DES_SERVICES'] = config.getfull('submit_des_services')
+                os.environ['DES_DB_SECTION'] = config.getfull('submit_des_db_section')
+                self.logfh = Messaging.Messaging(new_log_name, f"{self.progname}.py",
+                                                 config['pfw_attempt_id'], mode='a+')
+            else:
+                self.logfh = Messaging.Messaging(new_log_name, f"{self.progname}.py", config['pfw_attempt_id'],
+                                                 dbh=dbh, mode='a+', usedb=dbh is not None)
+            self._redirect()
+        print(f"DESDMTIME: {self.progname}_startup {time.time()-self.starttime:0.3f}")
+
+    def message(self, task_id, msg, msglvl, *fileinfo):
+        """ Queue a pfw_message (args as Messaging.pfw_message)
+
+            Queued messages are written when the hook closes or, once the
+            hook knows its config, when MSG_FLUSH_SIZE are waiting so a
+            killed hook only loses the last few.
+        """
+        self.messages.append((task_id, msg, msglvl) + fileinfo)
+        if len(self.messages) >= MSG_FLUSH_SIZE and self.config is not None:
+            self.flush_messages()
+
+    def flush_messages(self):
+        """ Write queued pfw_messages, warning instead of failing if the DB is unavailable
+
+            All are inserted together with one commit.   If that fails they
+            are written one at a time so one bad message doesn't drop the rest.
+        """
+        if self.messages and self.dbh is not None:
+            try:
+                self.dbh.insert_task_messages(self.config['pfw_attempt_id'], self.messages)
+            except Exception:
+                miscutils.fwdebug_print(f"Warning: could not write {len(self.messages)} messages to database together, writing one at a time")
+                try:
+                    self.dbh.rollback()
+                except Exception:
+                    pass
+                for msgargs in self.messages:
+                    try:
+                        Messaging.pfw_message(self.dbh, self.config['pfw_attempt_id'], *msgargs)
+                    except Exception:
+                        miscutils.fwdebug_print(f"Warning: could not write message to database: {msgargs[1]}")
+        self.messages = []
+
+    def close(self):
+        """ Flush queued messages, close the log and restore stdout/stderr """
+        self.flush_messages()
+        if self._dbh is not None:
+            self._dbh.print_stmt_stats()
+        self.logfh.close()
+        self._restore()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trback):
+        if not self.closed:
+            if exc_type is not None:
+                # keep the error in the hook's log, queued messages are still written
+                traceback.print_exception(exc_type, exc_value, trback, file=self.logfh)
+            self.close()
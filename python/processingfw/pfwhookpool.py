@@ -0,0 +1,154 @@
+# pylint: disable=print-statement
+
+""" Limit how many DAG hook scripts (jobpost, blockpost) run at once
+
+    Each pool is a directory of slot files.  A hook holds a slot by keeping
+    an exclusive flock on one of the files, so slots are freed automatically
+    if the hook dies.  Separate pools keep DB-heavy hooks from queueing
+    behind filesystem-heavy ones.
+
+    The DB pool shrinks its effective limit when hooks report slow DB
+    responses (see record_db_latency) and grows back as they speed up.
+    Time spent waiting for a slot is printed and appended to the pool's
+    wait log.
+"""
+
+import fcntl
+import math
+import os
+import time
+
+POOLDIR_ENV = 'PFW_HOOK_POOLDIR'
+LATENCY_FILE = 'db_latency'
+WAITLOG_FILE = 'wait.log'
+LATENCY_WEIGHT = 0.2     # weight of newest sample in moving average
+
+DEF_POOLDIR = os.path.join(os.path.expanduser('~'), '.desprocessingfw', 'hookpools')
+DEF_LIMIT = 20
+DEF_MIN_LIMIT = 2
+DEF_TARGET_LATENCY = 2.0   # secs
+
+#######################################################################
+def read_db_latency(pooldir):
+    """ Return moving average of reported DB latency for pool (None if unknown) """
+    try:
+        with open(os.path.join(pooldir, LATENCY_FILE), 'r') as latfh:
+            return float(latfh.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+#######################################################################
+def record_db_latency(secs, pooldir=None):
+    """ Add a DB latency sample to the moving average used for adaptive limits
+
+        Hooks call this (e.g., with the time it took to connect to the DB).
+        Does nothing if not running under a hook pool.
+    """
+    if pooldir is None:
+        pooldir = os.environ.get(POOLDIR_ENV)
+    if not pooldir or not os.path.isdir(pooldir):
+        return
+
+    latfile = os.path.join(pooldir, LATENCY_FILE)
+    with open(f"{latfile}.lock", 'a') as lockfh:
+        fcntl.flock(lockfh, fcntl.LOCK_EX)
+        avg = read_db_latency(pooldir)
+        avg = secs if avg is None else (1 - LATENCY_WEIGHT) * avg + LATENCY_WEIGHT * secs
+        tmpfile = f"{latfile}.{os.getpid()}"
+        with open(tmpfile, 'w') as latfh:
+            latfh.write(f"{avg:0.4f}\n")
+        os.replace(tmpfile, latfile)
+
+
+#######################################################################
+def effective_limit(limit, latency, target_latency=DEF_TARGET_LATENCY,
+                    min_limit=DEF_MIN_LIMIT):
+    """ Scale limit down proportionally when latency is above target """
+    if latency is None or latency <= target_latency:
+        return limit
+    return max(min(min_limit, limit), int(limit / math.ceil(latency / target_latency)))
+
+
+#######################################################################
+class HookPool:
+    """ Named pool of slots shared by hook processes on this machine """
+
+    def __init__(self, pooldir, name, limit=DEF_LIMIT, adaptive=False,
+                 target_latency=DEF_TARGET_LATENCY, min_limit=DEF_MIN_LIMIT):
+        self.pooldir = os.path.join(pooldir, name)
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.min_limit = min_limit
+        self.slotfh = None
+        self.waittime = 0
+        os.makedirs(self.pooldir, exist_ok=True)
+
+    def current_limit(self):
+        """ Number of slots hooks may currently use """
+        if not self.adaptive:
+            return self.limit
+        return effective_limit(self.limit, read_db_latency(self.pooldir),
+                               self.target_latency, self.min_limit)
+
+    def _try_slots(self, limit):
+        """ Try to lock one of the first limit slots, returning open fh or None """
+        for i in range(limit):
+            slotfh = open(os.path.join(self.pooldir, f"slot{i:03d}"), 'a')
+            try:
+                fcntl.flock(slotfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                slotfh.close()
+                continue
+            return slotfh
+        return None
+
+    def acquire(self, maxsleep=10.0):
+        """ Block until a slot is free """
+        starttime = time.time()
+        sleeptime = 0.1
+        while True:
+            self.slotfh = self._try_slots(self.current_limit())
+            if self.slotfh is not None:
+                break
+            time.sleep(sleeptime)
+            sleeptime = min(sleeptime * 2, maxsleep)
+        self.waittime = time.time() - starttime
+
+        with open(os.path.join(self.pooldir, WAITLOG_FILE), 'ab') as waitfh:
+            waitfh.write(f"{time.time():0.0f} {os.getpid()} {self.waittime:0.3f}\n".encode('utf-8'))
+        return self.waittime
+
+    def release(self):
+        """ Give the slot back """
+        if self.slotfh is not None:
+            fcntl.flock(self.slotfh, fcntl.LOCK_UN)
+            self.slotfh.close()
+            self.slotfh = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+#######################################################################
+def get_hook_prefix(config, hookname, defpool):
+    """ Return command prefix that runs hookname inside its configured pool
+
+        WCL: hookpool_<hookname> picks the pool (default defpool),
+        hookpool_limit_<pool> its size, hookpool_dir where pools live.
+        The db pool adapts its limit using hookpool_target_latency.
+    """
+    pool = config.getfull(f"hookpool_{hookname}", default=defpool)
+    limit = config.getfull(f"hookpool_limit_{pool}", default=DEF_LIMIT)
+    pooldir = config.getfull('hookpool_dir', default=DEF_POOLDIR)
+    prefix = f"{config.getfull('processingfw_dir')}/libexec/runhook.py --pool {pool} --limit {limit} --pooldir {pooldir}"
+    if pool == 'db':
+        target = config.getfull('hookpool_target_latency', default=DEF_TARGET_LATENCY)
+        prefix += f" --adaptive --target_latency {target}"
+    return prefix + " --"
@@ -5,11 +5,30 @@
 
 # pylint: disable=print-statement
 
-""" Functions that handle a processing framework execution event """
+""" Functions that handle a processing framework execution event
 
+    Each event is written as a single record with a single append so
+    concurrent hooks cannot interleave partial lines.  If the run has
+    deslog_collector turned on, hooks instead send the record to a local
+    collector process (see run_collector) which batches them into buffered
+    appends.  If the collector isn't reachable the hook falls back to
+    appending the record itself.
+"""
+
+import hashlib
 import os
+import socket
+import subprocess
+import sys
 import time
 
+import despymisc.miscutils as miscutils
+
+COLLECTOR_STOP = b'__STOP__'
+COLLECTOR_MAXMSG = 65536
+COLLECTOR_STARTUP_WAIT = 5.0    # secs to wait for collector socket to appear
+COLLECTOR_STOP_TIMEOUT = 5.0    # secs to wait to hand collector the stop message
+
 #######################################################################
 def get_timestamp():
     """Create timestamp in a particular format"""
@@ -18,39 +37,186 @@ def get_timestamp():
 
 
 #######################################################################
-def log_pfw_event(config, block=None, subblock=None,
-                  subblocktype=None, info=None):
-    """Write info for a PFW event to a log file"""
-    if block:
-        block = block.replace('"', '')
-    else:
-        block = ''
+def get_deslog_names(config):
+    """ Return the deslog filename and the collector socket name for the run
 
-    if subblock:
-        subblock = subblock.replace('"', '')
-    else:
-        subblock = ''
+        The socket lives in a short per-user dir and is named by a hash of
+        the deslog path since AF_UNIX paths are limited to ~107 bytes.
+    """
+    logfile = f"{config.getfull('uberctrl_dir')}/{config.getfull('submit_run')}.deslog"
+    loghash = hashlib.sha1(os.path.abspath(logfile).encode('utf-8')).hexdigest()[:20]
+    return logfile, f"/tmp/pfwlog_{os.getuid()}/{loghash}.sock"
+
+
+#######################################################################
+def use_collector(config):
+    """ Whether events should be sent to the collector process """
+    return 'deslog_collector' in config and \
+           miscutils.convertBool(config.getfull('deslog_collector'))
 
-    if subblocktype:
-        subblocktype = subblocktype.replace('"', '')
-    else:
-        subblocktype = ''
+
+#######################################################################
+def format_event(config, block=None, subblock=None,
+                 subblocktype=None, info=None):
+    """ Create the full deslog record (including newline) for an event """
+    block = block.replace('"', '') if block else ''
+    subblock = subblock.replace('"', '') if subblock else ''
+    subblocktype = subblocktype.replace('"', '') if subblocktype else ''
 
     runsite = config.getfull('run_site')
     run = config.getfull('submit_run')
-    logdir = config.getfull('uberctrl_dir')
 
     dagid = os.getenv('CONDOR_ID')
     if not dagid:
         dagid = 0
 
-    deslogfh = open(f"{logdir}/{run}.deslog", "ab", 0)
-    deslogfh.write(f"{get_timestamp()} {dagid} {run} {runsite} {block} {subblocktype} {subblock}".encode('utf-8'))
+    record = f"{get_timestamp()} {dagid} {run} {runsite} {block} {subblocktype} {subblock}"
     if isinstance(info, list):
         for col in info:
-            deslogfh.write(f",{col}".encode('utf-8'))
+            record += f",{col}"
+    else:
+        record += f",{info}"
+    record += "\n"
+    return record.encode('utf-8')
+
+
+#######################################################################
+def append_record(logfile, record):
+    """ Append bytes to the log file with a single write call """
+    logfd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(logfd, record)
+    finally:
+        os.close(logfd)
+
+
+#######################################################################
+def send_to_collector(sockname, record, timeout=0):
+    """ Send a record to the collector, returning whether it was accepted
+
+        By default doesn't wait if the collector's queue is full so a busy
+        collector never blocks the hook (it appends the record itself).
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(record, sockname)
+    except OSError:
+        return False
+    return True
+
+
+#######################################################################
+def log_pfw_event(config, block=None, subblock=None,
+                  subblocktype=None, info=None):
+    """Write info for a PFW event to a log file"""
+    starttime = time.time()
+    record = format_event(config, block, subblock, subblocktype, info)
+    logfile, sockname = get_deslog_names(config)
+
+    how = 'append'
+    if use_collector(config) and len(record) < COLLECTOR_MAXMSG and \
+       send_to_collector(sockname, record):
+        how = 'collector'
     else:
-        deslogfh.write(f",{info}".encode('utf-8'))
+        append_record(logfile, record)
+
+    if miscutils.fwdebug_check(3, 'PFWLOG_DEBUG'):
+        miscutils.fwdebug_print(f"event write latency ({how}) = {time.time()-starttime:0.6f} secs")
+
+
+#######################################################################
+def run_collector(sockname, logfile, flush_interval=2.0, flush_bytes=65536,
+                  idle_timeout=86400):
+    """ Receive event records on a local socket and append them in batches
+
+        Buffered records are appended when flush_bytes have accumulated or
+        flush_interval seconds have passed.   Stops on a COLLECTOR_STOP
+        message or after idle_timeout seconds without any events.
+    """
+    os.makedirs(os.path.dirname(sockname), mode=0o700, exist_ok=True)
+    if os.path.exists(sockname):
+        os.unlink(sockname)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(sockname)
+    buf = []
+    bufsize = 0
+    numevents = 0
+    lastflush = lastevent = time.time()
+    try:
+        while True:
+            sock.settimeout(flush_interval)
+            try:
+                msg = sock.recv(COLLECTOR_MAXMSG)
+            except socket.timeout:
+                msg = None
+
+            now = time.time()
+            if msg == COLLECTOR_STOP:
+                break
+            if msg:
+                buf.append(msg)
+                bufsize += len(msg)
+                numevents += 1
+                lastevent = now
+
+            if buf and (bufsize >= flush_bytes or now - lastflush >= flush_interval):
+                append_record(logfile, b''.join(buf))
+                buf = []
+                bufsize = 0
+                lastflush = now
+            elif not buf and now - lastevent > idle_timeout:
+                break
+    finally:
+        # stop taking events before final flush so late hooks append themselves
+        sock.close()
+        if os.path.exists(sockname):
+            os.unlink(sockname)
+        if buf:
+            append_record(logfile, b''.join(buf))
+    return numevents
+
+
+#######################################################################
+def start_collector(config):
+    """ Start the collector in the background if requested for the run """
+    if not use_collector(config):
+        return None
+
+    logfile, sockname = get_deslog_names(config)
+    errfile = f"{logfile}.collector.err"
+    cmd = [sys.executable, '-m', 'processingfw.pfwlog', sockname, logfile]
+    miscutils.fwdebug_print(f"Starting deslog collector: {' '.join(cmd)}")
+    if os.path.exists(sockname):
+        os.unlink(sockname)   # left by an earlier collector, don't mistake it for this one
+    with open(os.devnull, 'r+') as devnull, open(errfile, 'w') as errfh:
+        proc = subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=errfh,
+                                start_new_session=True)
+
+    # make sure it is listening, else hooks silently pay for failed sends
+    waited = 0
+    while not os.path.exists(sockname) and proc.poll() is None and waited < COLLECTOR_STARTUP_WAIT:
+        time.sleep(0.1)
+        waited += 0.1
+    if not os.path.exists(sockname):
+        print(f"Warning: deslog collector did not start (see {errfile}).  Hooks will append to {logfile} directly.")
+        if proc.poll() is None:
+            proc.kill()
+        return None
+    return proc.pid
+
+
+#######################################################################
+def stop_collector(config):
+    """ Tell the collector (if any) to flush and exit """
+    if use_collector(config):
+        _, sockname = get_deslog_names(config)
+        send_to_collector(sockname, COLLECTOR_STOP, COLLECTOR_STOP_TIMEOUT)
+
 
-    deslogfh.write("\n".encode('utf-8'))
-    deslogfh.close()
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: pfwlog.py sockname logfile")
+        sys.exit(1)
+    run_collector(sys.argv[1], sys.argv[2])
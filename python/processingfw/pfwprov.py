@@ -0,0 +1,104 @@
+"""
+    Accumulate provenance for a job so it can be written to the DB in bulk
+
+    Wrappers and the compression step hand their provenance sections to a
+    ProvAccumulator instead of ingesting them row by row.  Edges are kept
+    in sets so duplicates (e.g., the same input used by many execs of the
+    same task) are only written once.  The job flushes them via
+    PFWDB.ingest_provenance_bulk whenever enough have accumulated and at
+    the end of the job.
+"""
+
+import despymisc.miscutils as miscutils
+import despymisc.provdefs as provdefs
+
+
+class ProvAccumulator:
+    """ Deduplicating in-memory store of provenance edges
+
+        used edges are (task_id, filename, compression)
+        was_derived_from edges are (parent_filename, parent_compression,
+                                    child_filename, child_compression)
+    """
+
+    def __init__(self):
+        self.used = set()
+        self.wdf = set()
+
+    def __len__(self):
+        return len(self.used) + len(self.wdf)
+
+    @staticmethod
+    def _fullname(fname, comp):
+        """ Join filename and compression as ingest_provenance_bulk reports them """
+        return fname if comp is None else fname + comp
+
+    @staticmethod
+    def _split(fullnames):
+        """ Split a provenance file list into (filename, compression) tuples """
+        parsemask = miscutils.CU_PARSE_FILENAME | miscutils.CU_PARSE_COMPRESSION
+        return [miscutils.parse_fullname(fname, parsemask)
+                for fname in miscutils.fwsplit(fullnames, provdefs.PROV_DELIM)]
+
+    def add(self, prov, execids):
+        """ Add the used and was_derived_from edges from a provenance section
+
+            Returns a dict of any other provenance sections which the caller
+            must still ingest
+        """
+        leftover = {}
+        for sect, sectinfo in prov.items():
+            if sect.lower() == provdefs.PROV_USED.lower():
+                for execname, fullnames in sectinfo.items():
+                    task_id = execids[execname]
+                    for (fname, comp) in self._split(fullnames):
+                        self.used.add((task_id, fname, comp))
+            elif sect.lower() == provdefs.PROV_WDF.lower():
+                for pair in sectinfo.values():
+                    parents = self._split(pair[provdefs.PROV_PARENTS])
+                    children = self._split(pair[provdefs.PROV_CHILDREN])
+                    for (pname, pcomp) in parents:
+                        for (cname, ccomp) in children:
+                            self.wdf.add((pname, pcomp, cname, ccomp))
+            else:
+                leftover[sect] = sectinfo
+        return leftover
+
+    def merge(self, other):
+        """ Merge edges accumulated elsewhere (e.g., in a fw thread) """
+        if other is not None:
+            self.used |= other.used
+            self.wdf |= other.wdf
+
+    def take(self):
+        """ Move all edges into a new accumulator, leaving this one empty """
+        taken = ProvAccumulator()
+        taken.used, self.used = self.used, set()
+        taken.wdf, self.wdf = self.wdf, set()
+        return taken
+
+    def flush(self, dbh):
+        """ Write all accumulated edges to the DB and empty the accumulator
+
+            Edges referring to files not (yet) in desfile are kept so a
+            later flush can retry them.   If the DB write fails all edges
+            are kept.
+
+            Returns (number of used rows inserted, number of wdf rows inserted,
+                     fullnames of files not in desfile whose edges were kept)
+        """
+        if miscutils.fwdebug_check(3, 'PFWPROV_DEBUG'):
+            miscutils.fwdebug_print(f"BEG used={len(self.used)} wdf={len(self.wdf)}")
+
+        counts = (0, 0, [])
+        if self.used or self.wdf:
+            counts = dbh.ingest_provenance_bulk(self.used, self.wdf)
+        missing = set(counts[2])
+        self.used = {(task_id, fname, comp) for (task_id, fname, comp) in self.used
+                     if self._fullname(fname, comp) in missing}
+        self.wdf = {(pname, pcomp, cname, ccomp) for (pname, pcomp, cname, ccomp) in self.wdf
+                    if self._fullname(pname, pcomp) in missing or self._fullname(cname, ccomp) in missing}
+
+        if miscutils.fwdebug_check(3, 'PFWPROV_DEBUG'):
+            miscutils.fwdebug_print(f"END inserted used={counts[0]} wdf={counts[1]} missing files={len(counts[2])}")
+        return counts
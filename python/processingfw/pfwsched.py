@@ -0,0 +1,93 @@
+"""
+    Schedule the wrappers of a parallel group by their resource hints
+
+    Wrappers may give wrap_expected_secs, wrap_ncpu and wrap_mem_mb in their
+    wcl.  job_workflow asks WrapperScheduler for the next wrapper to hand to
+    the pool whenever it polls, so wrappers start as resources free up
+    instead of all being queued at once.
+"""
+
+import os
+import psutil
+
+
+class WrapperScheduler:
+    """ Decide which wrapper of a parallel group to start next and when
+
+        Wrappers are ordered longest-expected-first (wrap_expected_secs hint,
+        ties in wrapnum order).  A wrapper is started only if the number
+        running is below fw_nthread and, when others are already running,
+        its wrap_ncpu hint fits in the cpus this job may use (its cpu
+        affinity, i.e., the batch slot, not the whole host) and its
+        wrap_mem_mb hint, if given, fits in current free memory.  The host
+        load average is only checked if a max_load is given.  The first
+        pending wrapper that fits is started so small wrappers can fill
+        gaps left by large ones.
+
+        ncpu overrides the cpus available (e.g., for simulations).
+    """
+    def __init__(self, wrapnums, hints, nproc, mem_reserve_mb=500, max_load=None, ncpu=None):
+        self.hints = hints
+        self.pending = sorted(wrapnums, key=lambda w: (-self.hint(w, 'secs'), int(w)))
+        self.started = []
+        self.nproc = nproc
+        self.ncpu = ncpu
+        if self.ncpu is None:
+            try:
+                self.ncpu = len(os.sched_getaffinity(0))
+            except AttributeError:   # not available on all platforms
+                self.ncpu = psutil.cpu_count() or 1
+        self.mem_reserve_mb = mem_reserve_mb
+        self.max_load = max_load
+        self.waits = 0
+
+    def hint(self, wrapnum, name):
+        """ Return resource hint for wrapper (0 if not given) """
+        return self.hints.get(wrapnum, {}).get(name) or 0
+
+    def running(self, unfinished):
+        """ Wrappers started but not yet finished """
+        return [w for w in self.started if w in unfinished]
+
+    def next_wrapper(self, unfinished):
+        """ Return the next wrapper to start now, or None if must wait """
+        if not self.pending:
+            return None
+        running = self.running(unfinished)
+        if len(running) >= self.nproc:
+            return None
+
+        if not running:   # always make progress
+            wrapnum = self.pending.pop(0)
+            self.started.append(wrapnum)
+            return wrapnum
+
+        if self.max_load is not None and os.getloadavg()[0] >= self.max_load * self.ncpu:
+            self.waits += 1
+            return None
+        freecpu = self.ncpu - sum([max(1, self.hint(w, 'ncpu')) for w in running])
+        freemem = None
+        for i, wrapnum in enumerate(self.pending):
+            if max(1, self.hint(wrapnum, 'ncpu')) > freecpu:
+                continue
+            if self.hint(wrapnum, 'mem'):
+                if freemem is None:
+                    freemem = psutil.virtual_memory().available / (1024 * 1024) - self.mem_reserve_mb
+                if self.hint(wrapnum, 'mem') > freemem:
+                    continue
+            del self.pending[i]
+            self.started.append(wrapnum)
+            return wrapnum
+        self.waits += 1
+        return None
+
+
+######################################################################
+def get_wrapper_hints(wcl):
+    """ Get the scheduling hints (all optional) from a wrapper's wcl """
+    hints = {}
+    for name, key in [('secs', 'wrap_expected_secs'), ('ncpu', 'wrap_ncpu'), ('mem', 'wrap_mem_mb')]:
+        val = wcl.getfull(key, default=None)
+        if val is not None:
+            hints[name] = float(val)
+    return hints
@@ -17,6 +17,7 @@ import intgutils.intgdefs as intgdefs
 import despymisc.miscutils as miscutils
 import processingfw.pfwdefs as pfwdefs
 import processingfw.pfwcondor as pfwcondor
+import processingfw.pfwhookpool as pfwhookpool
 import processingfw.pfwlog as pfwlog
 
 
@@ -204,8 +205,7 @@ SCRIPT post {cjobname} {blockdir}/blockpost.sh $RETURN
 
         with open(f"{blockdir}/blockpost.sh", 'w') as bpostfh:
             bpostfh.write("#!/usr/bin/env sh\n")
-            bpostfh.write("sem --record-env\n")
-            bpostfh.write(f"sem --fg --id blockpost -j 20 {pfwdir}/libexec/blockpost.py ../uberctrl/config.des $1\n")
+            bpostfh.write(f"{pfwhookpool.get_hook_prefix(config, 'blockpost', 'fs')} {pfwdir}/libexec/blockpost.py ../uberctrl/config.des $1\n")
         os.chmod(f"{blockdir}/blockpost.sh", stat.S_IRWXU | stat.S_IRWXG)
 
     dagfh.write(f"""
@@ -13,7 +13,11 @@ import tarfile
 import errno
 import subprocess
 import shlex
+import selectors
 import time
+import gzip
+import queue
+import threading
 
 import despymisc.miscutils as miscutils
 import processingfw.pfwdefs as pfwdefs
@@ -121,6 +125,94 @@ def tar_list(tarfilename, filelist):
 
 
 
+#######################################################################
+class _CompressPipe:
+    """ File-like object handing tar stream chunks to a compression thread """
+    def __init__(self, outfilename, maxchunks=64):
+        self.chunks = queue.Queue(maxsize=maxchunks)
+        self.error = None
+        self.thread = threading.Thread(target=self._compress, args=(outfilename,), daemon=True)
+        self.thread.start()
+
+    def _compress(self, outfilename):
+        try:
+            with gzip.open(outfilename, 'wb') as gzfh:
+                chunk = self.chunks.get()
+                while chunk is not None:
+                    gzfh.write(chunk)
+                    chunk = self.chunks.get()
+        except Exception as exc:
+            self.error = exc
+            # keep draining so the writer never blocks
+            while self.chunks.get() is not None:
+                pass
+
+    def write(self, data):
+        """ Queue a chunk for compression """
+        if self.error is not None:
+            raise self.error
+        self.chunks.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        """ Wait for compression thread to finish """
+        self.chunks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+#######################################################################
+def tar_stream(tarfilename, fileiter, maxbytes=None, compress_thread=True):
+    """ Tars files as fileiter produces them
+
+        Members are written as soon as they are produced so the full list of
+        files is never held in memory.  If the tarball ends in .gz and
+        compress_thread is True, the compression runs in a separate thread.
+        Stops adding files once maxbytes of file data have been added.
+
+        Returns (number of files, bytes of file data, whether the cap stopped it)
+    """
+    numfiles = 0
+    numbytes = 0
+    truncated = False
+
+    pipe = None
+    if tarfilename.endswith('.gz') and compress_thread:
+        pipe = _CompressPipe(tarfilename)
+        tar = tarfile.open(fileobj=pipe, mode='w|')
+    elif tarfilename.endswith('.gz'):
+        tar = tarfile.open(tarfilename, 'w:gz')
+    else:
+        tar = tarfile.open(tarfilename, 'w')
+
+    try:
+        for filen in fileiter:
+            # one lstat per member, reused for both the size cap and the header
+            tinfo = tar.gettarinfo(filen)
+            if tinfo is None:   # sockets, etc. can't be tarred
+                continue
+            if maxbytes is not None and numbytes + tinfo.size > maxbytes:
+                truncated = True
+                break
+            if tinfo.isreg():
+                with open(filen, 'rb') as memberfh:
+                    tar.addfile(tinfo, memberfh)
+            else:
+                tar.addfile(tinfo)
+            numfiles += 1
+            numbytes += tinfo.size
+    finally:
+        try:
+            tar.close()
+        finally:
+            # always stop the compression thread, even if tar.close() failed
+            if pipe is not None:
+                pipe.close()
+
+    return numfiles, numbytes, truncated
+
+
 #######################################################################
 def untar_dir(filename, outputdir):
     """ Untars a directory """
@@ -214,10 +306,18 @@ def get_version(execname, execdefs):
 
 
 ############################################################################
-def run_cmd_qcf(cmd, logfilename, wid, execnames, use_qcf=False, dbh=None, pfwattid=0, patterns={}, threaded=False):
-    """ Execute the command piping stdout/stderr to log and QCF """
+def run_cmd_qcf(cmd, logfilename, wid, execnames, use_qcf=False, dbh=None, pfwattid=0, patterns={}, threaded=False,
+                stats=None):
+    """ Execute the command piping stdout/stderr to log and QCF
+
+        Blocks in a selector until the command writes output (or closes its
+        output at exit) instead of polling, so exit detection carries no fixed
+        sleep.  The DB keepalive runs on its own deadline.  If stats is a dict,
+        it is filled with bytes_read, walltime and waittime (secs blocked
+        waiting for output).
+    """
     bufsize = 1024 * 10
-    lasttime = time.time()
+    keepalive = 30. * 60.
     if miscutils.fwdebug_check(3, "PFWUTILS_DEBUG"):
         miscutils.fwdebug_print("BEG")
         miscutils.fwdebug_print(f"working dir = {os.getcwd()}")
@@ -230,6 +330,7 @@ def run_cmd_qcf(cmd, logfilename, wid, execnames, use_qcf=False, dbh=None, pfwat
     use_qcf = miscutils.convertBool(use_qcf)
 
     sys.stdout.flush()
+    starttime = time.time()
     try:
         messaging = Messaging.Messaging(logfilename, execnames, pfwattid=pfwattid, taskid=wid,
                                         dbh=dbh, usedb=use_qcf, qcf_patterns=patterns, threaded=threaded)
@@ -248,30 +349,56 @@ def run_cmd_qcf(cmd, logfilename, wid, execnames, use_qcf=False, dbh=None, pfwat
         print("    and it sets up the path correctly")
         raise
 
+    bytes_read = 0
+    waittime = 0.
+    outfd = process_wrap.stdout.fileno()
+    sel = selectors.DefaultSelector()
     try:
-        buf = os.read(process_wrap.stdout.fileno(), bufsize)
-        while process_wrap.poll() is None or buf:
+        sel.register(outfd, selectors.EVENT_READ)
+        next_ping = time.time() + keepalive
+        eof = False
+        while not eof:
+            timeout = None
             if dbh is not None:
-                now = time.time()
-                if now - lasttime > 30.*60.:
-                    if not dbh.ping():
-                        dbh.reconnect()
-                    lasttime = now
-            messaging.write(buf)
-            #print buf
-            buf = os.read(process_wrap.stdout.fileno(), bufsize)
-            # brief sleep
-            if process_wrap.poll() is None:
-                time.sleep(0.1)
+                timeout = max(0., next_ping - time.time())
+
+            waitstart = time.time()
+            events = sel.select(timeout)
+            waittime += time.time() - waitstart
+
+            if dbh is not None and time.time() >= next_ping:
+                if not dbh.ping():
+                    dbh.reconnect()
+                next_ping = time.time() + keepalive
+
+            if events:
+                # readable with 0 bytes means the command closed its output
+                buf = os.read(outfd, bufsize)
+                if buf:
+                    bytes_read += len(buf)
+                    messaging.write(buf)
+                else:
+                    eof = True
+        process_wrap.wait()
 
     except IOError as exc:
         print(f"\tI/O error({exc.errno}): {exc.strerror}")
+        process_wrap.wait()
 
     except:
         (extype, exvalue, _) = sys.exc_info()
         print(f"\tError: Unexpected error: {extype} - {exvalue}")
         raise
 
+    finally:
+        sel.close()
+
+    walltime = time.time() - starttime
+    if stats is not None:
+        stats.update({'bytes_read': bytes_read,
+                      'walltime': walltime,
+                      'waittime': waittime})
+
     sys.stdout.flush()
     if miscutils.fwdebug_check(3, "PFWUTILS_DEBUG"):
         if process_wrap.returncode != 0:
@@ -279,6 +406,7 @@ def run_cmd_qcf(cmd, logfilename, wid, execnames, use_qcf=False, dbh=None, pfwat
             miscutils.fwdebug_print(f"\tInfo: failed cmd = {cmd}")
         else:
             miscutils.fwdebug_print("\tInfo: cmd exited with exit code = 0")
+        miscutils.fwdebug_print(f"\tInfo: read {bytes_read} bytes, walltime = {walltime:0.3f}, waittime = {waittime:0.3f}")
 
 
     if miscutils.fwdebug_check(3, "PFWUTILS_DEBUG"):
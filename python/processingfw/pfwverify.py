@@ -0,0 +1,147 @@
+# pylint: disable=print-statement
+
+""" Verify files in an archive against their DB entries (size and optionally md5sum)
+
+    Files are checked concurrently by a bounded pool of threads.   Either all
+    files, a random percentage of them or a percentage of each filetype can
+    be checked.   Results are appended to a checkpoint file as they come in
+    so a rerun only checks the files not already done.
+"""
+
+import collections
+import concurrent.futures as futures
+import hashlib
+import os
+import random
+import time
+
+DEF_NTHREADS = 8
+DEF_PERCENT = 10
+SAMPLE_MODES = ['all', 'percent', 'filetype']
+
+#######################################################################
+def get_fullname(finfo):
+    """ Return archive-relative name of file including compression extension """
+    fname = finfo['filename']
+    if finfo.get('compression') is not None:
+        fname += finfo['compression']
+    return os.path.join(finfo['path'], fname)
+
+
+#######################################################################
+def select_sample(files, mode='all', percent=DEF_PERCENT, seed=None):
+    """ Return the files to verify
+
+        mode 'all' returns every file, 'percent' a random percent of them
+        and 'filetype' percent of the files of each filetype (at least one
+        per filetype).   The same seed picks the same files so a rerun
+        resumes the same sample.
+    """
+    if mode not in SAMPLE_MODES:
+        raise ValueError(f"Invalid verify sample mode ({mode}).  Must be one of {','.join(SAMPLE_MODES)}")
+    if mode == 'all' or percent >= 100:
+        return list(files)
+
+    rng = random.Random(seed)
+    files = sorted(files, key=get_fullname)
+    if mode == 'percent':
+        return rng.sample(files, int(round(len(files) * percent / 100.0)))
+
+    byftype = collections.defaultdict(list)
+    for finfo in files:
+        byftype[finfo.get('filetype')].append(finfo)
+    sample = []
+    for ftype in sorted(byftype, key=str):
+        flist = byftype[ftype]
+        sample.extend(rng.sample(flist, max(1, int(round(len(flist) * percent / 100.0)))))
+    return sample
+
+
+#######################################################################
+def verify_file(root, finfo, md5sum=False):
+    """ Compare a single file on disk to its DB entry, returning problem or None """
+    fullname = os.path.join(root, get_fullname(finfo))
+    try:
+        fsize = os.path.getsize(fullname)
+    except OSError:
+        return 'missing'
+
+    if finfo.get('filesize') is not None and fsize != int(finfo['filesize']):
+        return f"size {fsize} != db {finfo['filesize']}"
+
+    if md5sum and finfo.get('md5sum') is not None:
+        fhash = hashlib.md5()
+        try:
+            with open(fullname, 'rb') as infh:
+                for chunk in iter(lambda: infh.read(4*1024*1024), b''):
+                    fhash.update(chunk)
+        except OSError as err:
+            return f"read error ({err})"
+        if fhash.hexdigest() != finfo['md5sum']:
+            return f"md5sum {fhash.hexdigest()} != db {finfo['md5sum']}"
+    return None
+
+
+#######################################################################
+def read_checkpoint(checkpoint):
+    """ Return dict of fullname -> problem ('' if ok) from checkpoint file
+
+        Later lines for a file override earlier ones (e.g., a rerun which
+        rechecked a failed file).
+    """
+    done = {}
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint, 'r') as ckfh:
+            for line in ckfh:
+                parts = line.rstrip('\n').split('\t', 1)
+                if len(parts) == 2:
+                    done[parts[0]] = parts[1]
+    return done
+
+
+#######################################################################
+def verify_files(files, root, md5sum=False, nthreads=DEF_NTHREADS, checkpoint=None):
+    """ Verify files with a pool of threads
+
+        Returns dict of fullname -> problem for files that failed.  Files
+        recorded as ok in the checkpoint by an earlier run are skipped,
+        files recorded as failed are checked again (they may have been
+        repaired).
+    """
+    done = read_checkpoint(checkpoint)
+    todo = [finfo for finfo in files if done.get(get_fullname(finfo)) != '']
+    problems = {}
+    print(f"Verifying {len(todo)} files ({len(files) - len(todo)} already verified)")
+
+    starttime = time.time()
+    ckfh = open(checkpoint, 'a') if checkpoint is not None else None
+    try:
+        with futures.ThreadPoolExecutor(max_workers=max(1, nthreads)) as executor:
+            pending = {}
+            todoiter = iter(todo)
+            for finfo in todoiter:
+                pending[executor.submit(verify_file, root, finfo, md5sum)] = get_fullname(finfo)
+                if len(pending) >= 2 * nthreads:
+                    break
+            while pending:
+                complete, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for fut in complete:
+                    fname = pending.pop(fut)
+                    prob = fut.result()
+                    if prob:
+                        problems[fname] = prob
+                    if ckfh is not None:
+                        ckfh.write(f"{fname}\t{prob or ''}\n")
+                    finfo = next(todoiter, None)
+                    if finfo is not None:
+                        pending[executor.submit(verify_file, root, finfo, md5sum)] = get_fullname(finfo)
+                if ckfh is not None:
+                    ckfh.flush()
+    finally:
+        if ckfh is not None:
+            ckfh.close()
+
+    secs = time.time() - starttime
+    rate = len(todo) / secs if secs > 0 else 0
+    print(f"DESDMTIME: verify_files {len(todo)} {secs:0.3f} ({rate:0.1f} files/sec)")
+    return problems
@@ -10,7 +10,6 @@
 import argparse
 import re
 import sys
-import datetime
 
 import processingfw.pfwdb as pfwdb
 
@@ -19,12 +18,6 @@ def print_header():
     """ Print report column headers """
     print("tid, parent_tid, root_tid, name, label, status, infotable, start_time, end_time")
 
-######################################################################
-def get_start_time(x):
-    """ Get non-null start_time """
-    maxdate = datetime.datetime.now()
-    return x['start_time'] or maxdate
-
 ######################################################################
 def print_task(taskd, indent=''):
     """ Print information for a single task """
@@ -48,17 +41,6 @@ def print_task(taskd, indent=''):
     else:
         print("")
 
-######################################################################
-def recurs_dump(tasks, tids, indent=''):
-    """ Recursively print task information """
-    tlist = [tasks[t] for t in tids]
-    for taskd in sorted(tlist, key=lambda x: get_start_time(x), reverse=False):
-    #for taskd in sorted(tlist, key=lambda x: x['created_date'], reverse=False):
-    #for taskd in sorted(tlist, key=lambda x: x['id'], reverse=False):
-        print_task(taskd, indent)
-        if taskd['children']:
-            recurs_dump(tasks, taskd['children'], indent+'    ')
-
 ######################################################################
 def parse_args(argv):
     """ Parse command line arguments """
@@ -70,6 +52,14 @@ def parse_args(argv):
     parser.add_argument('-r', '--reqnum', action='store')
     parser.add_argument('-u', '--unitname', action='store')
     parser.add_argument('-a', '--attnum', action='store')
+    parser.add_argument('--subtree', action='store', type=int,
+                        help='Only print the tree below this task id')
+    parser.add_argument('--maxdepth', action='store', type=int,
+                        help='Only print this many levels of the tree')
+    parser.add_argument('--maxtasks', action='store', type=int,
+                        help='Stop after printing this many tasks')
+    parser.add_argument('--cachedir', action='store',
+                        help='Save/reuse task trees of finished attempts in this directory')
 
     args = vars(parser.parse_args(argv))   # convert to dict
 
@@ -96,60 +86,14 @@ def parse_attempt_str(attstr):
     return reqnum, unitname, attnum
 
 ######################################################################
-def get_task_info(args):
-    """ Query the DB for task information """
-
-    dbh = pfwdb.PFWDB(args['des_services'], args['section'])
-
-    # get the run info
-    attinfo = dbh.get_attempt_info(args['reqnum'], args['unitname'], args['attnum'])
-    attid = attinfo['task_id']
-    print("attempt task id = ", attid)
-
-    #sql = """WITH alltasks (id, parent_task_id, root_task_id, lvl,
-    #name, info_table, start_time, end_time, status, exec_host,label)
-    #AS (SELECT c.id, c.parent_task_id, c.root_task_id, 1, c.name,
-    #c.info_table, c.start_time, c.end_time, c.status, c.exec_host,c.label
-    #FROM task c WHERE c.id=%s UNION ALL SELECT r.id, r.parent_task_id,
-    #r.root_task_id, a.lvl+1, r.name, r.info_table, r.start_time,
-    #r.end_time, r.status, r.exec_host,r.label FROM alltasks a INNER
-    #JOIN task r ON r.parent_task_id = a.id) SELECT id, parent_task_id,
-    #root_task_id, lvl, name, info_table, start_time, end_time, status,
-    #exec_host, label FROM alltasks ORDER BY lvl ASC""" % (attid)
-
-    sql = f"select * from task where root_task_id={attid:d} order by id"
-    print(sql)
-
-    curs = dbh.cursor()
-    curs.execute(sql)
-    desc = [d[0].lower() for d in curs.description]
-    #print desc
-
-    tasks = {}
-    for line in curs:
-        lined = dict(zip(desc, line))
-        lined['children'] = []
-        tasks[lined['id']] = lined
-
-    return attid, tasks
-
-
-######################################################################
-def add_children(tasks):
-    """ To help printing, add children ids to tasks """
-
-    orphans = {}
-    for taskd in tasks.values():
-        if taskd['parent_task_id'] is not None:
-            if taskd['parent_task_id'] in tasks:
-                tasks[taskd['parent_task_id']]['children'].append(taskd['id'])
-            else:
-                orphans[taskd['id']] = taskd
-        elif taskd['name'] != 'attempt':  # attempt is not orphan
-            orphans[taskd['id']] = taskd
-
-    return orphans
-
+def dump_task_tree(dbh, attid, args):
+    """ Print task information in tree order as it is read """
+    cnt = 0
+    for taskd in dbh.get_task_tree(attid, args['subtree'], args['maxdepth'],
+                                   args['maxtasks'], args['cachedir']):
+        print_task(taskd, '    ' * (taskd['depth'] - 1))
+        cnt += 1
+    return cnt
 
 
 ######################################################################
@@ -161,18 +105,24 @@ def main(argv):
     print("reqnum =", args['reqnum'])
     print("attnum =", args['attnum'])
 
-    attid, tasks = get_task_info(args)
-    orphans = add_children(tasks)
+    dbh = pfwdb.PFWDB(args['des_services'], args['section'])
 
-    print(len(tasks), "tasks total")
+    # get the run info
+    attinfo = dbh.get_attempt_info(args['reqnum'], args['unitname'], args['attnum'])
+    attid = attinfo['task_id']
+    print("attempt task id = ", attid)
 
     print_header()
-    recurs_dump(tasks, [attid], '')
-
-    if orphans:
-        print("********** ORPHANS  **********")
-        for taskd in sorted(orphans.values(), key=lambda x: x['parent_task_id'], reverse=False):
-            print_task(taskd)
+    cnt = dump_task_tree(dbh, attid, args)
+    print(cnt, "tasks printed")
+
+    # orphans only make sense when looking at the whole tree
+    if args['subtree'] is None and args['maxdepth'] is None and args['maxtasks'] is None:
+        orphans = dbh.get_orphan_tasks(attid)
+        if orphans:
+            print("********** ORPHANS  **********")
+            for taskd in sorted(orphans, key=lambda x: x['parent_task_id'] or 0, reverse=False):
+                print_task(taskd)
 
 
 if __name__ == "__main__":
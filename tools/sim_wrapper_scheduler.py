@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+""" Simulate a parallel wrapper group with synthetic durations
+
+    Compares the old fixed pool (fw_nthread wrappers at a time in wrapnum
+    order) with processingfw.pfwsched.WrapperScheduler.   Time is simulated
+    so no wrappers, DB or sleeping are needed.
+"""
+
+import argparse
+import random
+import sys
+
+import processingfw.pfwsched as pfwsched
+
+######################################################################
+def make_wrappers(nwrappers, seed):
+    """ Create synthetic wrappers: hints plus actual run times """
+    rand = random.Random(seed)
+    hints = {}
+    actual = {}
+    for i in range(1, nwrappers + 1):
+        wrapnum = str(i)
+        secs = rand.lognormvariate(5.5, 0.8)
+        hints[wrapnum] = {'secs': secs,
+                          'ncpu': rand.choice([1, 1, 1, 1, 2, 2, 4, 8])}
+        # the hint is only an estimate of the run time
+        actual[wrapnum] = secs * rand.uniform(0.7, 1.3)
+    return hints, actual
+
+######################################################################
+class FifoPolicy:
+    """ Old behavior: up to nproc wrappers at a time in wrapnum order """
+    def __init__(self, wrapnums, nproc):
+        self.pending = sorted(wrapnums, key=int)
+        self.started = []
+        self.nproc = nproc
+        self.waits = 0
+
+    def next_wrapper(self, unfinished):
+        """ Return the next wrapper to start now, or None if must wait """
+        if not self.pending or len([w for w in self.started if w in unfinished]) >= self.nproc:
+            return None
+        wrapnum = self.pending.pop(0)
+        self.started.append(wrapnum)
+        return wrapnum
+
+######################################################################
+def simulate(policy, hints, actual, ncpu):
+    """ Run the group in simulated time, asking the policy whenever a wrapper ends
+
+        When the running wrappers want more cpus than the slot has, they
+        all slow down in proportion (the kernel shares the cpus).
+    """
+    unfinished = dict.fromkeys(actual)   # like job_track
+    remaining = {}
+    now = 0.
+    busy = 0.
+    oversub = 0.
+    peak = 0
+    while unfinished:
+        wrapnum = policy.next_wrapper(unfinished)
+        while wrapnum is not None:
+            remaining[wrapnum] = actual[wrapnum]
+            wrapnum = policy.next_wrapper(unfinished)
+
+        inuse = sum([max(1, hints[w].get('ncpu', 0)) for w in remaining])
+        peak = max(peak, inuse)
+        rate = min(1., ncpu / inuse)
+        step = min(remaining.values()) / rate
+        busy += min(inuse, ncpu) * step
+        if inuse > ncpu:
+            oversub += step
+        now += step
+        for wrapnum in list(remaining):
+            remaining[wrapnum] -= step * rate
+            if remaining[wrapnum] <= 1e-9:
+                del remaining[wrapnum]
+                del unfinished[wrapnum]
+
+    return {'makespan': now, 'util': busy / (ncpu * now), 'peak': peak,
+            'oversub': oversub, 'waits': policy.waits}
+
+######################################################################
+def parse_args(argv):
+    """ Parse command line arguments """
+    parser = argparse.ArgumentParser(description='Simulate wrapper scheduling with synthetic durations')
+    parser.add_argument('--nwrappers', action='store', type=int, default=200)
+    parser.add_argument('--nproc', action='store', type=int, default=8,
+                        help='fw_nthread for the group')
+    parser.add_argument('--ncpu', action='store', type=int, default=8,
+                        help='cpus in the batch slot')
+    parser.add_argument('--seed', action='store', type=int, default=1)
+    parser.add_argument('--trials', action='store', type=int, default=5)
+    return parser.parse_args(argv)
+
+######################################################################
+def main(argv):
+    """ Program entry point """
+    args = parse_args(argv)
+
+    print("trial, policy, makespan, cpu_util, peak_cpus, oversub_secs, waits")
+    for trial in range(args.trials):
+        hints, actual = make_wrappers(args.nwrappers, args.seed + trial)
+        policies = [('fifo', FifoPolicy(list(actual), args.nproc)),
+                    ('sched', pfwsched.WrapperScheduler(list(actual), hints, args.nproc, ncpu=args.ncpu))]
+        for name, policy in policies:
+            stats = simulate(policy, hints, actual, args.ncpu)
+            print(f"{trial}, {name}, {stats['makespan']:0.1f}, {stats['util']:0.3f}, "
+                  f"{stats['peak']}, {stats['oversub']:0.1f}, {stats['waits']}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])